@@ -0,0 +1,414 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# End to end benchmark of the handover pipeline, offline.
+# handover_database and the datacheck, dbcopy, metadata and dispatch tasks run in this process, over an in memory
+# broker consumed by a thread pool worker. The datacheck, dbcopy, metadata and event services, Elasticsearch, the
+# report exchange and the MySQL servers are in memory stand-ins answering after a sampled latency, their jobs
+# completing after a sampled duration:
+#     python benchmarks/pipeline.py --handovers 200 --concurrency 16
+#     python benchmarks/pipeline.py --job-duration lognormal:2,0.5 --api-latency uniform:0.005,0.02 --dispatch
+# Latencies and durations are given in seconds as const:S, uniform:MIN,MAX, lognormal:MEDIAN,SIGMA or exp:MEAN.
+# '''
+
+import argparse
+import contextlib
+import itertools
+import logging
+import math
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import mock
+
+DISTRIBUTIONS = {
+    'const': lambda rng, value: value,
+    'uniform': lambda rng, low, high: rng.uniform(low, high),
+    'lognormal': lambda rng, median, sigma: rng.lognormvariate(math.log(median), sigma),
+    'exp': lambda rng, mean: rng.expovariate(1 / mean),
+}
+
+
+def distribution(text, rng=random):
+    """Sampler of the latency described by text, e.g. uniform:0.01,0.05"""
+    name, _, params = text.partition(':')
+    if name not in DISTRIBUTIONS:
+        raise ValueError(f"Unknown distribution {name}, expected one of {', '.join(DISTRIBUTIONS)}")
+    values = [float(value) for value in params.split(',')] if params else []
+    sample = DISTRIBUTIONS[name]
+    try:
+        sample(rng, *values)
+    except (TypeError, ValueError, ZeroDivisionError) as e:
+        raise ValueError(f"Invalid parameters for {text}: {e}") from e
+    return lambda: max(0.0, sample(rng, *values))
+
+
+def percentile(values, ratio):
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+class Stats:
+    """Counters and timings collected during a run, by handover token"""
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.counters = Counter()
+        self.submitted = {}
+        self.in_flight = Counter()
+        self.finished = {}
+        self.failed = set()
+        self.busy = 0
+        self.peak_busy = 0
+        self.busy_seconds = 0.0
+        self.started = {}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def submit(self, token, when):
+        with self.lock:
+            self.submitted[token] = when
+
+    def published(self, token):
+        with self.lock:
+            self.counters['broker_messages'] += 1
+            if token:
+                self.in_flight[token] += 1
+
+    def task_started(self, task_id):
+        with self.lock:
+            self.started[task_id] = time.perf_counter()
+            self.busy += 1
+            self.peak_busy = max(self.peak_busy, self.busy)
+
+    def task_ended(self, task_id, token, state):
+        """A handover is over once none of its task messages is left to run"""
+        now = time.perf_counter()
+        with self.lock:
+            self.busy -= 1
+            self.busy_seconds += now - self.started.pop(task_id, now)
+            if state == 'FAILURE':
+                self.failed.add(token)
+            if token:
+                self.in_flight[token] -= 1
+                if self.in_flight[token] <= 0:
+                    self.finished[token] = now
+                    self.lock.notify_all()
+
+    def report(self, report):
+        self.count('reports')
+        params = report.get('params') or {}
+        if report.get('report_type') in ('ERROR', 'CRITICAL') and params.get('handover_token'):
+            with self.lock:
+                self.failed.add(params['handover_token'])
+
+    def wait(self, tokens, timeout):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while not all(token in self.finished for token in tokens):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+
+class FakeJobService:
+    """Stand-in of a REST service running jobs: submit_job returns a job id and retrieve_job reports the job as running
+    until its sampled duration elapsed"""
+
+    def __init__(self, name, stats, api_latency, job_duration, running, done, status_key='status', output=None):
+        self.name = name
+        self.stats = stats
+        self.api_latency = api_latency
+        self.job_duration = job_duration
+        self.running = running
+        self.done = done
+        self.status_key = status_key
+        self.output = output
+        self.ids = itertools.count(1)
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def _call(self, method):
+        time.sleep(self.api_latency())
+        self.stats.count(f"{self.name}.{method}")
+
+    def submit_job(self, *args, **kwargs):
+        self._call('submit_job')
+        with self.lock:
+            job_id = next(self.ids)
+            self.jobs[job_id] = time.monotonic() + self.job_duration()
+        return job_id
+
+    def retrieve_job(self, job_id):
+        self._call('retrieve_job')
+        with self.lock:
+            done = time.monotonic() >= self.jobs[int(job_id)]
+        job = {'id': job_id, self.status_key: self.done if done else self.running}
+        if done and self.output is not None:
+            job['output'] = self.output
+        return job
+
+
+class FakeElasticsearch:
+    """Stand-in of the Elasticsearch client, every index empty"""
+
+    def __init__(self, stats, latency):
+        self.stats = stats
+        self.latency = latency
+        self.indices = SimpleNamespace(exists=lambda **kwargs: False)
+
+    def _call(self, kind):
+        time.sleep(self.latency())
+        self.stats.count(kind)
+
+    def ping(self):
+        return True
+
+    def index(self, **kwargs):
+        self._call('es.documents')
+
+    update = index
+
+    def bulk(self, body=None, **kwargs):
+        self._call('es.bulk_requests')
+        for _ in body[::2]:
+            self.stats.count('es.documents')
+        return {'errors': False, 'items': [{'update': {'status': 200}} for _ in body[::2]]}
+
+    def delete(self, **kwargs):
+        self._call('es.deletes')
+
+    def search(self, **kwargs):
+        self._call('es.searches')
+        return {'hits': {'total': {'value': 0}, 'hits': []}, 'aggregations': {'top_result': {'hits': {'hits': []}}}}
+
+
+class FakePublisher:
+    """Stand-in of the report publisher, the latency being paid by the caller only when reports are not sent from
+    a background thread"""
+
+    def __init__(self, stats, latency, synchronous):
+        self.stats = stats
+        self.latency = latency
+        self.synchronous = synchronous
+
+    def publish(self, report, routing_key):
+        if self.synchronous:
+            time.sleep(self.latency())
+        self.stats.report(report)
+
+    def close(self, timeout=30):
+        pass
+
+
+@contextlib.contextmanager
+def stand_ins(stats, args, databases):
+    """Replace the services used by the pipeline with in memory stand-ins"""
+    from ensembl.production.handover import es
+    from ensembl.production.handover.celery_app import lookups, utils
+    from ensembl.production.handover.config import ComparaSpeciesIndex, HandoverCeleryConfig, HandoverConfig as cfg
+
+    events = [{'genome': 'benchmark_species', 'type': 'new_genome', 'details': '{}'}] if args.dispatch else []
+    services = {
+        'dc_client': FakeJobService('datacheck', stats, args.api_latency, args.job_duration, 'running', 'passed'),
+        'db_copy_client': FakeJobService('dbcopy', stats, args.api_latency, args.job_duration, 'Running', 'Complete',
+                                         status_key='overall_status'),
+        'metadata_client': FakeJobService('metadata', stats, args.api_latency, args.job_duration, 'running',
+                                          'complete', output={'events': events}),
+        'event_client': FakeJobService('event', stats, args.api_latency, args.job_duration, 'running', 'done'),
+        'publisher': FakePublisher(stats, args.amqp_latency, synchronous=not cfg.report_async),
+    }
+    elasticsearch = FakeElasticsearch(stats, args.es_latency)
+    meta_rows = [('schema_version', str(utils.release)), ('species.division', 'EnsemblVertebrates')]
+
+    def query(self, uri, statement, **params):
+        time.sleep(args.mysql_latency())
+        stats.count('mysql.queries')
+        return [('GRCh38',)] if 'genome_db' in str(statement) else meta_rows
+
+    def list_databases(uri, registry=None):
+        time.sleep(args.mysql_latency())
+        stats.count('mysql.listings')
+        return databases
+
+    with contextlib.ExitStack() as stack:
+        for name, service in services.items():
+            stack.enter_context(mock.patch.object(getattr(utils, name), 'get', lambda service=service: service))
+        stack.enter_context(mock.patch.object(es, 'get_es_client', lambda: elasticsearch))
+        stack.enter_context(mock.patch.object(lookups.DatabaseLookups, 'query', query))
+        stack.enter_context(mock.patch.object(lookups, 'list_databases', list_databases))
+        stack.enter_context(mock.patch.object(cfg, 'compara_species',
+                                              ComparaSpeciesIndex({'vertebrates': ['benchmark_species']})))
+        stack.enter_context(mock.patch.object(cfg, 'dispatch_all', args.dispatch))
+        stack.enter_context(mock.patch.object(cfg, 'dispatch_targets',
+                                              {'core': 'mysql://ensadmin@dispatch-host:3306/'} if args.dispatch else {}))
+        stack.enter_context(mock.patch.object(HandoverCeleryConfig, 'backoff_policies',
+                                              {'default': {'initial': args.poll_interval}}))
+        stack.enter_context(mock.patch.object(HandoverCeleryConfig, 'learned_backoff', False))
+        lookups.database_listings.clear()
+        yield services
+
+
+def handover_token(body):
+    """Handover token of a task message body or arguments, the spec being the first argument of every task"""
+    task_args = body[0] if isinstance(body, (list, tuple)) and body and isinstance(body[0], (list, tuple)) else body
+    spec = task_args[0] if task_args else None
+    return spec.get('handover_token') if isinstance(spec, dict) else None
+
+
+@contextlib.contextmanager
+def instrumented(stats):
+    """Count the broker messages and track the worker slots and handovers in flight"""
+    from celery import signals
+
+    def before_publish(body=None, headers=None, **kwargs):
+        if headers and headers.get('retries'):
+            stats.count('broker_retries')
+        stats.published(handover_token(body))
+
+    def prerun(task_id=None, **kwargs):
+        stats.task_started(task_id)
+
+    def postrun(task_id=None, args=None, state=None, **kwargs):
+        stats.task_ended(task_id, handover_token(args), state)
+
+    receivers = ((signals.before_task_publish, before_publish), (signals.task_prerun, prerun),
+                 (signals.task_postrun, postrun))
+    for signal, receiver in receivers:
+        signal.connect(receiver, weak=False)
+    try:
+        yield
+    finally:
+        for signal, receiver in receivers:
+            signal.disconnect(receiver)
+
+
+def run(args):
+    from celery.contrib.testing.worker import start_worker
+    from ensembl.production.handover.celery_app import tasks
+    from ensembl.production.handover.celery_app.app import app
+
+    app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                    broker_transport_options={'polling_interval': 0.01}, completion_mode='poll')
+    release = tasks.release
+    databases = [f"benchmark_species_{i}_core_{release}_1" for i in range(args.handovers)]
+    specs = [{'src_uri': f"mysql://ensro@benchmark-host:3306/{database}", 'database': database,
+              'contact': 'benchmark@ebi.ac.uk', 'comment': 'benchmark'} for database in databases]
+    stats = Stats()
+
+    def submit(spec):
+        start = time.perf_counter()
+        try:
+            token = tasks.handover_database(spec)
+        except Exception as e:
+            logging.error("Cannot submit %s: %s", spec['database'], e)
+            stats.count('submit_errors')
+            return None
+        stats.count('submit_seconds', time.perf_counter() - start)
+        stats.submit(token, start)
+        return token
+
+    with stand_ins(stats, args, databases), instrumented(stats), \
+            start_worker(app, pool='threads', concurrency=args.concurrency, perform_ping_check=False,
+                         loglevel='WARNING', shutdown_timeout=args.timeout):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.submitters) as executor:
+            tokens = [token for token in executor.map(submit, specs) if token]
+        submit_elapsed = time.perf_counter() - start
+        completed = stats.wait(tokens, args.timeout)
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(stats.finished[token] - stats.submitted[token] for token in tokens if token in stats.finished)
+    return {
+        'handovers': len(tokens),
+        'rejected': stats.counters['submit_errors'],
+        'completed': completed,
+        'failed': len(stats.failed),
+        'submissions_per_second': len(tokens) / submit_elapsed,
+        'elapsed': elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else 0.0,
+        'occupancy': stats.busy_seconds / (args.concurrency * elapsed),
+        'peak_busy': stats.peak_busy,
+        'counters': stats.counters,
+    }
+
+
+def report(result, concurrency):
+    handovers = result['handovers']
+    counters = result['counters']
+
+    def per_handover(*names):
+        return sum(counters[name] for name in names) / handovers
+
+    lines = [
+        f"handovers         {handovers} in {result['elapsed']:.1f}s, {result['rejected']} rejected, "
+        f"{result['failed']} failed"
+        f"{'' if result['completed'] else ', TIMED OUT'}",
+        f"submissions       {result['submissions_per_second']:.1f}/s, "
+        f"{counters['submit_seconds'] / handovers * 1000:.1f}ms each",
+        f"end to end        p50={result['p50']:.2f}s p95={result['p95']:.2f}s p99={result['p99']:.2f}s "
+        f"max={result['max']:.2f}s",
+        f"broker messages   {per_handover('broker_messages'):.1f} per handover, "
+        f"{per_handover('broker_retries'):.1f} retries",
+        f"reports           {per_handover('reports'):.1f} per handover",
+        f"ES                {per_handover('es.documents'):.1f} documents, {per_handover('es.searches'):.1f} searches "
+        f"per handover",
+        f"MySQL             {per_handover('mysql.queries'):.1f} queries, {per_handover('mysql.listings'):.2f} "
+        f"listings per handover",
+    ]
+    for service in ('datacheck', 'dbcopy', 'metadata', 'event'):
+        lines.append(f"{service:<17} {per_handover(f'{service}.submit_job'):.1f} submissions, "
+                     f"{per_handover(f'{service}.retrieve_job'):.1f} polls per handover")
+    lines.append(f"worker slots      {result['occupancy'] * 100:.1f}% busy, peak {result['peak_busy']}/{concurrency}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End to end benchmark of the handover pipeline against in memory '
+                                                 'stand-ins of the services it depends on')
+    parser.add_argument('--handovers', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8, help='worker slots')
+    parser.add_argument('--submitters', type=int, default=4, help='threads calling handover_database')
+    parser.add_argument('--poll-interval', type=float, default=0.2, help='delay between two polls of a job')
+    parser.add_argument('--dispatch', action='store_true', help='dispatch the databases after the metadata load')
+    parser.add_argument('--job-duration', type=distribution, default='uniform:0.5,1.5',
+                        help='duration of the datacheck, copy and metadata jobs')
+    parser.add_argument('--api-latency', type=distribution, default='uniform:0.005,0.02',
+                        help='latency of the datacheck, dbcopy, metadata and event services')
+    parser.add_argument('--es-latency', type=distribution, default='uniform:0.002,0.01')
+    parser.add_argument('--amqp-latency', type=distribution, default='const:0.002',
+                        help='report publishing latency, paid by the tasks only when report_async is off')
+    parser.add_argument('--mysql-latency', type=distribution, default='const:0.002')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for the handovers to complete')
+    parser.add_argument('--seed', type=int, help='seed of the latency samples')
+    args = parser.parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('ensembl').setLevel(logging.WARNING)
+    print(report(run(args), args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
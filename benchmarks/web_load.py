@@ -0,0 +1,121 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Load benchmark of the handover list and detail endpoints.
+#
+# Against a running service (e.g. gunicorn --config gunicorn_config.py ...):
+#     python benchmarks/web_load.py --url http://localhost:5000 --token <handover_token>
+# Offline, against the app served by a threaded server in this process, the state store answering from memory after
+# --latency seconds to stand for Elasticsearch:
+#     python benchmarks/web_load.py --concurrency 1 --no-cache
+#     python benchmarks/web_load.py --concurrency 16 --no-cache
+# '''
+
+import argparse
+import logging
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def fake_states(count=1000):
+    return [{'handover_token': f'token-{i}', 'database': f'species_{i}_core_110_1', 'release': [110],
+             'src_uri': f'mysql://ensro@host:3306/species_{i}_core_110_1', 'contact': 'user@ebi.ac.uk',
+             'comment': 'benchmark', 'report_type': 'INFO', 'message': 'Handover successful', 'status': 'successful',
+             'report_time': '2023-06-01T10:00:00.000', 'submission_time': '2023-06-01T09:00:00.000'}
+            for i in range(count)]
+
+
+def serve_offline(latency, cache):
+    """Serve the app with an in memory state store, returns the base url"""
+    from werkzeug.serving import make_server
+    from ensembl.production.handover.app import main
+    from ensembl.production.handover.celery_app.state import HandoverStateStore
+
+    states = fake_states()
+    by_token = {state['handover_token']: state for state in states}
+
+    class FakeStateStore(HandoverStateStore):
+        def get(self, handover_token):
+            time.sleep(latency)
+            return by_token.get(handover_token)
+
+        def page(self, query, sort='report_time', order='desc', limit=100, offset=0, search_after=None):
+            time.sleep(latency)
+            return len(states), states[offset:offset + limit], None
+
+    main.state_store = FakeStateStore()
+    if not cache:
+        main.response_cache.ttl = 0
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def run(url, concurrency, duration):
+    """Requests per second and latencies of GET url from concurrency threads during duration seconds"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                session.get(url).raise_for_status()
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+            except requests.RequestException as e:
+                with lock:
+                    errors.append(e)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50': statistics.median(latencies) * 1000 if latencies else 0,
+        'p95': latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load benchmark of GET /jobs and GET /jobs/<token>')
+    parser.add_argument('--url', help='base url of a running service, the app is served in process otherwise')
+    parser.add_argument('--token', default='token-1', help='handover token for the detail endpoint')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--latency', type=float, default=0.02, help='offline state store latency in seconds')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='disable the offline response cache')
+    args = parser.parse_args(argv)
+    base_url = args.url.rstrip('/') if args.url else serve_offline(args.latency, args.cache)
+    for name, path in (('list', '/jobs?format=json&limit=100'),
+                       ('detail', f'/jobs/{args.token}?format=json')):
+        result = run(base_url + path, args.concurrency, args.duration)
+        print(f"{name:<6} concurrency={args.concurrency} requests={result['requests']} errors={result['errors']} "
+              f"{result['rps']:.1f} req/s p50={result['p50']:.1f}ms p95={result['p95']:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
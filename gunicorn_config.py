@@ -19,6 +19,7 @@
 #
 
 #  bind = '0.0.0.0:5006'
+import multiprocessing
 import os
 bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
 backlog = int(os.getenv("GUNICORN_BACKLOG", "2048"))
@@ -68,11 +69,24 @@ backlog = int(os.getenv("GUNICORN_BACKLOG", "2048"))
 #       A positive integer. Generally set in the 1-5 seconds range.
 #
 
-workers = 2
-worker_class = 'sync'
-worker_connections = 1000
-timeout = 120
-keepalive = 2
+#   threads - The number of worker threads per process, with the
+#       gthread worker class. Views mostly wait on Elasticsearch,
+#       MySQL and the other production services, so a few threads
+#       per process serve slow requests without stalling the others.
+#
+#   The defaults below can be overridden with GUNICORN_WORKERS,
+#   GUNICORN_THREADS, GUNICORN_WORKER_CLASS and GUNICORN_TIMEOUT.
+#   GUNICORN_WORKER_CLASS=sync GUNICORN_WORKERS=2 gives back the
+#   previous one request per process deployment.
+#
+
+workers = int(os.getenv("GUNICORN_WORKERS", min(2 * multiprocessing.cpu_count() + 1,
+                                                int(os.getenv("GUNICORN_MAX_WORKERS", "8")))))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "2"))
 
 #
 #   spew - Install a trace function that spews every line of Python
@@ -191,6 +205,9 @@ access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"
 
 def post_fork(server, worker):
     server.log.info("Worker spawned (pid: %s)", worker.pid)
+    # start loading the compara allowed species, requests answer with an empty list until they are loaded
+    from ensembl.production.handover.config import HandoverConfig
+    HandoverConfig.compara_species.load()
 
 def pre_fork(server, worker):
     pass
@@ -220,3 +237,9 @@ def worker_int(worker):
 
 def worker_abort(worker):
     worker.log.info("worker received SIGABRT signal")
+
+def child_exit(server, worker):
+    # forget the live gauges of the worker when the metrics are shared between the workers
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -11,14 +11,16 @@
 #    limitations under the License.
 
 import datetime
+import json
 import logging
 import os
 import re
+import time
 
 import requests
 from elasticsearch import TransportError, NotFoundError
 from flasgger import Swagger
-from flask import Flask, request, jsonify, render_template, redirect, flash, url_for
+from flask import Flask, request, jsonify, render_template, redirect, flash, url_for, g, stream_with_context
 from flask_bootstrap import Bootstrap4
 from flask_cors import CORS
 from requests.exceptions import HTTPError
@@ -28,10 +30,17 @@ from werkzeug.wrappers import Response
 
 import ensembl.production.handover.exceptions
 from ensembl.production.core import app_logging
-from ensembl.production.core.es import ElasticsearchConnectionManager
 from ensembl.production.core.exceptions import HTTPRequestError
-from ensembl.production.handover.celery_app.tasks import handover_database, stop_handover_job, restart_handover_job
-from ensembl.production.handover.config import HandoverConfig as cfg
+from ensembl.production.handover import export, metrics
+from ensembl.production.handover.cache import response_cache
+from ensembl.production.handover.celery_app.lookups import database_listings
+from ensembl.production.handover.celery_app.state import state_store, stage_timeline
+from ensembl.production.handover.celery_app.tasks import submit_handover, stop_handover_job, restart_handover_job, \
+    notify_job_completion, handover_databases
+from ensembl.production.handover.celery_app.utils import state_writer
+from ensembl.production.handover.config import HandoverConfig as cfg, parse_boolean_var
+from ensembl.production.handover.dropdown import dropdown_proxy, listing_server, MAX_DROPDOWN_RESULTS
+from ensembl.production.handover.es import ElasticsearchConnection
 from ensembl.production.handover.exceptions import MissingDispatchException
 from ensembl.production.handover.forms import HandoverSubmissionForm
 
@@ -75,12 +84,9 @@ bootstrap = Bootstrap4(app)
 # use re to support different charsets
 json_pattern = re.compile("application/json")
 form_pattern = re.compile("multipart/form-data")
-es_host = app.config['ES_HOST']
-es_port = int(app.config['ES_PORT'])
 es_index = app.config['ES_INDEX']
-es_user = app.config['ES_USER']
-es_password = app.config['ES_PASSWORD']
-es_ssl = app.config['ES_SSL']
+# parameters of a paged handover list, answered with its total and rows
+LIST_PAGING_PARAMS = ('limit', 'offset', 'search_after')
 
 
 @app.context_processor
@@ -91,17 +97,30 @@ def inject_configs():
                 css_url=f"css/{cfg.HANDOVER_TYPE}.css")
 
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    if 'request_start' in g:
+        metrics.http_seconds.labels(request.endpoint or 'unknown', request.method,
+                                    response.status_code).observe(time.perf_counter() - g.request_start)
+    return response
+
+
 @app.route('/', methods=['GET'])
 def info():
     if not cfg.compara_species:
         # Empty list of compara
         raise MissingDispatchException
 
-    app.config['SWAGGER'] = {
+    # not stored in app.config, shared by the threads of the worker
+    return jsonify({
         'title': '%s handover REST endpoints' % os.getenv('APP_ENV', '').capitalize(),
         'uiversion': 2
-    }
-    return jsonify(app.config['SWAGGER'])
+    })
 
 
 @app.route('/ping', methods=['GET'])
@@ -113,21 +132,37 @@ def ping():
     return jsonify({"status": "ok"})
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_export():
+    """Prometheus metrics of the web app, and of the celery workers sharing PROMETHEUS_MULTIPROC_DIR"""
+    if not metrics.enabled:
+        return jsonify(error='Metrics are disabled or prometheus_client is not installed'), 404
+    return Response(metrics.export(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/jobs/dropdown/src_host', methods=['GET'])
 @app.route('/jobs/dropdown/databases/<string:src_host>/<string:src_port>', methods=['GET'])
 def dropdown(src_host=None, src_port=None):
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        raise HTTPRequestError('limit must be an integer', 400)
+    if not 0 < limit <= MAX_DROPDOWN_RESULTS:
+        raise HTTPRequestError(f'limit must be between 1 and {MAX_DROPDOWN_RESULTS}', 400)
     try:
         src_name = request.args.get('name', None)
         search = request.args.get('search', None)
         if src_name:
-            res = requests.get(f"{cfg.copy_uri_dropdown}api/dbcopy/srchost", params={'name': src_name})
-            res.raise_for_status()
-            return jsonify(res.json())
+            return jsonify(dropdown_proxy.get('api/dbcopy/srchost', name=src_name))
         elif src_host and src_port and search:
-            res = requests.get(f"{cfg.copy_uri_dropdown}api/dbcopy/databases/{src_host}/{src_port}",
-                               params={'search': search})
-            res.raise_for_status()
-            return jsonify(res.json())
+            # only the known source servers are listed, with the configured read only user
+            server = listing_server(src_host, src_port)
+            if server:
+                try:
+                    return jsonify(database_listings.search(server, search, limit))
+                except OperationalError as e:
+                    app.logger.warning("Unable to list databases of %s:%s: %s", src_host, src_port, e)
+            return jsonify(dropdown_proxy.get(f"api/dbcopy/databases/{src_host}/{src_port}", search=search))
         else:
             raise Exception('required params not provided')
     except HTTPError as http_err:
@@ -153,7 +188,7 @@ def handover_form():
                 spec = request.form.to_dict()
                 spec['src_uri'] = spec['src_uri'] + spec['database']
                 app.logger.debug('Submitting handover request %s', spec)
-                ticket = handover_database(spec)
+                ticket = submit_handover(spec)
                 app.logger.info('Ticket: %s', ticket)
                 return redirect(url_for('handover_result', handover_token=str(ticket)))
             else:
@@ -253,7 +288,7 @@ def handovers():
             raise HTTPRequestError("Handover specification incomplete - please specify src_uri, contact and comment")
 
         app.logger.debug('Submitting handover request %s', spec)
-        ticket = handover_database(spec)
+        ticket = submit_handover(spec)
         app.logger.info('Ticket: %s', ticket)
 
     except Exception as e:
@@ -261,6 +296,70 @@ def handovers():
     return jsonify(ticket)
 
 
+@app.route('/jobs/batch', methods=['POST'])
+def handovers_batch():
+    """
+    Endpoint to submit several handover jobs at once
+    This is using docstring for specifications
+    ---
+    tags:
+      - handovers
+    parameters:
+      - in: body
+        name: body
+        description: list of handover jobs
+        required: true
+        schema:
+          type: array
+          items:
+            $ref: '#/definitions/handovers'
+    operationId: handovers_batch
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    security:
+      handovers_auth:
+        - 'write:jobs'
+        - 'read:jobs'
+    schemes: ['http', 'https']
+    deprecated: false
+    externalDocs:
+      description: Project repository
+      url: http://github.com/rochacbruno/flasgger
+    responses:
+      200:
+        description: handover token or error of each submitted job, in the submission order
+        examples:
+          [{src_uri: "mysql://user@server:port/saccharomyces_cerevisiae_core_91_4", handover_token: "605f1191-7a13-11e8-aa7e-005056ab00f0"}, {src_uri: "mysql://user@server:port/saccharomyces_cerevisiae_otherfeatures_91_4", error: "mysql://user@server:port/saccharomyces_cerevisiae_otherfeatures_91_4 does not exist"}]
+    """
+    try:
+        if not cfg.compara_species:
+            # Empty list of compara
+            raise MissingDispatchException
+        if not json_pattern.match(request.headers['Content-Type']):
+            raise HTTPRequestError('Could not handle input of type %s' % request.headers['Content-Type'])
+        specs = request.json
+        if not isinstance(specs, list):
+            raise HTTPRequestError('Handover batch must be a list of handover specifications')
+    except Exception as e:
+        raise HTTPRequestError(str(e), 400)
+
+    results = [None] * len(specs)
+    valid = []
+    for i, spec in enumerate(specs):
+        if not isinstance(spec, dict) or 'src_uri' not in spec or 'contact' not in spec or 'comment' not in spec:
+            results[i] = {'src_uri': spec.get('src_uri') if isinstance(spec, dict) else None,
+                          'error': 'Handover specification incomplete - please specify src_uri, contact and comment'}
+        else:
+            valid.append(i)
+    app.logger.debug('Submitting %s handover requests', len(valid))
+    for i, result in zip(valid, handover_databases([specs[i] for i in valid])):
+        results[i] = result
+    app.logger.info('Tickets: %s', results)
+    return jsonify(results)
+
+
 @app.route('/jobs/status', methods=['PUT'])
 def handover_status_update():
     """update handover status to success"""
@@ -269,7 +368,7 @@ def handover_status_update():
             handover_token = request.json.get('handover_token')
         else:
             raise HTTPRequestError('Could not handle input of type %s' % request.headers['Content-Type'])
-        with ElasticsearchConnectionManager(es_host, es_port, es_user, es_password, es_ssl) as es:
+        with ElasticsearchConnection() as es:
             res_error = es.client.search(index=es_index, body={
                 "query": {
                     "bool": {
@@ -292,12 +391,33 @@ def handover_status_update():
             result['message'] = 'Metadata load complete, Handover successful'
             result['report_type'] = 'INFO'
             res = es.client.update(index=es_index, id=h_id, doc_type='report', body={"doc": result})
+        # the report message is read from msg when present
+        state_store.upsert(state_store.from_report({**result, 'msg': result['message']}), refresh='wait_for')
+        response_cache.invalidate(handover_token)
     except Exception as e:
         raise HTTPRequestError('%s' % str(e))
 
     return res
 
 
+@app.route('/jobs/notify', methods=['PUT'])
+def handover_job_notify():
+    """Notify the completion of a downstream job (datacheck, dbcopy, metadata or dispatch) waited for by a handover"""
+    try:
+        if json_pattern.match(request.headers['Content-Type']):
+            stage = request.json.get('stage')
+            job_id = request.json.get('job_id')
+        else:
+            raise HTTPRequestError('Could not handle input of type %s' % request.headers['Content-Type'])
+        if stage is None or job_id is None:
+            raise HTTPRequestError('Notification incomplete - please specify stage and job_id')
+        notify_job_completion(stage, job_id)
+    except Exception as e:
+        raise HTTPRequestError('%s' % str(e), 400)
+
+    return jsonify({'stage': stage, 'job_id': job_id})
+
+
 @app.route('/job', methods=['GET'])
 @app.route('/jobs/<string:handover_token>', methods=['GET'])
 def handover_result(handover_token=''):
@@ -355,67 +475,200 @@ def handover_result(handover_token=''):
         return render_template('result.html',
                                handover_token=handover_token)
 
-    with ElasticsearchConnectionManager(es_host, es_port, es_user, es_password, es_ssl) as es:
+    def detail():
+        state = state_store.get(handover_token)
         handover_detail = []
-        res = es.client.search(index=es_index, body={
-            "size": 0,
-            "query": {
-                "bool": {
-                    "must": [
-                        {"term": {"params.handover_token.keyword": str(handover_token)}},
-                        {
-                            "query_string": {
-                                "fields": ["report_type"], "query": "(INFO|ERROR)",
-                                "analyze_wildcard": "true"
-                            }
-                        },
-                    ]
-                }
-            },
-            "aggs": {
-                "top_result": {
-                    "top_hits": {
-                        "size": 1,
-                        "sort": {
-                            "report_time": "desc"
-                        }
-                    }
-                }
-            },
-            "sort": [
-                {
-                    "report_time": {
-                        "order": "desc"
-                    }
-                }
-            ]
-        })
-    for doc in res['aggregations']['top_result']['hits']['hits']:
-        result = {"id": doc['_id']}
-        params = doc['_source']['params']
-        if 'job_progress' in params:
-            result['job_progress'] = params['job_progress']
-        result['message'] = doc['_source']['message']
-        result['comment'] = params.get('comment', '')
-        result['handover_token'] = params.get('handover_token', '')
-        result['contact'] = params.get('contact', '')
-        result['src_uri'] = params.get('src_uri', '')
-        result['tgt_uri'] = params.get('tgt_uri', '')
-        result['progress_complete'] = params.get('progress_complete', '')
-        result['progress_total'] = params.get('progress_total', '')
-        result['report_time'] = doc['_source']['report_time']
-        handover_detail.append(result)
-
-    if len(handover_detail) == 0:
-        raise HTTPRequestError('Handover token %s not found' % handover_token, 404)
-    else:
-        return jsonify(handover_detail)
+        if state is not None:
+            result = {"id": state['handover_token']}
+            if 'job_progress' in state:
+                result['job_progress'] = state['job_progress']
+            result['message'] = state['message']
+            result['comment'] = state.get('comment', '')
+            result['handover_token'] = state['handover_token']
+            result['contact'] = state.get('contact', '')
+            result['src_uri'] = state.get('src_uri', '')
+            result['tgt_uri'] = state.get('tgt_uri', '')
+            result['progress_complete'] = state.get('progress_complete', '')
+            result['progress_total'] = state.get('progress_total', '')
+            result['report_time'] = state['report_time']
+            handover_detail.append(result)
+
+        if len(handover_detail) == 0:
+            raise HTTPRequestError('Handover token %s not found' % handover_token, 404)
+        return handover_detail
+
+    return cached_response(response_cache.detail_key(handover_token), detail)
+
+
+@app.route('/jobs/<string:handover_token>/timeline', methods=['GET'])
+def handover_timeline(handover_token):
+    """
+    Endpoint to get the timeline of the pipeline stages of a handover
+    This is using docstring for specifications
+    ---
+    tags:
+      - handovers
+    parameters:
+      - name: handover_token
+        in: path
+        type: string
+        required: true
+        default: 15ce20fd-68cd-11e8-8117-005056ab00f0
+        description: handover token for the database handed over
+    operationId: handovers
+    produces:
+      - application/json
+    responses:
+      200:
+        description: Start, end, duration in seconds, number of checks of the downstream job and job id of each stage
+        examples:
+          {"handover_token": "605f1191-7a13-11e8-aa7e-005056ab00f0", "status": "successful", "submission_time": "2018-06-27T14:02:11.251", "report_time": "2018-06-27T15:07:07.462", "stages": [{"stage": "datacheck", "start": "2018-06-27T14:02:12.100231", "end": "2018-06-27T14:40:02.305112", "duration": 2270.2, "polls": 38, "job_id": "12", "running": false}, {"stage": "dbcopy", "start": "2018-06-27T14:40:02.401442", "end": "2018-06-27T15:06:58.012731", "duration": 1615.6, "polls": 27, "job_id": "8a7e2c1f", "running": false}]}
+      404:
+        description: Unknown handover token
+    """
+
+    def timeline():
+        state = state_store.get(handover_token)
+        if state is None:
+            raise HTTPRequestError('Handover token %s not found' % handover_token, 404)
+        return {
+            'handover_token': state['handover_token'],
+            'status': state.get('status', ''),
+            'submission_time': state.get('submission_time'),
+            'report_time': state['report_time'],
+            'stages': stage_timeline(state),
+        }
+
+    return cached_response(response_cache.timeline_key(handover_token), timeline)
+
+
+@app.route('/jobs/latency', methods=['GET'])
+def handover_latency():
+    """
+    Endpoint to get the duration of the pipeline stages of the handovers of a release
+    This is using docstring for specifications
+    ---
+    tags:
+      - handovers
+    parameters:
+      - name: release
+        in: query
+        type: string
+        description: release of the handovers (the current one by default)
+      - name: db_type
+        in: query
+        type: string
+      - name: division
+        in: query
+        type: string
+      - name: date_from
+        in: query
+        type: string
+        example: 2023-01-31
+        description: earliest submission date
+      - name: date_to
+        in: query
+        type: string
+        example: 2023-02-28T23:59:59
+        description: latest submission date
+    operationId: handovers
+    produces:
+      - application/json
+    responses:
+      200:
+        description: Number of completed stages, mean, maximum and percentiles of their duration in seconds and mean number of checks of their downstream job, by stage
+        examples:
+          {"release": "110", "stages": {"datacheck": {"count": 412, "mean": 1833.2, "max": 30211.9, "p50": 1201.4, "p90": 4210.0, "p99": 21002.3, "mean_polls": 31.2}}}
+    """
+    release = request.args.get('release', str(app.config['RELEASE']))
+
+    def latency():
+        try:
+            query = state_store.filter_query(release=release,
+                                             db_type=request.args.get('db_type'),
+                                             division=request.args.get('division'),
+                                             date_from=request.args.get('date_from'),
+                                             date_to=request.args.get('date_to'))
+        except ValueError as e:
+            raise HTTPRequestError('Invalid latency parameters: %s' % str(e), 400)
+        return {'release': release, 'stages': state_store.stage_latencies(query)}
+
+    params = {**request.args.to_dict(), 'release': release, 'view': 'latency'}
+    return cached_response(response_cache.list_key(params), latency)
+
+
+@app.route('/jobs/export', methods=['GET'])
+def handover_export():
+    """
+    Endpoint to download all the handovers of a release, streamed as json lines or csv
+    This is using docstring for specifications
+    ---
+    tags:
+      - handovers
+    parameters:
+      - name: release
+        in: query
+        type: string
+        description: release of the handovers (the current one by default)
+      - name: format
+        in: query
+        type: string
+        example: ndjson
+        description: ndjson (one handover state per line, the default) or csv
+      - name: reports
+        in: query
+        type: boolean
+        description: include the full report history of each handover, as a list in json lines or one csv line per report
+      - name: status
+        in: query
+        type: string
+        description: running, successful or failed
+      - name: db_type
+        in: query
+        type: string
+      - name: division
+        in: query
+        type: string
+      - name: date_from
+        in: query
+        type: string
+        example: 2023-01-31
+        description: earliest submission date
+      - name: date_to
+        in: query
+        type: string
+        example: 2023-02-28T23:59:59
+        description: latest submission date
+    operationId: handovers
+    produces:
+      - application/x-ndjson
+      - text/csv
+    responses:
+      200:
+        description: Handovers of the release in handover token order
+    """
+    release = request.args.get('release', str(app.config['RELEASE']))
+    fmt = request.args.get('format', 'ndjson')
+    reports = parse_boolean_var(request.args.get('reports', 'false'))
+    try:
+        query = state_store.filter_query(release=release,
+                                         status=request.args.get('status'),
+                                         db_type=request.args.get('db_type'),
+                                         division=request.args.get('division'),
+                                         date_from=request.args.get('date_from'),
+                                         date_to=request.args.get('date_to'))
+        lines = export.export(query, fmt, reports)
+    except ValueError as e:
+        raise HTTPRequestError('Invalid export parameters: %s' % str(e), 400)
+    response = app.response_class(stream_with_context(lines), mimetype=export.FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename=handovers_{release}.{fmt}'
+    return response
 
 
 @app.route('/jobs', methods=['GET'])
 def handover_results():
     """
-    Endpoint to get a list of all the handover by release
+    Endpoint to get a page of the handovers of a release
     This is using docstring for specifications
     ---
     tags:
@@ -431,6 +684,55 @@ def handover_results():
         type: string
         example: json
         description: get hadover format
+      - name: limit
+        in: query
+        type: integer
+        description: number of handovers per page (default 100, at most 1000), without limit, offset or search_after every handover is listed
+      - name: offset
+        in: query
+        type: integer
+        description: index of the first handover of the page, for pages within the first 10000 handovers
+      - name: search_after
+        in: query
+        type: string
+        description: json cursor returned with the previous page, to get the next one
+      - name: sort
+        in: query
+        type: string
+        example: report_time
+        description: field to sort on (report_time, handover_submission_time, src_uri, contact, comment, current_message, handover_token)
+      - name: order
+        in: query
+        type: string
+        example: desc
+        description: asc or desc
+      - name: status
+        in: query
+        type: string
+        description: running, successful or failed
+      - name: contact
+        in: query
+        type: string
+      - name: db_type
+        in: query
+        type: string
+      - name: division
+        in: query
+        type: string
+      - name: date_from
+        in: query
+        type: string
+        example: 2023-01-31
+        description: earliest submission date
+      - name: date_to
+        in: query
+        type: string
+        example: 2023-02-28T23:59:59
+        description: latest submission date
+      - name: search
+        in: query
+        type: string
+        description: text searched in the token, database, contact, comment and current message
 
     consumes:
       - application/json
@@ -452,11 +754,11 @@ def handover_results():
         type: object
     responses:
       200:
-        description: Retrieve all the handover job details
+        description: The handovers of the release, as {total, rows, search_after} when paged with limit, offset or search_after
         schema:
           $ref: '#/definitions/jobs'
         examples:
-          [{"comment": "handover new Tiger database", "contact": "maurel@ebi.ac.uk", "handover_token": "605f1191-7a13-11e8-aa7e-005056ab00f0", "id": "QFqRQWQBiZ0vMed2vKDI", "message": "Handling {u'comment': u'handover new Tiger database', 'handover_token': '605f1191-7a13-11e8-aa7e-005056ab00f0', u'contact': u'maurel@ebi.ac.uk', u'src_uri': u'mysql://ensro@mysql-ens-general-prod-1:4525/panthera_tigris_altaica_core_93_1', 'tgt_uri': 'mysql://ensro@mysql-ens-general-dev-1:4484/panthera_tigris_altaica_core_93_1'}", "report_time": "2018-06-27T15:07:07.462", "src_uri": "mysql://ensro@mysql-ens-general-prod-1:4525/panthera_tigris_altaica_core_93_1", "tgt_uri": "mysql://ensro@mysql-ens-general-dev-1:4484/panthera_tigris_altaica_core_93_1"}, {"comment": "handover new Leopard database", "contact": "maurel@ebi.ac.uk", "handover_token": "5dcb1aca-7a13-11e8-b24e-005056ab00f0", "id": "P1qRQWQBiZ0vMed2rqBh", "message": "Handling {u'comment': u'handover new Leopard database', 'handover_token': '5dcb1aca-7a13-11e8-b24e-005056ab00f0', u'contact': u'maurel@ebi.ac.uk', u'src_uri': u'mysql://ensro@mysql-ens-general-prod-1:4525/panthera_pardus_core_93_1', 'tgt_uri': 'mysql://ensro@mysql-ens-general-dev-1:4484/panthera_pardus_core_93_1'}", "report_time": "2018-06-27T15:07:03.145", "src_uri": "mysql://ensro@mysql-ens-general-prod-1:4525/panthera_pardus_core_93_1", "tgt_uri": "mysql://ensro@mysql-ens-general-dev-1:4484/panthera_pardus_core_93_1"} ]
+          {"total": 2, "search_after": null, "rows": [{"comment": "handover new Tiger database", "contact": "maurel@ebi.ac.uk", "handover_token": "605f1191-7a13-11e8-aa7e-005056ab00f0", "id": "605f1191-7a13-11e8-aa7e-005056ab00f0", "message": "Metadata load complete, Handover successful", "current_message": "Metadata load complete, Handover successful", "status": "successful", "report_time": "2018-06-27T15:07:07.462", "handover_submission_time": "2018-06-27T14:02:11.251", "src_uri": "mysql://ensro@mysql-ens-general-prod-1:4525/panthera_tigris_altaica_core_93_1"}, {"comment": "handover new Leopard database", "contact": "maurel@ebi.ac.uk", "handover_token": "5dcb1aca-7a13-11e8-b24e-005056ab00f0", "id": "5dcb1aca-7a13-11e8-b24e-005056ab00f0", "message": "Datachecks in progress, please see: http://datacheck/jobs/12", "current_message": "Datachecks in progress, please see: http://datacheck/jobs/12", "status": "running", "report_time": "2018-06-27T15:07:03.145", "handover_submission_time": "2018-06-27T15:01:43.077", "src_uri": "mysql://ensro@mysql-ens-general-prod-1:4525/panthera_pardus_core_93_1"}]}
     """
     app.logger.info("Retrieving all handover report")
 
@@ -467,90 +769,61 @@ def handover_results():
     if fmt != 'json' and not request.is_json:
         return render_template('list.html')
 
-    with ElasticsearchConnectionManager(es_host, es_port, es_user, es_password, es_ssl) as es:
-        res = es.client.search(index=es_index, body={
-            "size": 0,
-            "query": {
-                "bool": {
-                    "must": [
-                        {
-                            "query_string": {
-                                "fields": [
-                                    "report_type"
-                                ],
-                                "query": "(INFO|ERROR)",
-                                "analyze_wildcard": "true"
-                            }
-                        },
-                        {
-                            "query_string": {
-                                "fields": [
-                                    "params.database"
-                                ],
-                                "query": "/.*_{}(_[0-9]+)?/".format(release)
-                            }
-                        }
-                    ]
-                }
-            },
-            "aggs": {
-                "handover_token": {
-                    "terms": {
-                        "field": "params.handover_token.keyword",
-                        "size": 1000
-                    },
-                    "aggs": {
-                        "top_result": {
-                            "top_hits": {
-                                "size": 1,
-                                "sort": {
-                                    "report_time": "desc"
-                                }
-                            }
-                        },
-                        "submission_time": {"min": {"field": "report_time"}},
-                        "last_message": {"max": {"field": "report_time"}}
-                    }
-                }
-            },
-            "sort": [
-                {
-                    "report_time": {
-                        "order": "desc"
-                    }
-                }
-            ]
-        })
-
-    list_handovers = []
-    app.logger.info(f"Results {res}")
-    for each_handover_bucket in res['aggregations']['handover_token']['buckets']:
-        for doc in each_handover_bucket['top_result']['hits']['hits']:
-            result = {"id": doc['_id']}
-            if 'job_progress' in doc['_source']['params']:
-                result['job_progress'] = doc['_source']['params']['job_progress']
-
-            result['handover_token'] = doc['_source']['params']['handover_token']
-            result['message'] = doc['_source']['message']
-            result['comment'] = doc['_source']['params']['comment']
-            result['current_message'] = doc['_source']['message']
-            result['contact'] = doc['_source']['params']['contact']
-            result['src_uri'] = doc['_source']['params']['src_uri']
-            result['report_time'] = doc['_source']['report_time']
-            result['handover_submission_time'] = each_handover_bucket['submission_time']['value_as_string']
-            list_handovers.append(result)
-
-    return jsonify(list_handovers)
-
-
-def valid_handover(doc, release):
-    src_uri = doc['_source']['params']['src_uri']
-    match = re.match(r'^.*?_(?P<first>\d+)(_(?P<second>\d+))?(_(\d+))?$', src_uri)
-    if match:
-        first = match.group('first')
-        second = match.group('second')
-        return (first == release) or ((second == release) and (int(second) - int(first) == 53))
-    return False
+    def page():
+        try:
+            query = state_store.filter_query(release=release,
+                                             status=request.args.get('status'),
+                                             contact=request.args.get('contact'),
+                                             db_type=request.args.get('db_type'),
+                                             division=request.args.get('division'),
+                                             date_from=request.args.get('date_from'),
+                                             date_to=request.args.get('date_to'),
+                                             search=request.args.get('search'))
+            sort = request.args.get('sort', 'report_time')
+            order = request.args.get('order', 'desc')
+            if not any(param in request.args for param in LIST_PAGING_PARAMS):
+                # unpaged, the plain list of every handover of the release of the previous versions
+                return [list_row(state) for states in state_store.pages(query, size=cfg.jobs_max_page_size,
+                                                                        sort=sort, order=order)
+                        for state in states]
+            limit = min(int(request.args.get('limit', cfg.jobs_page_size)), cfg.jobs_max_page_size)
+            offset = int(request.args.get('offset', 0))
+            search_after = request.args.get('search_after')
+            search_after = json.loads(search_after) if search_after else None
+            total, states, cursor = state_store.page(query, sort=sort, order=order, limit=limit, offset=offset,
+                                                     search_after=search_after)
+        except ValueError as e:
+            raise HTTPRequestError('Invalid list parameters: %s' % str(e), 400)
+        return {'total': total, 'rows': [list_row(state) for state in states], 'search_after': cursor}
+
+    params = {**request.args.to_dict(), 'release': release}
+    return cached_response(response_cache.list_key(params), page)
+
+
+def list_row(state):
+    """Handover list entry of a state document"""
+    result = {"id": state['handover_token']}
+    if 'job_progress' in state:
+        result['job_progress'] = state['job_progress']
+
+    result['handover_token'] = state['handover_token']
+    result['message'] = state['message']
+    result['comment'] = state.get('comment', '')
+    result['current_message'] = state['message']
+    result['status'] = state.get('status', '')
+    result['contact'] = state.get('contact', '')
+    result['src_uri'] = state.get('src_uri', '')
+    result['report_time'] = state['report_time']
+    result['handover_submission_time'] = state['submission_time']
+    return result
+
+
+def cached_response(key, build):
+    """Json response from the response cache, answered with 304 when the client already has it"""
+    cached = response_cache.get_or_set(key, build)
+    response = app.response_class(cached['body'], mimetype='application/json')
+    response.set_etag(cached['etag'])
+    return response.make_conditional(request)
 
 
 @app.route('/jobs/<string:handover_token>', methods=['DELETE'])
@@ -607,12 +880,17 @@ def delete_handover(handover_token):
     """
     try:
         app.logger.info('Retrieving handover data with token %s', handover_token)
-        with ElasticsearchConnectionManager(es_host, es_port, es_user, es_password, es_ssl) as es:
+        # revoked while its state still tells the celery task, the revocation report written before the state
+        # is deleted so that it doesn't create it again
+        stop_handover_job(handover_token)
+        state_writer.flush()
+        with ElasticsearchConnection() as es:
             result = es.client.delete_by_query(index=es_index, doc_type='report', body={
                 "query": {"bool": {"must": [{"term": {"params.handover_token.keyword": str(handover_token)}}]}}
             })
             app.logger.info(str(result))
-        stop_handover_job(handover_token)
+        state_store.delete(handover_token)
+        response_cache.invalidate(handover_token)
         app.logger.info('Delete query success for %s', handover_token)
         return jsonify(str(handover_token))
     except NotFoundError as e:
@@ -766,6 +1044,13 @@ def restart_handover():
         return jsonify(error=str(e)), 400
 
 
+
+@app.cli.command('rebuild-state')
+def rebuild_handover_state():
+    """Fill the handover state index from the reports index"""
+    count = state_store.rebuild()
+    app.logger.info('Rebuilt the state of %s handovers', count)
+
 @app.errorhandler(TransportError)
 def handle_elastisearch_error(e):
     app.logger.error(str(e))
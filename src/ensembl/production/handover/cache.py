@@ -0,0 +1,168 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Short lived cache of the handover list and detail responses.
+# Responses are kept response_cache_ttl seconds, in the process by default or in redis with response_cache_url
+# (e.g. redis://cache:6379/0) to share them across gunicorn workers and let the celery workers invalidate them.
+# A report published for a handover drops its detail and every cached list.
+# '''
+
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from ensembl.production.handover.config import HandoverConfig as cfg
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache:
+    """In process backend, entries expire after their ttl and the oldest are evicted past max_entries"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + ttl if ttl else None, value)
+            if len(self._entries) > self.max_entries:
+                now = time.monotonic()
+                for k in [k for k, (expires, _) in self._entries.items() if expires is not None and expires < now]:
+                    del self._entries[k]
+                while len(self._entries) > self.max_entries:
+                    del self._entries[next(iter(self._entries))]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            expires, value = self._entries.get(key, (None, 0))
+            self._entries[key] = (expires, value + 1)
+            return value + 1
+
+
+class RedisCache:
+    """Redis backend, shared by all the processes using the same url. Needs the redis package."""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The redis package is required to use a redis response_cache_url")
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, json.dumps(value), px=int(ttl * 1000) if ttl else None)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+
+def create_backend(url):
+    if not url or url == 'local':
+        return LocalCache()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCache(url)
+    raise ValueError(f"Unsupported response cache url {url}")
+
+
+class ResponseCache:
+    """Serialized json responses with their ETag, keyed by handover token for the details and by request
+    parameters for the lists. Backend errors are logged and the responses computed again."""
+    generation_key = 'handover:lists:generation'
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    @staticmethod
+    def detail_key(handover_token):
+        return f"handover:detail:{handover_token}"
+
+    @staticmethod
+    def timeline_key(handover_token):
+        return f"handover:timeline:{handover_token}"
+
+    def list_key(self, params):
+        """Key of a list for the given request parameters, changed whenever a list is invalidated"""
+        try:
+            generation = self.backend.get(self.generation_key) or 0
+        except Exception as e:
+            logger.warning("Unable to read response cache: %s", e)
+            generation = 0
+        digest = hashlib.sha1(json.dumps(sorted(params.items())).encode()).hexdigest()
+        return f"handover:list:{generation}:{digest}"
+
+    @staticmethod
+    def etag(body):
+        return hashlib.sha1(body.encode()).hexdigest()
+
+    def get_or_set(self, key, build):
+        """Cached {'body', 'etag'} of a response, build returning the data to serialize when missing"""
+        if self.enabled:
+            try:
+                cached = self.backend.get(key)
+                if cached is not None:
+                    return cached
+            except Exception as e:
+                logger.warning("Unable to read response cache: %s", e)
+        body = json.dumps(build())
+        cached = {'body': body, 'etag': self.etag(body)}
+        if self.enabled:
+            try:
+                self.backend.set(key, cached, self.ttl)
+            except Exception as e:
+                logger.warning("Unable to write response cache: %s", e)
+        return cached
+
+    def invalidate(self, handover_token):
+        """Drop the cached detail and timeline of the handover and all the cached lists"""
+        if not self.enabled:
+            return
+        try:
+            self.backend.delete(self.detail_key(handover_token))
+            self.backend.delete(self.timeline_key(handover_token))
+            self.backend.incr(self.generation_key)
+        except Exception as e:
+            logger.warning("Unable to invalidate response cache for %s: %s", handover_token, e)
+
+
+response_cache = ResponseCache(create_backend(cfg.response_cache_url), cfg.response_cache_ttl)
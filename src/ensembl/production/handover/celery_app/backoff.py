@@ -0,0 +1,158 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Poll scheduling of the downstream jobs per pipeline stage.
+# backoff_policies are looked up by db_type and stage, then stage, then 'default', e.g.:
+#   backoff_policies:
+#     default: {initial: 60}
+#     metadata: {initial: 10, factor: 2, cap: 300}
+#     core:
+#       datacheck: {initial: 300, factor: 1.5, cap: 1800, jitter: 0.1}
+# Without any configuration every poll happens after retry_wait seconds.
+# With learned_backoff, the first poll of a stage is set from the average duration of that stage for the db_type.
+# '''
+
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from ensembl.production.handover.config import HandoverConfig as cfg, HandoverCeleryConfig
+from ensembl.production.handover.es import ElasticsearchConnection
+
+logger = logging.getLogger(__name__)
+
+
+class BackoffPolicy:
+    """Delay before the next poll: initial * factor ** attempt, capped, with +/- jitter ratio"""
+
+    def __init__(self, initial, factor=1.0, cap=None, jitter=0.0):
+        self.initial = float(initial)
+        self.factor = float(factor)
+        self.cap = float(cap) if cap is not None else None
+        self.jitter = float(jitter)
+
+    @classmethod
+    def from_config(cls, conf, default_wait):
+        return cls(initial=conf.get('initial', default_wait),
+                   factor=conf.get('factor', 1.0),
+                   cap=conf.get('cap', None),
+                   jitter=conf.get('jitter', 0.0))
+
+    def delay(self, attempt, first=None):
+        """Delay in seconds before poll number attempt (0 based). When set, first replaces the initial delay for
+        attempt 0 and the growth starts again from initial afterwards."""
+        if first is not None:
+            if attempt == 0:
+                return self._jitter(first)
+            attempt -= 1
+        delay = self.initial * self.factor ** attempt
+        if self.cap is not None:
+            delay = min(delay, self.cap)
+        return self._jitter(delay)
+
+    def _jitter(self, delay):
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(delay, 0)
+
+    def __repr__(self):
+        return f"BackoffPolicy(initial={self.initial}, factor={self.factor}, cap={self.cap}, jitter={self.jitter})"
+
+
+def backoff_policy(stage, db_type=None, policies=None, default_wait=None):
+    """Return the policy configured for the stage and db_type"""
+    policies = HandoverCeleryConfig.backoff_policies if policies is None else policies
+    default_wait = HandoverCeleryConfig.retry_wait if default_wait is None else default_wait
+    by_db_type = policies.get(db_type, {}) if db_type else {}
+    for conf in (by_db_type.get(stage), policies.get(stage), policies.get('default')):
+        if conf:
+            return BackoffPolicy.from_config(conf, default_wait)
+    return BackoffPolicy(default_wait)
+
+
+class StageDurationHistory:
+    """Running average of the stage durations per db_type, one document per db_type and stage in ES_STATS_INDEX.
+    Averages read are cached for cache_ttl seconds in the process, for the max_entries last read."""
+    doc_type = '_doc'
+    # weight of the last duration in the exponential moving average
+    alpha = 0.2
+
+    def __init__(self, index=None, cache_ttl=600, max_entries=256):
+        self.index = index or cfg.ES_STATS_INDEX
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def connect():
+        return ElasticsearchConnection()
+
+    @staticmethod
+    def key(db_type, stage):
+        return f"{db_type}-{stage}"
+
+    def record(self, db_type, stage, duration):
+        with self.connect() as es:
+            es.client.update(index=self.index, doc_type=self.doc_type, id=self.key(db_type, stage),
+                             retry_on_conflict=3, body={
+                    "script": {
+                        "source": "ctx._source.count += 1; "
+                                  "ctx._source.mean += (params.duration - ctx._source.mean) * params.alpha",
+                        "params": {"duration": duration, "alpha": self.alpha}
+                    },
+                    "upsert": {"db_type": db_type, "stage": stage, "count": 1, "mean": duration}
+                })
+
+    def mean(self, db_type, stage):
+        """Average duration in seconds, None when unknown"""
+        key = self.key(db_type, stage)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and cached[0] > time.time():
+                self._cache.move_to_end(key)
+                return cached[1]
+        mean = None
+        try:
+            with self.connect() as es:
+                if es.client.exists(index=self.index, doc_type=self.doc_type, id=key):
+                    mean = es.client.get(index=self.index, doc_type=self.doc_type, id=key)['_source']['mean']
+        except Exception as e:
+            logger.warning("Unable to retrieve %s duration history: %s", key, e)
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (time.time() + self.cache_ttl, mean)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return mean
+
+
+def learned_backoff():
+    """Whether the first poll of a stage is set from its average duration, the durations being recorded"""
+    return HandoverCeleryConfig.learned_backoff
+
+
+history = StageDurationHistory()
+
+
+def next_poll_delay(stage, spec, attempt):
+    """Delay in seconds before polling the job of the stage again, attempt being the number of polls done"""
+    db_type = spec.get('db_type')
+    policy = backoff_policy(stage, db_type)
+    first = None
+    if learned_backoff() and db_type and attempt == 0:
+        mean = history.mean(db_type, stage)
+        if mean:
+            first = max(policy.initial, mean * HandoverCeleryConfig.learned_backoff_ratio)
+    return policy.delay(attempt, first=first)
@@ -0,0 +1,86 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Classification of the database names accepted by the handover.
+# A name is matched once against a single precompiled pattern covering the species, compara and ancestral databases,
+# and the resulting record is memoized, so that validation, list filtering and batch submissions all share it.
+# '''
+
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+database_name_pattern = re.compile(
+    r'^(?:'
+    r'(?P<prefix>\w+)_(?P<type>core|rnaseq|cdna|otherfeatures|variation|funcgen)'
+    r'(?:_(?P<division_release>\d+))?_(?P<release>\d+)_(?P<assembly>\d+)'
+    r'|ensembl_compara(?:_(?P<compara_division>[a-z]+|pan)(?:_homology)?)?'
+    r'(?:_(?P<compara_division_release>\d+))?_(?P<compara_release>\d+)'
+    r'|ensembl_ancestral(?:_(?P<ancestral_division>[a-z]+))?'
+    r'(?:_(?P<ancestral_division_release>\d+))?_(?P<ancestral_release>\d+)'
+    r')$')
+# divisions of the collection databases, e.g. bacteria_0_collection
+collection_pattern = re.compile(r'^(?P<division>[a-z]+)_\w+_collection$')
+
+DatabaseName = namedtuple('DatabaseName', ['name', 'prefix', 'type', 'release', 'division_release', 'assembly',
+                                           'division'])
+DatabaseName.__doc__ = """Parsed database name.
+prefix is the species, collection or compara division, release the Ensembl release and division_release the
+non vertebrates release, when present. assembly is only set for species databases and division is a hint from the
+name alone, None when the name doesn't tell."""
+
+
+def _int(value):
+    return int(value) if value is not None else None
+
+
+@lru_cache(maxsize=8192)
+def classify(database):
+    """DatabaseName of the database, None when it cannot be handed over"""
+    m = database_name_pattern.match(database or '')
+    if not m:
+        return None
+    if m.group('type'):
+        prefix = m.group('prefix')
+        division_release = _int(m.group('division_release'))
+        collection = collection_pattern.match(prefix)
+        if collection:
+            division = collection.group('division')
+        else:
+            division = 'vertebrates' if division_release is None else None
+        return DatabaseName(database, prefix, m.group('type'), int(m.group('release')), division_release,
+                            m.group('assembly'), division)
+    db_type = 'compara' if m.group('compara_release') else 'ancestral'
+    division = m.group(f'{db_type}_division') or 'vertebrates'
+    return DatabaseName(database, division, db_type, int(m.group(f'{db_type}_release')),
+                        _int(m.group(f'{db_type}_division_release')), None, division)
+
+
+def parse(database):
+    """DatabaseName of the database, raising ValueError when it cannot be handed over"""
+    name = classify(database)
+    if name is None:
+        raise ValueError("Database type for %s is not expected. Please contact the Production team" % database)
+    return name
+
+
+def classify_all(databases):
+    """DatabaseName (or None) of each database, by name"""
+    return {database: classify(database) for database in databases}
+
+
+def releases(database):
+    """Releases a database belongs to: the Ensembl release, then the non vertebrates one when present"""
+    name = classify(database)
+    if name is None:
+        return []
+    return [name.release] if name.division_release is None else [name.release, name.division_release]
@@ -0,0 +1,318 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# MySQL lookups done while validating a handover submission.
+# Queries go through one pooled engine per MySQL server and process (see EngineRegistry), and the meta values needed
+# for a database are read in a single query.
+# The databases of each server are listed at most every database_listing_ttl seconds (see DatabaseListingCache) to
+# answer the existence checks and the submission form autocompletion from memory.
+# DatabaseLookups queries the servers on every call. CachedDatabaseLookups is created for each handover, or shared
+# by the handovers of a batch: each database is probed once.
+# '''
+
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+from sqlalchemy import bindparam, create_engine, text
+from sqlalchemy.engine.url import make_url
+
+from ensembl.production.handover import tracing
+from ensembl.production.handover.config import HandoverConfig as cfg
+
+# meta keys read at once for the release and division lookups
+META_KEYS = ('schema_version', 'species.division')
+database_name_pattern = re.compile(r'^[\w-]+$')
+
+
+def server_uri(uri):
+    """Uri of the MySQL server hosting the database"""
+    return make_url(uri)._replace(database=None).render_as_string(hide_password=False)
+
+
+def database_name(uri):
+    """Name of the database of the uri, checked before being quoted in a query"""
+    name = make_url(uri).database
+    if not name or not database_name_pattern.match(name):
+        raise ValueError(f"Invalid database name in {uri}")
+    return name
+
+
+class EngineRegistry:
+    """One pooled engine per MySQL server, recreated in forked processes.
+    Beyond max_engines servers, the engine of the least recently used one is disposed."""
+
+    def __init__(self, pool_size=5, pool_recycle=3600, max_engines=32):
+        self.pool_size = pool_size
+        self.pool_recycle = pool_recycle
+        self.max_engines = max_engines
+        self._lock = threading.Lock()
+        self._engines = OrderedDict()
+        self._pid = os.getpid()
+
+    def engine(self, uri):
+        server = server_uri(uri)
+        evicted = []
+        with self._lock:
+            if self._pid != os.getpid():
+                # connections opened by the parent process must not be shared
+                self._engines = OrderedDict()
+                self._pid = os.getpid()
+            engine = self._engines.get(server)
+            if engine is None:
+                engine = self._engines[server] = create_engine(server, pool_size=self.pool_size,
+                                                               pool_recycle=self.pool_recycle, pool_pre_ping=True)
+                while len(self._engines) > self.max_engines:
+                    evicted.append(self._engines.popitem(last=False)[1])
+            else:
+                self._engines.move_to_end(server)
+        for old in evicted:
+            old.dispose()
+        return engine
+
+    def dispose(self):
+        with self._lock:
+            engines, self._engines = self._engines, {}
+        for engine in engines.values():
+            engine.dispose()
+
+
+engines = EngineRegistry(pool_size=cfg.mysql_pool_size, pool_recycle=cfg.mysql_pool_recycle,
+                         max_engines=cfg.mysql_max_servers)
+
+
+def list_databases(uri, registry=None):
+    """Names of the databases on the server of the uri"""
+    with tracing.span('mysql SHOW DATABASES', server=server_uri(uri)), \
+            (registry or engines).engine(uri).connect() as connection:
+        return [row[0] for row in connection.execute(text('SHOW DATABASES'))]
+
+
+def trigrams(value):
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class DatabaseListing:
+    """Databases of a server at a given time, indexed by prefix and trigram for the autocompletion"""
+
+    def __init__(self, names, loaded=None):
+        self.names = frozenset(names)
+        self.loaded = time.monotonic() if loaded is None else loaded
+        self._sorted = sorted(self.names)
+        self._trigrams = {}
+        for name in self._sorted:
+            for trigram in trigrams(name):
+                self._trigrams.setdefault(trigram, []).append(name)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def age(self):
+        return time.monotonic() - self.loaded
+
+    def prefixed(self, prefix):
+        i = bisect_left(self._sorted, prefix)
+        while i < len(self._sorted) and self._sorted[i].startswith(prefix):
+            yield self._sorted[i]
+            i += 1
+
+    def search(self, term, limit=50):
+        """Names starting with the term first, then the other names containing it, in alphabetical order"""
+        term = term.strip()
+        matches = []
+        for name in self.prefixed(term):
+            if len(matches) == limit:
+                return matches
+            matches.append(name)
+        candidates = None
+        if len(term) >= 3:
+            # names having all the trigrams of the term, the rarest first to narrow down quickly
+            for trigram in sorted(trigrams(term), key=lambda t: len(self._trigrams.get(t, ()))):
+                names = self._trigrams.get(trigram, ())
+                candidates = set(names) if candidates is None else candidates.intersection(names)
+                if not candidates:
+                    break
+            candidates = sorted(candidates)
+        else:
+            candidates = self._sorted
+        prefixed = set(matches)
+        for name in candidates:
+            if len(matches) == limit:
+                break
+            if term in name and name not in prefixed:
+                matches.append(name)
+        return matches
+
+
+class DatabaseListingCache:
+    """Listing of the databases of each server, loaded again once older than ttl seconds.
+    Concurrent loads of the same server are coalesced into one SHOW DATABASES. Beyond max_servers servers, the
+    listing of the least recently used one is dropped."""
+
+    def __init__(self, ttl=300, registry=None, max_servers=32):
+        self.ttl = ttl
+        self.registry = registry
+        self.max_servers = max_servers
+        self._listings = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def listing(self, uri, refresh=False):
+        server = server_uri(uri)
+        with self._lock:
+            listing = self._listings.get(server)
+            if listing is not None and not refresh and listing.age() < self.ttl:
+                self._listings.move_to_end(server)
+                return listing
+            lock = self._loading.setdefault(server, threading.Lock())
+        with lock:
+            with self._lock:
+                current = self._listings.get(server)
+            if current is not None and current is not listing and current.age() < self.ttl:
+                # loaded by another thread meanwhile
+                return current
+            listing = DatabaseListing(list_databases(server, self.registry))
+            with self._lock:
+                self._listings.pop(server, None)
+                self._listings[server] = listing
+                while len(self._listings) > self.max_servers:
+                    evicted, _ = self._listings.popitem(last=False)
+                    self._loading.pop(evicted, None)
+            return listing
+
+    def database_exists(self, uri):
+        """Existence of the database of the uri, the listing being refreshed before reporting a missing database"""
+        name = make_url(uri).database
+        listing = self.listing(uri)
+        if name in listing:
+            return True
+        return name in self.listing(uri, refresh=True)
+
+    def search(self, uri, term, limit=50):
+        return self.listing(uri).search(term, limit)
+
+    def invalidate(self, uri):
+        """Forget the listing of the server, e.g. after dropping databases"""
+        with self._lock:
+            self._listings.pop(server_uri(uri), None)
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+
+
+database_listings = DatabaseListingCache(ttl=cfg.database_listing_ttl, max_servers=cfg.mysql_max_servers)
+
+
+class DatabaseLookups:
+    """Lookups straight from the MySQL servers"""
+
+    def __init__(self, registry=None, listings=None):
+        self.registry = registry or engines
+        self.listings = listings or database_listings
+
+    def query(self, uri, statement, **params):
+        with tracing.span('mysql query', server=server_uri(uri), statement=str(statement)), \
+                self.registry.engine(uri).connect() as connection:
+            return connection.execute(statement, params).fetchall()
+
+    def database_exists(self, uri):
+        return self.listings.database_exists(uri)
+
+    def meta(self, uri):
+        """First value of each of the META_KEYS found in the database"""
+        statement = text(f"SELECT meta_key, meta_value FROM `{database_name(uri)}`.meta "
+                         f"WHERE meta_key IN :keys ORDER BY meta_id").bindparams(bindparam('keys', expanding=True))
+        values = {}
+        for key, value in self.query(uri, statement, keys=list(META_KEYS)):
+            values.setdefault(key, value)
+        return values
+
+    def species_assembly(self, uri, species):
+        """Assembly of the species in a compara database, None when missing"""
+        rows = self.query(uri, text(f"SELECT assembly FROM `{database_name(uri)}`.genome_db "
+                                    f"WHERE name = :species ORDER BY genome_db_id LIMIT 1"), species=species)
+        return rows[0][0] if rows else None
+
+    def release(self, uri):
+        return int(self.meta(uri)['schema_version'])
+
+    def release_compara(self, uri):
+        return self.release(uri)
+
+    def division(self, src_uri, tgt_uri, db_type):
+        uri = src_uri
+        if db_type in ('variation', 'funcgen'):
+            # the division is read from the matching core database
+            uri = tgt_uri.replace("_variation_", "_core_").replace("_funcgen_", "_core_")
+        return str(self.meta(uri).get('species.division')).replace('Ensembl', '').lower()
+
+    def grch37(self, uri):
+        return self.species_assembly(uri, 'homo_sapiens') == 'GRCh37'
+
+    def close(self):
+        pass
+
+
+class CachedDatabaseLookups(DatabaseLookups):
+    """Lookups memoized for the lifetime of the object, safe to share between threads.
+    Concurrent calls for the same key wait for the first one instead of querying the server again."""
+
+    def __init__(self, registry=None, listings=None):
+        super().__init__(registry, listings)
+        self._lock = threading.Lock()
+        self._results = {}
+        self._pending = {}
+
+    def _memoize(self, key, func, *args):
+        with self._lock:
+            if key in self._results:
+                return self._results[key]
+            event = self._pending.get(key)
+            owner = event is None
+            if owner:
+                event = self._pending[key] = threading.Event()
+        if not owner:
+            event.wait()
+            with self._lock:
+                if key in self._results:
+                    return self._results[key]
+            # the first call failed, try again
+            return self._memoize(key, func, *args)
+        try:
+            result = func(*args)
+            with self._lock:
+                self._results[key] = result
+            return result
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+
+    def meta(self, uri):
+        return self._memoize(('meta', uri), super().meta, uri)
+
+    def species_assembly(self, uri, species):
+        return self._memoize(('assembly', uri, species), super().species_assembly, uri, species)
+
+    def close(self):
+        with self._lock:
+            self._results.clear()
+
+
+default_lookups = DatabaseLookups()
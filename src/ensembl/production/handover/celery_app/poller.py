@@ -0,0 +1,130 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Batched status poller for the downstream jobs of all in-flight handovers.
+# Each watcher tick hands over every outstanding job id at once, the poller queries each backend once:
+# a single job listing request for the backends configured in poll_bulk_stages, otherwise one request per job, with
+# at most poll_concurrency requests in flight. The requests share a keep-alive session and are recorded through the
+# instrumented client of the backend, like the calls made by the tasks.
+# '''
+
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ensembl.production.handover import tracing
+from ensembl.production.handover.config import HandoverCeleryConfig
+
+logger = logging.getLogger(__name__)
+
+
+class JobStatusPoller:
+    """Retrieve the jobs of several REST clients in one go, the clients being metrics.InstrumentedClient.
+    Results are returned as a dict {job_id: job}, or {job_id: exception} when a job couldn't be retrieved."""
+
+    def __init__(self, concurrency=8, bulk_stages=()):
+        self.concurrency = concurrency
+        self.bulk_stages = set(bulk_stages)
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            retries = Retry(total=3, backoff_factor=1,
+                            status_forcelist=[429, 500, 502, 503, 504],
+                            allowed_methods=["GET"])
+            adapter = HTTPAdapter(max_retries=retries, pool_connections=4, pool_maxsize=self.concurrency)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({'Accept': 'application/json'})
+            self._session = session
+        return self._session
+
+    def _get(self, uri):
+        r = self.session.get(uri, timeout=60)
+        r.raise_for_status()
+        return r.json()
+
+    def retrieve_one(self, client, job_id):
+        try:
+            return client.call('retrieve_job', self._get, client.jobs_id.format(client.uri, str(job_id)))
+        except Exception as e:
+            return e
+
+    def retrieve_bulk(self, client, job_ids):
+        """Retrieve the given jobs of the client from a single listing request, the jobs not listed being left out"""
+        # the services can't restrict their job listing to some job ids, every job they know of is listed and
+        # the requested ones are picked here, only worth it for the stages with many jobs in flight at once
+        listing = client.call('list_jobs', self._get, client.jobs.format(client.uri))
+        if isinstance(listing, dict):
+            listing = listing.get('results', [])
+        wanted = {str(job_id) for job_id in job_ids}
+        results = {}
+        for job in listing:
+            job_id = str(job.get('job_id', job.get('id')))
+            if job_id in wanted:
+                results[job_id] = job
+        return results
+
+    def retrieve(self, client, job_ids, bulk=False):
+        """Retrieve the given jobs from a single client"""
+        job_ids = list(dict.fromkeys(str(job_id) for job_id in job_ids))
+        results = {}
+        if bulk:
+            try:
+                results = self.retrieve_bulk(client, job_ids)
+            except Exception as e:
+                logger.warning("Unable to list jobs from %s, retrieving them one by one: %s", client.uri, e)
+        missing = [job_id for job_id in job_ids if job_id not in results]
+        if missing:
+            # the requests made from the pool belong to the trace of the caller
+            context = tracing.current_context()
+
+            def retrieve_one(job_id):
+                with tracing.use(context):
+                    return self.retrieve_one(client, job_id)
+
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(missing))) as executor:
+                for job_id, result in zip(missing, executor.map(retrieve_one, missing)):
+                    results[job_id] = result
+        return results
+
+    def poll(self, jobs, client_for):
+        """Retrieve the status of the outstanding jobs across all stages.
+
+        Args:
+            jobs (list): (stage, job_id) tuples
+            client_for (callable): return the REST client of a stage
+
+        Returns:
+            dict: {(stage, job_id): job or exception}
+        """
+        by_client = defaultdict(list)
+        for stage, job_id in jobs:
+            by_client[client_for(stage)].append((stage, str(job_id)))
+        results = {}
+        for client, client_jobs in by_client.items():
+            bulk = any(stage in self.bulk_stages for stage, _ in client_jobs)
+            retrieved = self.retrieve(client, [job_id for _, job_id in client_jobs], bulk=bulk)
+            for stage, job_id in client_jobs:
+                results[(stage, job_id)] = retrieved[job_id]
+            logger.debug("Retrieved %s jobs from %s", len(client_jobs), client.uri)
+        return results
+
+
+poller = JobStatusPoller(concurrency=int(HandoverCeleryConfig.poll_concurrency),
+                         bulk_stages=[stage for stage in HandoverCeleryConfig.poll_bulk_stages.split(',') if stage])
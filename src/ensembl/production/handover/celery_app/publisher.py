@@ -0,0 +1,240 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Asynchronous report publishing.
+# Reports are formatted when published and queued in memory, a background thread per process sends them
+# in batches over a long lived connection and channel, waiting for the broker confirms once per batch. Only the
+# messages rejected by the broker are published again.
+# Flask views and celery tasks never wait on the broker, when the queue is full reports are dropped.
+# '''
+
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+from kombu import Connection, Exchange, Producer
+
+from ensembl.production.handover import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PublishError(Exception):
+    pass
+
+
+class ReportPublisher:
+    """Publisher sending messages to an AMQP exchange from a bounded in-memory queue.
+    Same interface as ensembl.production.core.amqp_publishing.AMQPPublisher.publish"""
+
+    def __init__(self, uri, exchange_name, exchange_type='topic', formatter=None,
+                 max_queue=10000, batch_size=100, flush_interval=1.0, confirm_timeout=30):
+        self.uri = uri
+        self.exchange = Exchange(exchange_name, type=exchange_type)
+        self.formatter = formatter
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.confirm_timeout = confirm_timeout
+        self._stopped = threading.Event()
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # the queue, connection and thread belong to the parent process
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._connection = None
+        self._channel = None
+        self._producer = None
+        self._confirms = False
+        self._unconfirmed = set()
+        self._delivery_tag = 0
+        self._nacked = set()
+        self._metrics_lock = threading.Lock()
+        self._metrics = {'published': 0, 'dropped': 0, 'failed_batches': 0, 'reconnections': 0,
+                         'publish_latency_last': 0.0, 'publish_latency_total': 0.0}
+
+    def _count(self, name, value=1):
+        with self._metrics_lock:
+            self._metrics[name] += value
+
+    def stats(self):
+        """Queue depth and publishing metrics for this process, latencies in seconds from queueing to confirm"""
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        metrics['queue_depth'] = self._queue.qsize()
+        metrics['connected'] = self._connection is not None
+        metrics['publish_latency_avg'] = (metrics['publish_latency_total'] / metrics['published']
+                                          if metrics['published'] else 0.0)
+        return metrics
+
+    def publish(self, msg, routing_key):
+        """Queue a message for publication, never blocks"""
+        body = self.formatter.format(msg) if self.formatter is not None else msg
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((body, routing_key, time.monotonic()))
+        except queue.Full:
+            self._count('dropped')
+            metrics.amqp_dropped.inc()
+            logger.error("Report queue full (%s), dropping message: %s", self.max_queue, body)
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            self._reset()
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._stopped.clear()
+                    self._thread = threading.Thread(target=self._run, name='report-publisher', daemon=True)
+                    self._thread.start()
+
+    def close(self, timeout=30):
+        """Flush the queued messages and stop the publishing thread"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopped.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error("Report publisher not flushed after %ss, %s message(s) lost", timeout, self._queue.qsize())
+        self._disconnect()
+
+    def _next_batch(self):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            metrics.amqp_queue_depth.set(self._queue.qsize())
+            if batch:
+                self._send(batch)
+            elif self._stopped.is_set():
+                break
+
+    def _send(self, batch):
+        attempt = 0
+        while True:
+            try:
+                rejected = self._publish_batch(batch)
+                if not rejected:
+                    return
+                # the connection is fine, only the rejected messages are published again
+                error = PublishError(f"{len(rejected)} message(s) rejected by the broker")
+                batch = rejected
+            except Exception as e:
+                error = e
+                self._disconnect()
+            attempt += 1
+            self._count('failed_batches')
+            metrics.amqp_failed_batches.inc()
+            if self._stopped.is_set() and attempt >= 3:
+                self._count('dropped', len(batch))
+                metrics.amqp_dropped.inc(len(batch))
+                logger.error("Unable to publish %s report(s) on shutdown: %s", len(batch), error)
+                return
+            wait = min(2 ** attempt, 30)
+            logger.warning("Unable to publish %s report(s), retrying in %ss: %s", len(batch), wait, error)
+            time.sleep(wait)
+
+    def _publish_batch(self, batch):
+        """Publish the messages and wait for the broker confirms, returns the messages rejected by the broker"""
+        producer = self._connect()
+        sent = {}
+        for message in batch:
+            body, routing_key, _ = message
+            producer.publish(body, exchange=self.exchange, routing_key=routing_key, serializer='json',
+                             delivery_mode=2)
+            if self._confirms:
+                self._delivery_tag += 1
+                self._unconfirmed.add(self._delivery_tag)
+                sent[self._delivery_tag] = message
+        self._wait_for_confirms()
+        if self._confirms:
+            rejected = [message for tag, message in sent.items() if tag in self._nacked]
+            published = [message for tag, message in sent.items() if tag not in self._nacked]
+            self._nacked.difference_update(sent)
+        else:
+            rejected, published = [], batch
+        now = time.monotonic()
+        with self._metrics_lock:
+            for _, _, queued in published:
+                self._metrics['publish_latency_last'] = now - queued
+                self._metrics['publish_latency_total'] += now - queued
+                metrics.amqp_seconds.observe(now - queued)
+            self._metrics['published'] += len(published)
+        metrics.amqp_published.inc(len(published))
+        return rejected
+
+    def _connect(self):
+        if self._producer is None:
+            self._connection = Connection(self.uri)
+            self._connection.ensure_connection(max_retries=1)
+            self._channel = self._connection.channel()
+            self.exchange(self._channel).declare()
+            self._confirms = hasattr(self._channel, 'confirm_select') and hasattr(self._channel, 'events')
+            if self._confirms:
+                self._channel.events['basic_ack'].add(self._on_ack)
+                self._channel.events['basic_nack'].add(self._on_nack)
+                self._channel.confirm_select()
+            self._unconfirmed = set()
+            self._delivery_tag = 0
+            self._nacked = set()
+            self._producer = Producer(self._channel)
+            self._count('reconnections')
+            metrics.amqp_reconnections.inc()
+        return self._producer
+
+    def _on_ack(self, delivery_tag, multiple):
+        if multiple:
+            self._unconfirmed = {tag for tag in self._unconfirmed if tag > delivery_tag}
+        else:
+            self._unconfirmed.discard(delivery_tag)
+
+    def _on_nack(self, delivery_tag, multiple):
+        if multiple:
+            self._nacked.update(tag for tag in self._unconfirmed if tag <= delivery_tag)
+        else:
+            self._nacked.add(delivery_tag)
+        self._on_ack(delivery_tag, multiple)
+
+    def _wait_for_confirms(self):
+        deadline = time.monotonic() + self.confirm_timeout
+        while self._unconfirmed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PublishError(f"{len(self._unconfirmed)} message(s) not confirmed after {self.confirm_timeout}s")
+            try:
+                self._connection.drain_events(timeout=remaining)
+            except socket.timeout:
+                pass
+
+    def _disconnect(self):
+        connection, self._connection, self._channel, self._producer = self._connection, None, None, None
+        if connection is not None:
+            try:
+                connection.release()
+            except Exception as e:
+                logger.debug("Error while closing report publisher connection: %s", e)
@@ -0,0 +1,523 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Current state of the handovers.
+# Every INFO or ERROR report published for a handover is folded into a single document per handover token in
+# ES_STATE_INDEX, so that listing the handovers of a release or checking a database is a plain search on one
+# document per handover instead of an aggregation over all the reports.
+# The document also holds the timeline of the pipeline stages (start, end, duration, number of checks of the
+# downstream job and its id), from which the stage latencies of a release are aggregated.
+# Reports update the state from a background thread per process, the updates queued in the meantime being sent
+# in a single bulk request, so that publishing a report never waits on Elasticsearch. As the web app and each worker
+# update the state independently, an update is only applied when its report is not older than the current state.
+# Asynchronous submissions reserve their database in ES_RESERVATION_INDEX, one document per database name, so that
+# only one of several concurrent submissions of a database is accepted.
+# '''
+
+import datetime
+import logging
+import os
+import queue
+import re
+import threading
+
+from elasticsearch import ConflictError, NotFoundError
+from elasticsearch.helpers import bulk, scan
+
+from ensembl.production.handover.celery_app import dbnames
+from ensembl.production.handover.config import HandoverConfig as cfg
+from ensembl.production.handover.es import ElasticsearchConnection
+
+logger = logging.getLogger(__name__)
+
+# report types reflected in the handover state
+STATE_REPORT_TYPES = ('INFO', 'ERROR')
+# spec values copied into the handover state, enough to restart the handover
+STATE_PARAMS = ('handover_token', 'database', 'src_uri', 'tgt_uri', 'staging_uri', 'contact', 'comment', 'db_type',
+                'db_division', 'GRCh37', 'task_id', 'job_progress', 'progress_complete', 'progress_total', 'timeline')
+# pipeline stages, in running order
+STAGES = ('datacheck', 'dbcopy', 'metadata', 'dispatch')
+# percentiles of the stage durations of a release
+LATENCY_PERCENTILES = (50, 90, 99)
+# state update applied only when not older than the current state, report times sorting as strings
+STATE_UPDATE_SCRIPT = ("if (ctx._source.report_time != null && "
+                       "params.state.report_time.compareTo(ctx._source.report_time) < 0) { ctx.op = 'none' } "
+                       "else { ctx._source.putAll(params.state) }")
+
+success_pattern = re.compile(r'Handover.*successful$')
+failure_pattern = re.compile(r'failed|problems')
+# sortable columns of the handover list and the matching state fields
+SORT_FIELDS = {
+    'id': 'handover_token.keyword',
+    'handover_token': 'handover_token.keyword',
+    'report_time': 'report_time',
+    'handover_submission_time': 'submission_time',
+    'submission_time': 'submission_time',
+    'src_uri': 'src_uri.keyword',
+    'database': 'database.keyword',
+    'contact': 'contact.keyword',
+    'comment': 'comment.keyword',
+    'current_message': 'message.keyword',
+    'message': 'message.keyword',
+    'status': 'status.keyword',
+}
+# free text search fields
+SEARCH_FIELDS = ['handover_token', 'database', 'src_uri', 'contact', 'comment', 'message']
+
+
+def database_releases(database):
+    """Releases a database name belongs to: its Ensembl release, and the non vertebrates release when present,
+    e.g. [110] for homo_sapiens_core_110_38 or [110, 57] for arabidopsis_thaliana_core_57_110_11"""
+    return dbnames.releases(database)
+
+
+def handover_status(report_type, message):
+    """One of successful, failed or running"""
+    if success_pattern.search(message):
+        return 'successful'
+    if report_type == 'ERROR' or failure_pattern.search(message):
+        return 'failed'
+    return 'running'
+
+
+def report_time(now=None):
+    """Report time in the format of the reports index"""
+    return (now or datetime.datetime.now()).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+
+
+def stage_timeline(state, now=None):
+    """Stages of the handover in running order, each with its start, end, duration in seconds, number of checks of
+    the downstream job and job id. A stage without end lasts until now while the handover runs, and until the last
+    report once the handover is over."""
+    timeline = state.get('timeline') or {}
+    stages = []
+    for stage in STAGES:
+        times = timeline.get(stage)
+        if not times:
+            continue
+        start = datetime.datetime.fromisoformat(times['start'])
+        end = times.get('end')
+        running = end is None and state.get('status') == 'running'
+        if end is not None:
+            until = datetime.datetime.fromisoformat(end)
+        elif running:
+            until = now or datetime.datetime.now()
+        else:
+            until = datetime.datetime.fromisoformat(state['report_time'])
+        stages.append({
+            'stage': stage,
+            'start': times['start'],
+            'end': end,
+            'duration': times.get('duration', max((until - start).total_seconds(), 0)),
+            'polls': times.get('polls', 0),
+            'job_id': times.get('job_id'),
+            'running': running,
+        })
+    return stages
+
+
+class HandoverStateStore:
+    """Last known state of each handover, one document per handover token in ES_STATE_INDEX"""
+    doc_type = '_doc'
+
+    def __init__(self, index=None):
+        self.index = index or cfg.ES_STATE_INDEX
+
+    @staticmethod
+    def connect():
+        return ElasticsearchConnection()
+
+    @staticmethod
+    def from_report(report):
+        """State document for a report, None when the report doesn't change the handover state"""
+        params = report.get('params') or {}
+        if report.get('report_type') not in STATE_REPORT_TYPES or not params.get('handover_token'):
+            return None
+        state = {key: params[key] for key in STATE_PARAMS if key in params}
+        state['release'] = database_releases(params.get('database'))
+        state['report_type'] = report['report_type']
+        state['message'] = report.get('msg', report.get('message', ''))
+        state['status'] = handover_status(state['report_type'], state['message'])
+        state['report_time'] = report.get('report_time') or report_time()
+        return state
+
+    @staticmethod
+    def update_body(state, submission_time):
+        """Update of the handover state, ignored when older than the current state"""
+        return {
+            "script": {"source": STATE_UPDATE_SCRIPT, "lang": "painless", "params": {"state": state}},
+            "upsert": {**state, "submission_time": submission_time}
+        }
+
+    def upsert(self, state, refresh='false'):
+        """Update the handover state, the submission time being the time of its first report"""
+        with self.connect() as es:
+            es.client.update(index=self.index, doc_type=self.doc_type, id=state['handover_token'],
+                             retry_on_conflict=3, refresh=refresh,
+                             body=self.update_body(state, state['report_time']))
+
+    def bulk_upsert(self, states):
+        """Update the state of several handovers in one request, the updates of the same handover being merged in
+        report time order. Returns the number of handovers whose update failed."""
+        merged = {}
+        for state in states:
+            token = state['handover_token']
+            if token not in merged:
+                merged[token] = (state, state['report_time'])
+                continue
+            doc, submission_time = merged[token]
+            if state['report_time'] >= doc['report_time']:
+                doc = {**doc, **state}
+            else:
+                doc = {**state, **doc}
+            merged[token] = (doc, min(submission_time, state['report_time']))
+        body = []
+        for token, (doc, submission_time) in merged.items():
+            body.append({'update': {'_index': self.index, '_type': self.doc_type, '_id': token,
+                                    'retry_on_conflict': 3}})
+            body.append(self.update_body(doc, submission_time))
+        with self.connect() as es:
+            res = es.client.bulk(body=body)
+        errors = [item['update'] for item in res.get('items', []) if 'error' in item['update']]
+        for error in errors:
+            logger.warning("Unable to update handover %s state: %s", error.get('_id'), error['error'])
+        return len(errors)
+
+    def get(self, handover_token):
+        """State document of the handover, None when unknown"""
+        try:
+            with self.connect() as es:
+                return es.client.get(index=self.index, doc_type=self.doc_type, id=str(handover_token))['_source']
+        except NotFoundError:
+            return None
+
+    def get_celery_task_id(self, handover_token):
+        """Celery task id of the last report of the handover, and the spec to restart it with
+
+        Returns:
+            dict: status, error, and task_id and spec when the handover is known
+        """
+        try:
+            state = self.get(handover_token)
+        except Exception as e:
+            return {'status': False, 'error': str(e)}
+        if state is None:
+            return {'status': False, 'error': f"Handover {handover_token} not found"}
+        spec = {key: state[key] for key in STATE_PARAMS if key in state}
+        return {'status': True, 'error': '', 'task_id': state.get('task_id', ''), 'spec': spec}
+
+    def search(self, query, size=1000, sort=None):
+        """State documents matching the query, the most recently updated first"""
+        with self.connect() as es:
+            res = es.client.search(index=self.index, body={
+                "size": size,
+                "query": query,
+                "sort": sort or [{"report_time": {"order": "desc"}}]
+            }, ignore_unavailable=True)
+        return [hit['_source'] for hit in res['hits']['hits']]
+
+    @staticmethod
+    def filter_query(release=None, status=None, contact=None, db_type=None, division=None, date_from=None,
+                     date_to=None, search=None):
+        """Query on the state documents for the given filters, submission dates being inclusive"""
+        filters = []
+        if release:
+            filters.append({"term": {"release": int(release)}})
+        for field, value in (('status', status), ('contact', contact), ('db_type', db_type),
+                             ('db_division', division)):
+            if value:
+                filters.append({"term": {f"{field}.keyword": value}})
+        if date_from or date_to:
+            date_range = {}
+            if date_from:
+                date_range['gte'] = date_from
+            if date_to:
+                date_range['lte'] = date_to
+            filters.append({"range": {"submission_time": date_range}})
+        query = {"bool": {"filter": filters}}
+        if search:
+            query['bool']['must'] = [{"multi_match": {"query": search, "type": "phrase_prefix",
+                                                      "fields": SEARCH_FIELDS}}]
+        return query
+
+    def page(self, query, sort='report_time', order='desc', limit=100, offset=0, search_after=None):
+        """One page of state documents, either from offset or after the sort values of the last document of the
+        previous page.
+
+        Returns:
+            tuple: (total number of documents, documents, sort values to get the next page or None)
+        """
+        if sort not in SORT_FIELDS:
+            raise ValueError(f"Cannot sort on {sort}, expected one of {', '.join(SORT_FIELDS)}")
+        if order not in ('asc', 'desc'):
+            raise ValueError(f"Invalid sort order {order}")
+        body = {
+            "size": limit,
+            "query": query,
+            # handover_token as tie breaker to get a total order for search_after
+            "sort": [{SORT_FIELDS[sort]: {"order": order}}, {"handover_token.keyword": {"order": order}}]
+        }
+        if search_after:
+            body['search_after'] = search_after
+        else:
+            body['from'] = offset
+        with self.connect() as es:
+            res = es.client.search(index=self.index, body=body, ignore_unavailable=True)
+        hits = res['hits']['hits']
+        total = res['hits']['total']
+        if isinstance(total, dict):
+            total = total['value']
+        cursor = hits[-1]['sort'] if len(hits) == limit else None
+        return total, [hit['_source'] for hit in hits], cursor
+
+    def pages(self, query, size=500, sort='handover_token', order='asc'):
+        """Yield the state documents matching the query a page at a time, in handover token order by default, each
+        page being fetched with search_after from the last one, however many they are"""
+        cursor = None
+        while True:
+            total, states, cursor = self.page(query, sort=sort, order=order, limit=size, search_after=cursor)
+            if states:
+                yield states
+            if cursor is None:
+                return
+
+    def reports(self, handover_tokens, reports_index=None, size=1000):
+        """Yield every report of the given handovers from the reports index, sorted by handover token and report
+        time, scrolling through them"""
+        with self.connect() as es:
+            yield from scan(es.client, index=reports_index or cfg.ES_INDEX, size=size, preserve_order=True, query={
+                "query": {"terms": {"params.handover_token.keyword": list(handover_tokens)}},
+                "sort": [{"params.handover_token.keyword": {"order": "asc"}}, {"report_time": {"order": "asc"}}]
+            })
+
+    def stage_latencies(self, query):
+        """Number, mean, maximum and percentiles of the completed stage durations, and mean number of checks of
+        the downstream jobs, of the handovers matching the query, all aggregated by a single search"""
+        aggs = {}
+        for stage in STAGES:
+            duration = f"timeline.{stage}.duration"
+            aggs[stage] = {"filter": {"exists": {"field": duration}}, "aggs": {
+                "duration": {"stats": {"field": duration}},
+                "percentiles": {"percentiles": {"field": duration, "percents": list(LATENCY_PERCENTILES)}},
+                "polls": {"avg": {"field": f"timeline.{stage}.polls"}},
+            }}
+        with self.connect() as es:
+            res = es.client.search(index=self.index, body={"size": 0, "query": query, "aggs": aggs},
+                                   ignore_unavailable=True)
+        latencies = {}
+        for stage in STAGES:
+            agg = res.get('aggregations', {}).get(stage)
+            if not agg or not agg['doc_count']:
+                continue
+            percentiles = agg['percentiles']['values']
+            latencies[stage] = {
+                'count': agg['doc_count'],
+                'mean': agg['duration']['avg'],
+                'max': agg['duration']['max'],
+                **{f"p{p}": percentiles.get(f"{float(p)}") for p in LATENCY_PERCENTILES},
+                'mean_polls': agg['polls']['value'],
+            }
+        return latencies
+
+    def by_database(self, database, size=1000):
+        return self.search({"term": {"database.keyword": database}}, size=size)
+
+    def delete(self, handover_token):
+        try:
+            with self.connect() as es:
+                es.client.delete(index=self.index, doc_type=self.doc_type, id=str(handover_token))
+        except NotFoundError:
+            pass
+
+    def rebuild(self, reports_index=None):
+        """Recreate the state of every handover from the reports index, returns the number of handovers.
+        Only needed once to fill the index with the handovers submitted before it existed."""
+        states = {}
+        with self.connect() as es:
+            query = {"query": {"bool": {"must": [
+                {"terms": {"report_type.keyword": list(STATE_REPORT_TYPES)}},
+                {"exists": {"field": "params.handover_token"}}
+            ]}}}
+            for hit in scan(es.client, index=reports_index or cfg.ES_INDEX, query=query):
+                state = self.from_report(hit['_source'])
+                if state is None:
+                    continue
+                current = states.get(state['handover_token'])
+                if current is None:
+                    state['submission_time'] = state['report_time']
+                    states[state['handover_token']] = state
+                elif state['report_time'] >= current['report_time']:
+                    state['submission_time'] = min(current['submission_time'], state['report_time'])
+                    states[state['handover_token']] = state
+                else:
+                    current['submission_time'] = min(current['submission_time'], state['report_time'])
+            bulk(es.client, ({'_index': self.index, '_type': self.doc_type, '_id': handover_token, '_source': state}
+                             for handover_token, state in states.items()))
+        return len(states)
+
+
+class StateWriter:
+    """Handover state updates queued in memory and sent in bulk by a background thread, every flush_interval
+    seconds or batch_size updates. When the queue is full, or without background thread, updates are sent straight
+    away. on_write is called with the handover tokens of each batch once written."""
+
+    def __init__(self, store, max_queue=10000, batch_size=500, flush_interval=1.0, background=True, on_write=None):
+        self.store = store
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.background = background
+        self.on_write = on_write
+        self._stopped = threading.Event()
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # the queue and thread belong to the parent process
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def record(self, report):
+        """Queue the state update of a published report, failures are logged and never raised"""
+        state = self.store.from_report(report)
+        if state is None:
+            return
+        if self.background:
+            self._ensure_started()
+            try:
+                self._queue.put_nowait(state)
+                return
+            except queue.Full:
+                logger.warning("State queue full (%s), updating handover %s state now", self.max_queue,
+                               state['handover_token'])
+        self.write([state])
+
+    def write(self, states):
+        try:
+            self.store.bulk_upsert(states)
+        except Exception as e:
+            logger.warning("Unable to update the state of %s handover(s): %s", len(states), e)
+        if self.on_write is not None:
+            for token in {state['handover_token'] for state in states}:
+                self.on_write(token)
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            self._reset()
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._stopped.clear()
+                    self._thread = threading.Thread(target=self._run, name='state-writer', daemon=True)
+                    self._thread.start()
+
+    def _next_batch(self):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self.write(batch)
+                for _ in batch:
+                    self._queue.task_done()
+            elif self._stopped.is_set():
+                break
+
+    def flush(self, timeout=30):
+        """Wait for the queued updates to be written, returns False when still pending after timeout seconds"""
+        if self._thread is None or self._pid != os.getpid():
+            return True
+        with self._queue.all_tasks_done:
+            return self._queue.all_tasks_done.wait_for(lambda: not self._queue.unfinished_tasks, timeout)
+
+    def close(self, timeout=30):
+        """Write the queued updates and stop the background thread"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopped.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error("Handover states not written after %ss, %s update(s) lost", timeout, self._queue.qsize())
+
+
+class DatabaseReservations:
+    """Handover holding each database, one document per database name in ES_RESERVATION_INDEX. A reservation is
+    released once its handover is over, or after timeout seconds without any handover state."""
+    doc_type = '_doc'
+
+    def __init__(self, store, index=None, timeout=600):
+        self.store = store
+        self.index = index or cfg.ES_RESERVATION_INDEX
+        self.timeout = timeout
+
+    @staticmethod
+    def connect():
+        return ElasticsearchConnection()
+
+    def held(self, reservation):
+        state = self.store.get(reservation['handover_token'])
+        if state is None:
+            reserved_at = datetime.datetime.fromisoformat(reservation['reserved_at'])
+            return (datetime.datetime.now() - reserved_at).total_seconds() < self.timeout
+        return state.get('status') == 'running'
+
+    def reserve(self, database, handover_token):
+        """Reserve the database for the handover, atomically.
+
+        Returns:
+            str: None when reserved, else the token of the handover holding the database
+        """
+        doc = {'database': database, 'handover_token': handover_token, 'reserved_at': report_time()}
+        with self.connect() as es:
+            try:
+                es.client.index(index=self.index, doc_type=self.doc_type, id=database, body=doc, op_type='create')
+                return None
+            except ConflictError:
+                current = es.client.get(index=self.index, doc_type=self.doc_type, id=database)
+            if self.held(current['_source']):
+                return current['_source']['handover_token']
+            try:
+                # taken over only if nobody else did in the meantime
+                es.client.index(index=self.index, doc_type=self.doc_type, id=database, body=doc,
+                                if_seq_no=current['_seq_no'], if_primary_term=current['_primary_term'])
+                return None
+            except ConflictError:
+                return es.client.get(index=self.index, doc_type=self.doc_type, id=database)['_source'][
+                    'handover_token']
+
+    def release(self, database, handover_token):
+        """Release the database when still reserved by the handover"""
+        with self.connect() as es:
+            try:
+                current = es.client.get(index=self.index, doc_type=self.doc_type, id=database)
+                if current['_source']['handover_token'] != handover_token:
+                    return
+                es.client.delete(index=self.index, doc_type=self.doc_type, id=database,
+                                 if_seq_no=current['_seq_no'], if_primary_term=current['_primary_term'])
+            except (NotFoundError, ConflictError):
+                # released or taken over in the meantime
+                pass
+
+
+state_store = HandoverStateStore()
+reservations = DatabaseReservations(state_store, timeout=cfg.reservation_timeout)
@@ -30,8 +30,10 @@
 # @author: dstaines
 # '''
 
-import json
 import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from celery.result import AsyncResult
 
@@ -39,20 +41,24 @@ from celery import chain
 from ensembl.production.core.reporting import make_report
 # core
 from ensembl.production.core.utils import send_email
+from ensembl.production.handover import metrics, tracing
 from ensembl.production.handover.celery_app.app import app
+from ensembl.production.handover.celery_app.lookups import CachedDatabaseLookups
+from ensembl.production.handover.celery_app.state import state_store, reservations
 from ensembl.production.handover.celery_app.utils import db_copy_client, metadata_client, dc_client
 from ensembl.production.handover.celery_app.utils import process_handover_payload, log_and_publish, \
-    drop_current_databases, submit_dc, submit_copy, submit_metadata_update, check_handover_db_resubmit, \
-    get_celery_task_id
+    drop_target_database, submit_dc, submit_copy, submit_metadata_update, check_handover_db_resubmit, \
+    check_handover_spec, process_metadata_events, error_reported
+from ensembl.production.handover.celery_app.watcher import HandoverTask, RUNNING_STATUSES, registry, \
+    check_pending_jobs
 # handover
 from ensembl.production.handover.config import HandoverConfig as cfg
+from ensembl.production.handover.exceptions import MissingDispatchException
 
 retry_wait = app.conf.get('retry_wait', 60)
 
 release = int(cfg.RELEASE) if cfg.RELEASE else 0
 
-blat_species = cfg.BLAT_SPECIES
-
 logger = logging.getLogger(__name__)
 
 
@@ -71,26 +77,112 @@ def handover_database(spec):
     * progress_total - Total number of task to do
     * progress_complete - Total number of task completed
     """
+    handover_token = str(uuid.uuid1())
+    with tracing.trace(handover_token, 'handover submission', src_uri=spec.get('src_uri')):
+        (spec, dc_job_id, src_uri) = validate_handover(spec, handover_token=handover_token)
+        start_handover(spec, dc_job_id, src_uri)
+    return spec['handover_token']
+
+
+def submit_handover(spec):
+    """Accept a new handover. In the asynchronous submission_mode only cheap checks are done before returning the
+    handover token, the validation being the first stage of the handover (see validate_handover_task)"""
+    if cfg.submission_mode != 'async':
+        return handover_database(spec)
+    database = check_handover_spec(spec)['database']
+    spec['handover_token'] = str(uuid.uuid1())
+    try:
+        holder = reservations.reserve(database, spec['handover_token'])
+    except Exception as e:
+        # the resubmission check of the first stage still applies
+        logger.warning("Unable to reserve database %s: %s", database, e)
+        holder = None
+    if holder is not None:
+        raise ValueError(f"DB {database} already submitted with handover: {holder}")
+    with tracing.trace(spec['handover_token'], 'handover submission', src_uri=spec['src_uri']):
+        log_and_publish(make_report('INFO', 'Handover submitted, checking database', spec, spec['src_uri']))
+        validate_handover_task.delay(spec)
+    return spec['handover_token']
+
+
+@metrics.timed(metrics.submission_seconds, step='total')
+def validate_handover(spec, lookups=None, handover_token=None):
+    """Check the database can be handed over, and submit its datachecks.
+    Without lookups shared with other handovers, each database is probed once for this handover."""
+    lookups = lookups or CachedDatabaseLookups()
     # check handover with dbname already exist and its in progress
-    submit_status = check_handover_db_resubmit(spec)
+    with metrics.timed(metrics.submission_seconds, step='resubmit_check'), tracing.span('resubmit check'):
+        submit_status = check_handover_db_resubmit(spec)
     if not submit_status['status']:
         raise ValueError(submit_status['error'])
 
     # TODO verify dict
-    (spec, src_url, db_type) = process_handover_payload(spec)
-    (dc_job_id, spec, src_uri) = submit_dc(spec, src_url, db_type)
+    (spec, src_url, db_type) = process_handover_payload(spec, lookups, handover_token)
+    with metrics.timed(metrics.submission_seconds, step='submit_dc'), tracing.span('submit_dc'):
+        (dc_job_id, spec, src_uri) = submit_dc(spec, src_url, db_type, lookups)
     submitted_dc_msg = 'Submitted DB for data check as %s' % dc_job_id
 
     log_and_publish(make_report('DEBUG', submitted_dc_msg, spec, src_uri))
+    return spec, dc_job_id, src_uri
+
 
-    # production handover workflow
-    res = chain(
+def start_handover(spec, dc_job_id, src_uri, producer=None):
+    """Queue the production handover workflow"""
+    return chain(
         datacheck_task.s(spec, dc_job_id, src_uri),
         dbcopy_task.s(),
         metadata_update_task.s(),
         dispatch_db_task.s(),
-    )()
-    return spec['handover_token']
+    ).apply_async(producer=producer)
+
+
+def handover_databases(specs):
+    """Accept several databases at once.
+    The specs are validated concurrently, sharing the MySQL lookups, then all the workflows are queued over a single
+    broker connection. Returns a list with, for each spec in the same order, either
+    {'src_uri': src_uri, 'handover_token': token} or {'src_uri': src_uri, 'error': message}
+    """
+    lookups = CachedDatabaseLookups()
+    seen = set()
+    seen_lock = threading.Lock()
+
+    def validate(spec):
+        try:
+            # names that cannot be handed over are rejected before querying any server, the database name being
+            # added to the spec for the resubmission check
+            database = check_handover_spec(spec)['database']
+            with seen_lock:
+                if database in seen:
+                    raise ValueError(f"DB {database} submitted more than once in the batch")
+                seen.add(database)
+            handover_token = str(uuid.uuid1())
+            with tracing.trace(handover_token, 'handover submission', src_uri=spec['src_uri'], batch=True):
+                return validate_handover(spec, lookups, handover_token=handover_token)
+        except Exception as e:
+            return e
+
+    try:
+        with ThreadPoolExecutor(max_workers=cfg.batch_concurrency) as executor:
+            validated = list(executor.map(validate, specs))
+    finally:
+        lookups.close()
+
+    results = []
+    with app.producer_or_acquire() as producer:
+        for spec, outcome in zip(specs, validated):
+            if isinstance(outcome, Exception):
+                results.append({'src_uri': spec.get('src_uri'), 'error': str(outcome)})
+                continue
+            (spec, dc_job_id, src_uri) = outcome
+            try:
+                with tracing.trace(spec['handover_token'], 'handover start', batch=True):
+                    start_handover(spec, dc_job_id, src_uri, producer=producer)
+                results.append({'src_uri': src_uri, 'handover_token': spec['handover_token']})
+            except Exception as e:
+                log_and_publish(make_report('ERROR', 'Handover failed, cannot start the handover workflow', spec,
+                                            src_uri))
+                results.append({'src_uri': src_uri, 'error': str(e)})
+    return results
 
 
 def stop_handover_job(handover_token):
@@ -104,13 +196,15 @@ def stop_handover_job(handover_token):
     """
     spec = None
     try:
-        status = get_celery_task_id(handover_token)
+        status = state_store.get_celery_task_id(handover_token)
         if not status['status']:
             return status
             # get celery task id
         task_id = status['task_id']
         spec = status['spec']
         task = AsyncResult(task_id)
+        # a handover waiting in notify mode has no running task, forget its pending job
+        registry.discard(handover_token)
         if task.state not in ['FAILURE', 'REVOKED']:
             task.revoke(terminate=True)
             log_and_publish(make_report('INFO', f"Handover failed, Job Revoked", spec, ""))
@@ -163,16 +257,37 @@ def restart_handover_job(handover_token, task_name):
         return {'status': False, 'error': f"{str(e)}"}
 
 
-@app.task(bind=True, default_retry_delay=retry_wait)
+@app.task(bind=True)
+def validate_handover_task(self, spec):
+    """First stage of an asynchronous submission: validate the handover then start its workflow"""
+    try:
+        (spec, dc_job_id, src_uri) = validate_handover(spec, handover_token=spec['handover_token'])
+    except Exception as e:
+        # failures not already reported during the validation
+        if not error_reported(spec):
+            log_and_publish(make_report('ERROR', f"Handover failed, {e}", spec, spec['src_uri']))
+        # the database can be submitted again straight away
+        try:
+            reservations.release(spec['database'], spec['handover_token'])
+        except Exception as err:
+            logger.warning("Unable to release database %s: %s", spec['database'], err)
+        return
+    start_handover(spec, dc_job_id, src_uri)
+
+
+@app.task(bind=True, base=HandoverTask, default_retry_delay=retry_wait)
 def datacheck_task(self, spec, dc_job_id, src_uri):
     """Submit the source database for data check and wait until DCs pipeline finish"""
     self.max_retries = None
     src_uri = spec['src_uri']
     spec['task_id'] = self.request.id
+    if not self.request.retries:
+        self.stage_started('datacheck', spec)
     progress_msg = f"Datachecks in progress"
     log_and_publish(make_report('INFO', progress_msg, spec, src_uri))
     try:
         result = dc_client.retrieve_job(dc_job_id)
+        self.job_checked('datacheck', dc_job_id, spec)
         if result.get('progress', None):
             spec['job_progress'] = result['progress']
 
@@ -186,7 +301,7 @@ def datacheck_task(self, spec, dc_job_id, src_uri):
     if result['status'] in ['incomplete', 'running', 'submitted']:
         # log_and_publish(make_report('DEBUG', 'Datacheck Job incomplete, checking again later', spec, src_uri))
         log_and_publish(make_report('INFO', progress_msg, spec, src_uri))
-        self.retry()
+        self.wait_for_job('datacheck', dc_job_id, spec)
     elif result['status'] == 'failed':
         self.request.chain = None
         prob_msg = (f'Datachecks found problems, Handover failed, you can download the output here: <a target="_blank" '
@@ -204,13 +319,14 @@ def datacheck_task(self, spec, dc_job_id, src_uri):
     else:
         if spec.get('job_progress', None):
             del spec['job_progress']
+        self.stage_completed('datacheck', spec)
         log_and_publish(make_report('INFO', 'Datachecks successful, starting copy', spec, src_uri))
         spec['progress_complete'] = 1
 
     return spec
 
 
-@app.task(bind=True, default_retry_delay=retry_wait)
+@app.task(bind=True, base=HandoverTask, default_retry_delay=retry_wait)
 def dbcopy_task(self, spec):
     """Wait for copy to complete and then respond accordingly:
     * if Success, submit to metadata database
@@ -223,12 +339,14 @@ def dbcopy_task(self, spec):
 
         # submit copy job for first retry
         if not self.request.retries:
+            self.stage_started('dbcopy', spec)
             spec['copy_job_id'] = submit_copy(spec)
             copy_in_progress_msg = f"Copying in progress, please see: <a href='{cfg.copy_web_uri}{spec['copy_job_id']}' target='_parent'>{spec['copy_job_id']}</a>"
             log_and_publish(make_report('INFO', copy_in_progress_msg, spec, src_uri))
 
         # retrieve copy job status
         status = db_copy_client.retrieve_job(spec['copy_job_id'])['overall_status']
+        self.job_checked('dbcopy', spec['copy_job_id'], spec)
 
     except Exception as e:
         self.request.chain = None
@@ -238,7 +356,7 @@ def dbcopy_task(self, spec):
     if status in ['Scheduled', 'Running', 'Submitted']:
         dbg_msg = 'Submitted DB for copying'
         log_and_publish(make_report('DEBUG', dbg_msg, spec, spec['src_uri']))
-        self.retry()
+        self.wait_for_job('dbcopy', spec['copy_job_id'], spec)
 
     if status == 'Failed':
         self.request.chain = None
@@ -248,16 +366,18 @@ def dbcopy_task(self, spec):
         send_email(to_address=spec['contact'], subject='Database copy failed', body=msg, smtp_server=cfg.smtp_server)
     elif 'GRCh37' in spec:
         self.request.chain = None
+        self.stage_completed('dbcopy', spec)
         log_and_publish(make_report('INFO', 'Copying complete, Handover successful', spec, src_uri))
         spec['progress_complete'] = 3
     else:
+        self.stage_completed('dbcopy', spec)
         log_and_publish(make_report('INFO', 'Copying complete, submitting metadata job', spec, src_uri))
         spec['progress_complete'] = 2
 
     return spec
 
 
-@app.task(bind=True, default_retry_delay=retry_wait)
+@app.task(bind=True, base=HandoverTask, default_retry_delay=retry_wait)
 def metadata_update_task(self, spec):
     """Wait for metadata update to complete and then respond accordingly:
     * if success, submit event to event handler for further processing
@@ -269,12 +389,14 @@ def metadata_update_task(self, spec):
     try:
         # submit metadata update job for first retry
         if not self.request.retries:
+            self.stage_started('metadata', spec)
             spec['metadata_job_id'] = submit_metadata_update(spec)
             loading_msg = f"Loading into metadata database, please see: <a target='_blank' href='{cfg.meta_uri}jobs/{spec['metadata_job_id']}'>here</a>"
             log_and_publish(make_report('INFO', loading_msg, spec, tgt_uri))
 
         # retrieve metadata update job status
         result = metadata_client.retrieve_job(spec['metadata_job_id'])
+        self.job_checked('metadata', spec['metadata_job_id'], spec)
 
     except Exception as e:
         self.request.chain = None
@@ -285,14 +407,14 @@ def metadata_update_task(self, spec):
     if result['status'] in ['incomplete', 'running', 'submitted']:
         incomplete_msg = 'Metadata load Job incomplete, checking again later'
         log_and_publish(make_report('DEBUG', incomplete_msg, spec, tgt_uri))
-        self.retry()
+        self.wait_for_job('metadata', spec['metadata_job_id'], spec)
 
     if result['status'] == 'failed':
         self.request.chain = None
         drop_msg = 'Dropping %s' % tgt_uri
         log_and_publish(make_report('INFO', drop_msg, spec, tgt_uri))
 
-        db_drop_status = drop_current_databases([], spec, target_db_delete=True)
+        db_drop_status = drop_target_database(spec)
         db_drop_message = "Target db dropped successfully" if db_drop_status else "Failed to drop target db"
         log_and_publish(make_report('INFO', db_drop_message, spec, tgt_uri))
         failed_msg = f"Metadata load failed, please see <a href='{cfg.meta_uri}jobs/{spec['metadata_job_id']}?format=failures' target='_blank'>here</a>"
@@ -305,59 +427,76 @@ def metadata_update_task(self, spec):
                    subject=f"Metadata load failed, please see: <a href='{cfg.meta_uri}jobs/{spec['metadata_job_id']}?format=failures target='_blank'>here</a>",
                    body=msg, smtp_server=cfg.smtp_server)
     else:
-        # Cleaning up old assembly or old genebuild databases for Wormbase when database suffix has changed
-        if 'events' in result['output'] and result['output']['events']:
-            for event in result['output']['events']:
-                details = json.loads(event['details'])
-                if 'current_database_list' in details:
-                    drop_current_databases(details['current_database_list'], spec)
-                if event['genome'] in blat_species and event['type'] == 'new_assembly':
-                    msg = 'The following species %s has a new assembly, please update the port number for this ' \
-                          'species here and communicate to Web: https://github.com/Ensembl/ensembl-production/blob/' \
-                          'master/modules/Bio/EnsEMBL/Production/Pipeline/PipeConfig/DumpCore_conf.pm#L107' % \
-                          event['genome']
-                    send_email(to_address=cfg.production_email,
-                               subject='BLAT species list needs updating in FTP Dumps config',
-                               body=msg)
+        self.stage_completed('metadata', spec)
+        events = result['output'].get('events') or []
+        if events:
+            # old assembly or old genebuild databases (e.g. Wormbase) dropped by a task of its own, which then
+            # decides on the dispatch, so that this slot is released as soon as the metadata load is over
+            return self.replace(metadata_events_task.s(spec, events))
+        return metadata_loaded(self, spec, events)
+    return spec
 
-        spec['progress_complete'] = 3
-        log_and_publish(make_report('INFO', 'Metadata load complete, Handover successful', spec, tgt_uri))
-        # get dispatch target for db_type
-        db_type_dispatch_target = (cfg.dispatch_targets.get(spec['db_type'], "") != "") or cfg.dispatch_all
-        if (db_type_dispatch_target and len(result['output']['events']) > 0
-                and result['output']['events'][0].get('genome', None)):
-            # Loop over all genome and see if one is set for the division
-            need_dispatch = False or cfg.dispatch_all
-            genome_info = None
-            for genome_info in result['output']['events']:
-                need_dispatch = genome_info['genome'] in cfg.compara_species or cfg.dispatch_all
-                if need_dispatch:
-                    break
-            if need_dispatch and genome_info:
-                spec['genome'] = genome_info
-                # get dispatch target host, default to core one if not defined for DB type
-                spec['tgt_uri'] = cfg.dispatch_targets.get(spec['db_type'], cfg.dispatch_targets.get('core', None))
-                if spec['tgt_uri'] is not None:
-                    spec['progress_total'] = 4
-                    log_and_publish(make_report('INFO', f"Dispatching Database to target hosts: {spec['tgt_uri']}"))
-                else:
-                    spec['progress_total'] = 3
-                    log_and_publish(
-                        make_report('WARNING', 'Handover Can\'t find a proper target to dispatch to', spec, tgt_uri))
-            elif not genome_info:
-                log_and_publish(
-                    make_report('ERROR', 'Handover failed (Database dispatch failed, no related genome)', spec,
-                                tgt_uri))
+
+@app.task(bind=True, base=HandoverTask, default_retry_delay=retry_wait)
+def metadata_events_task(self, spec, events):
+    """Drop the databases replaced by the new one on the staging server and notify the new BLAT assemblies, then
+    decide on the dispatch"""
+    spec['task_id'] = self.request.id
+    outcome = process_metadata_events(spec, events)
+    if outcome['errors']:
+        errors = '; '.join(f"{item}: {error}" for item, error in outcome['errors'].items())
+        log_and_publish(make_report('WARNING', f"Metadata events not fully processed, {errors}", spec,
+                                    spec['tgt_uri']))
+    return metadata_loaded(self, spec, events)
+
+
+def metadata_loaded(task, spec, events):
+    """Report the successful metadata load and decide on the dispatch of the database, ending the chain of the task
+    when there is nothing to dispatch"""
+    tgt_uri = spec['tgt_uri']
+    spec['progress_complete'] = 3
+    log_and_publish(make_report('INFO', 'Metadata load complete, Handover successful', spec, tgt_uri))
+    # get dispatch target for db_type
+    db_type_dispatch_target = (cfg.dispatch_targets.get(spec['db_type'], "") != "") or cfg.dispatch_all
+    if db_type_dispatch_target and len(events) > 0 and events[0].get('genome', None):
+        if not cfg.dispatch_all and not cfg.compara_species.available():
+            # never taken as an empty list, which would skip the dispatch of every genome
+            task.request.chain = None
+            err_msg = 'Handover failed, compara species unavailable, cannot decide on the database dispatch'
+            log_and_publish(make_report('ERROR', err_msg, spec, tgt_uri))
+            raise MissingDispatchException(err_msg)
+        # Loop over all genome and see if one is set for the division
+        need_dispatch = False or cfg.dispatch_all
+        genome_info = None
+        for genome_info in events:
+            need_dispatch = genome_info['genome'] in cfg.compara_species or cfg.dispatch_all
+            if need_dispatch:
+                break
+        if need_dispatch and genome_info:
+            spec['genome'] = genome_info
+            # get dispatch target host, default to core one if not defined for DB type
+            spec['tgt_uri'] = cfg.dispatch_targets.get(spec['db_type'], cfg.dispatch_targets.get('core', None))
+            if spec['tgt_uri'] is not None:
+                spec['progress_total'] = 4
+                log_and_publish(make_report('INFO', f"Dispatching Database to target hosts: {spec['tgt_uri']}"))
             else:
-                log_and_publish(make_report('INFO', 'Metadata load complete, Handover successful', spec, tgt_uri))
-                self.request.chain = None
+                spec['progress_total'] = 3
+                log_and_publish(
+                    make_report('WARNING', 'Handover Can\'t find a proper target to dispatch to', spec, tgt_uri))
+        elif not genome_info:
+            log_and_publish(
+                make_report('ERROR', 'Handover failed (Database dispatch failed, no related genome)', spec,
+                            tgt_uri))
         else:
             log_and_publish(make_report('INFO', 'Metadata load complete, Handover successful', spec, tgt_uri))
-            self.request.chain = None
+            task.request.chain = None
+    else:
+        log_and_publish(make_report('INFO', 'Metadata load complete, Handover successful', spec, tgt_uri))
+        task.request.chain = None
     return spec
 
 
-@app.task(bind=True, default_retry_delay=retry_wait)
+@app.task(bind=True, base=HandoverTask, default_retry_delay=retry_wait)
 def dispatch_db_task(self, spec):
     """
     Process dispatched dbs after metadata updates.
@@ -371,12 +510,14 @@ def dispatch_db_task(self, spec):
     try:
         # submit dispatch job for first retry
         if not self.request.retries:
+            self.stage_started('dispatch', spec)
             spec['dispatch_job_id'] = submit_copy(spec)
             copy_in_progress_msg = f"Dispatching in progress, please see: <a href='{cfg.copy_web_uri}{spec['dispatch_job_id']}' target='_parent'>{spec['dispatch_job_id']}</a>"
             log_and_publish(make_report('INFO', copy_in_progress_msg, spec, src_uri))
 
         # retrieve dispatch job status
         status = db_copy_client.retrieve_job(spec['dispatch_job_id'])['overall_status']
+        self.job_checked('dispatch', spec['dispatch_job_id'], spec)
 
     except Exception as e:
         self.request.chain = None
@@ -388,7 +529,7 @@ def dispatch_db_task(self, spec):
     if status in ['Scheduled', 'Running', 'Submitted']:
         incomplete_msg = 'Database dispatch in progress, please see: %s%s' % (cfg.copy_web_uri, spec['dispatch_job_id'])
         log_and_publish(make_report('DEBUG', incomplete_msg, spec, src_uri))
-        self.retry()
+        self.wait_for_job('dispatch', spec['dispatch_job_id'], spec)
 
     if status == 'Failed':
         self.request.chain = None
@@ -399,11 +540,28 @@ def dispatch_db_task(self, spec):
                    smtp_server=cfg.smtp_server)
     else:
         spec['progress_complete'] = 4
+        self.stage_completed('dispatch', spec)
         log_and_publish(make_report('INFO', 'Database dispatch complete, Handover successful', spec, src_uri))
 
     return spec
 
 
+def notify_job_completion(stage, job_id):
+    """Ask the watcher to check a downstream job reported as complete by its service"""
+    if stage not in RUNNING_STATUSES:
+        raise ValueError(f"Unknown handover stage {stage}, expected one of {', '.join(RUNNING_STATUSES)}")
+    watch_handover_jobs.delay(stage, job_id)
+
+
+@app.task(bind=True)
+def watch_handover_jobs(self, stage=None, job_id=None):
+    """Resume the handovers waiting in notify mode whose downstream job is over"""
+    resumed = check_pending_jobs(self.app, stage, job_id)
+    if resumed:
+        logger.info("Resumed %s handover(s)", resumed)
+    return resumed
+
+
 @app.task(bind=True, default_retry_delay=retry_wait)
 def event(self, spec):
     print('coming soon.....')
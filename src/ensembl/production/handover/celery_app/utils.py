@@ -10,25 +10,38 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import atexit
 import json
 import logging
+import os
 import re
+import time
 import uuid
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 # es clients
+from celery.exceptions import WorkerShutdown
+from celery.signals import worker_init, worker_process_shutdown, worker_ready, before_task_publish, task_prerun, \
+    task_postrun
+from sqlalchemy import text
 from sqlalchemy.engine.url import make_url
-from sqlalchemy_utils.functions import database_exists, drop_database
-from ensembl.production.core.es import ElasticsearchConnectionManager
 from ensembl.production.core.amqp_publishing import AMQPPublisher
 from ensembl.production.core.clients.datachecks import DatacheckClient
 # clients
 from ensembl.production.core.clients.dbcopy import DbCopyRestClient
 from ensembl.production.core.clients.event import EventClient
 from ensembl.production.core.clients.metadata import MetadataClient
-from ensembl.production.core.models.compara import check_grch37, get_release_compara
-from ensembl.production.core.models.core import get_division, get_release
 from ensembl.production.core.reporting import make_report, ReportFormatter
+from ensembl.production.core.utils import send_email
+from ensembl.production.handover import metrics, tracing
+from ensembl.production.handover.cache import response_cache
+from ensembl.production.handover.celery_app import dbnames
+from ensembl.production.handover.celery_app.lookups import database_listings, database_name, default_lookups, \
+    engines
+from ensembl.production.handover.celery_app.publisher import ReportPublisher
+from ensembl.production.handover.celery_app.state import state_store, StateWriter
 from ensembl.production.handover.config import HandoverConfig as cfg
+from ensembl.production.handover.lazy import Lazy
 from sqlalchemy.exc import MovedIn20Warning
 
 # TODO remove the day we move to SQLAlchemy > 2.0
@@ -37,30 +50,96 @@ warnings.filterwarnings("ignore", category=MovedIn20Warning)
 logger = logging.getLogger(__name__)
 release = int(cfg.RELEASE) if cfg.RELEASE else 0
 handover_formatter = ReportFormatter('handover')
-publisher = AMQPPublisher(cfg.report_server,
-                          cfg.report_exchange,
-                          exchange_type=cfg.report_exchange_type,
-                          formatter=handover_formatter)
-species_pattern = re.compile(
-    r'^(?P<prefix>\w+)_(?P<type>core|rnaseq|cdna|otherfeatures|variation|funcgen)(_\d+)?_(\d+)_(?P<assembly>\d+)$')
-compara_pattern = re.compile(r'^ensembl_compara(_(?P<division>[a-z]+|pan)(_homology)?)?(_(\d+))?(_\d+)$')
-ancestral_pattern = re.compile(r'^ensembl_ancestral(_(?P<division>[a-z]+))?(_(\d+))?(_\d+)$')
+
+
+def create_publisher():
+    if not cfg.report_async:
+        return AMQPPublisher(cfg.report_server,
+                             cfg.report_exchange,
+                             exchange_type=cfg.report_exchange_type,
+                             formatter=handover_formatter)
+    report_publisher = ReportPublisher(cfg.report_server,
+                                       cfg.report_exchange,
+                                       exchange_type=cfg.report_exchange_type,
+                                       formatter=handover_formatter,
+                                       max_queue=cfg.report_queue_size,
+                                       batch_size=cfg.report_batch_size)
+    # flush the queued reports when the web or celery worker process exits
+    atexit.register(report_publisher.close)
+    return report_publisher
+
+
+def close_publisher(**kwargs):
+    if cfg.report_async and publisher.created:
+        publisher.close()
+
+
+def create_state_writer():
+    writer = StateWriter(state_store, max_queue=cfg.state_queue_size, batch_size=cfg.state_batch_size,
+                         background=cfg.state_async, on_write=response_cache.invalidate)
+    # write the queued handover states when the web or celery worker process exits
+    atexit.register(writer.close)
+    return writer
+
+
+def close_state_writer(**kwargs):
+    if state_writer.created:
+        state_writer.close()
+
+
+def warm_compara_species(**kwargs):
+    # loaded before the pool processes are forked, the dispatch decisions need the full lists
+    if not cfg.compara_species.warm() and not cfg.dispatch_all:
+        raise WorkerShutdown(f"Compara species of release {cfg.compara_species.version} unavailable, "
+                             f"unable to decide on the databases dispatch")
+
+
+def start_metrics_server(**kwargs):
+    if cfg.worker_metrics_port:
+        metrics.start_server(cfg.worker_metrics_port)
+
+
+def release_process_metrics(pid=None, **kwargs):
+    metrics.mark_process_dead(pid or os.getpid())
+
+
+def propagate_trace(headers=None, **kwargs):
+    """Send the trace context of the handover along with the task message"""
+    context = tracing.current_context()
+    if context is not None and headers is not None:
+        headers.setdefault(tracing.HEADER, context)
+
+
+def start_task_span(task_id=None, task=None, **kwargs):
+    tracing.task_spans.start(task_id, f"task {task.name.rsplit('.', 1)[-1]}",
+                             getattr(task.request, tracing.HEADER, None), celery_task_id=task_id,
+                             retries=task.request.retries)
+
+
+def end_task_span(task_id=None, state=None, retval=None, **kwargs):
+    tracing.task_spans.end(task_id, state, retval if state == 'FAILURE' else None)
+
+
+publisher = Lazy('publisher', create_publisher)
+state_writer = Lazy('state writer', create_state_writer)
+worker_init.connect(warm_compara_species, weak=False)
+worker_process_shutdown.connect(close_publisher, weak=False)
+worker_process_shutdown.connect(close_state_writer, weak=False)
+worker_process_shutdown.connect(release_process_metrics, weak=False)
+worker_ready.connect(start_metrics_server, weak=False)
+before_task_publish.connect(propagate_trace, weak=False)
+task_prerun.connect(start_task_span, weak=False)
+task_postrun.connect(end_task_span, weak=False)
+# spec key holding the last report published for the handover
+REPORT_STATE_KEY = 'last_report'
 db_types_list = [i for i in cfg.allowed_database_types.split(",")]
 allowed_divisions_list = [i for i in cfg.allowed_divisions.split(",")]
 
 # app clients
-dc_client = DatacheckClient(cfg.dc_client_uri)
-db_copy_client = DbCopyRestClient(cfg.copy_client_uri)
-metadata_client = MetadataClient(cfg.meta_client_uri)
-event_client = EventClient(cfg.event_client_uri)
-
-# es Details
-es_host = cfg.ES_HOST
-es_port = str(cfg.ES_PORT)
-es_index = cfg.ES_INDEX
-es_user = cfg.ES_USER
-es_password = cfg.ES_PASSWORD
-es_ssl = cfg.ES_SSL
+dc_client = Lazy('dc_client', lambda: metrics.InstrumentedClient('datacheck', DatacheckClient(cfg.dc_client_uri)))
+db_copy_client = Lazy('db_copy_client', lambda: metrics.InstrumentedClient('dbcopy', DbCopyRestClient(cfg.copy_client_uri)))
+metadata_client = Lazy('metadata_client', lambda: metrics.InstrumentedClient('metadata', MetadataClient(cfg.meta_client_uri)))
+event_client = Lazy('event_client', lambda: metrics.InstrumentedClient('event', EventClient(cfg.event_client_uri)))
 
 
 def qualified_name(db_uri):
@@ -76,6 +155,14 @@ def qualified_name(db_uri):
             return f"{db_url.drivername}://{db_url.username}@{host}:{db_url.port}/{db_url.database}"
 
 
+def submitted_after(handover_token, other_token):
+    """Whether the handover was submitted after the other one, from the time of their uuid1 tokens"""
+    try:
+        return uuid.UUID(handover_token).time > uuid.UUID(other_token).time
+    except (TypeError, ValueError, AttributeError):
+        return False
+
+
 def check_handover_db_resubmit(spec: dict):
     """[Restrict Multiple handover submission with same Database name]
 
@@ -89,161 +176,91 @@ def check_handover_db_resubmit(spec: dict):
         [bool]: [Status boolean]
     """
     try:
-        with ElasticsearchConnectionManager(es_host, int(es_port), es_user, es_password, es_ssl) as es:
-            res_error = es.client.search(index=es_index, body={
-                "size": 0,
-                "query": {
-                    "bool": {
-                        "must": [
-                            {
-                                "term": {
-                                    "params.database.keyword": spec['database']
-                                }
-                            },
-                            {
-                                "query_string": {
-                                    "fields": [
-                                        "report_type"
-                                    ],
-                                    "query": "(INFO|ERROR)",
-                                    "analyze_wildcard": "true"
-                                }
-                            },
-                        ]
-                    }
-                },
-                "aggs": {
-                    "handover_token": {
-                        "terms": {
-                            "field": "params.handover_token.keyword",
-                            "size": 1000
-                        },
-                        "aggs": {
-                            "top_result": {
-                                "top_hits": {
-                                    "size": 1,
-                                    "sort": {
-                                        "report_time": "desc"
-                                    }
-                                }
-                            }
-                        }
-                    }
-                },
-                "sort": [
-                    {
-                        "report_time": {
-                            "order": "desc"
-                        }
-                    }
-                ]
-            })
-
         failed_msg_pattern = re.compile(r'.*(failed|Failed|found problems|complete|successful).*', re.IGNORECASE)
-        for each_handover_bucket in res_error['aggregations']['handover_token']['buckets']:
-            for doc in each_handover_bucket['top_result']['hits']['hits']:
-                msg = doc['_source']['message']
-                if not failed_msg_pattern.match(msg):
-                    # found  handover with status running for submitted DB
-                    raise ValueError(
-                        f"DB {doc['_source']['params']['database']} already submitted with handover: {doc['_source']['params']['handover_token']} and status: {msg} "
-                    )
+        for state in state_store.by_database(spec['database']):
+            msg = state['message']
+            # later submissions of the database give way to this one, failing their own check
+            if submitted_after(state['handover_token'], spec.get('handover_token')):
+                continue
+            if state['handover_token'] != spec.get('handover_token') and not failed_msg_pattern.match(msg):
+                # found  handover with status running for submitted DB
+                raise ValueError(
+                    f"DB {state['database']} already submitted with handover: {state['handover_token']} and status: {msg} "
+                )
     except Exception as e:
         return {'status': False, 'error': str(e)}
 
     return {'status': True, 'error': ''}
 
 
-def get_celery_task_id(handover_token: str):
-    """[Get celery task id for given handover id]
+def report_fingerprint(report):
+    params = report['params']
+    return [report['report_type'], report['msg'], params.get('job_progress'), params.get('progress_complete')]
 
-    Args:
-        hadover_id (str): [Handover Id]
-
-    Raises:
-        ValueError: [Handover Status in progress ]
 
-    Returns:
-        [task_id]: [str]
-    """
-    try:
-        task_id = ''
-        with ElasticsearchConnectionManager(es_host, int(es_port), es_user, es_password, es_ssl) as es:
-            res = es.client.search(index=es_index, body={
-                "size": 0,
-                "query": {
-                    "bool": {
-                        "must": [
-                            {"term": {"params.handover_token.keyword": str(handover_token)}},
-                            {
-                                "query_string": {
-                                    "fields": ["report_type"], "query": "(INFO|ERROR)",
-                                    "analyze_wildcard": "true"
-                                }
-                            },
-                        ]
-                    }
-                },
-                "aggs": {
-                    "top_result": {
-                        "top_hits": {
-                            "size": 1,
-                            "sort": {
-                                "report_time": "desc"
-                            }
-                        }
-                    }
-                },
-                "sort": [
-                    {
-                        "report_time": {
-                            "order": "desc"
-                        }
-                    }
-                ]
-            })
-
-        for doc in res['aggregations']['top_result']['hits']['hits']:
-            task_id = doc['_source']['params']['task_id']
+def is_duplicate_report(report, now=None):
+    """Check the report against the last one published for the handover, kept in the spec so that it follows
+    the handover across task retries and workers. Errors are never considered duplicates."""
+    params = report.get('params') or {}
+    last = params.get(REPORT_STATE_KEY)
+    if not last or report['report_type'] in ('ERROR', 'CRITICAL'):
+        return False
+    if last['fingerprint'] != report_fingerprint(report):
+        return False
+    now = time.time() if now is None else now
+    return not cfg.report_heartbeat or now - last['time'] < cfg.report_heartbeat * 60
 
-    except Exception as e:
-        return {'status': False, 'error': str(e)}
 
-    return {'status': True, 'error': '', 'task_id': task_id, 'spec': doc['_source']['params']}
+def error_reported(spec):
+    """Whether an error was already reported for the handover"""
+    return bool((spec.get(REPORT_STATE_KEY) or {}).get('error'))
 
 
 def log_and_publish(report):
     """Handy function to mimick the logger/publisher behaviour.
+    Reports identical to the last one published for a handover (same type, message, job_progress and
+    progress_complete) are skipped, unless report_heartbeat minutes elapsed since.
     """
     level = report['report_type']
+    if is_duplicate_report(report):
+        logger.debug("Skipping unchanged report: %s", report['msg'])
+        return
     routing_key = 'report.%s' % level.lower()
     logger.log(getattr(logging, level), report['msg'])
-    publisher.publish(report, routing_key)
+    params = report.get('params')
+    if params and 'handover_token' in params:
+        published = {**report, 'params': {k: v for k, v in params.items() if k != REPORT_STATE_KEY}}
+        with metrics.timed(metrics.report_seconds), tracing.span('amqp publish', routing_key=routing_key):
+            publisher.publish(published, routing_key)
+        # the handover state and its cached responses are updated in the background
+        state_writer.record(published)
+        params[REPORT_STATE_KEY] = {'fingerprint': report_fingerprint(report), 'time': time.time(),
+                                    'error': level in ('ERROR', 'CRITICAL') or error_reported(params)}
+    else:
+        with metrics.timed(metrics.report_seconds):
+            publisher.publish(report, routing_key)
 
 
 def parse_db_infos(database):
     """Parse database name and extract db_prefix and db_type. Also extract release and assembly for species databases"""
-    if species_pattern.match(database):
-        m = species_pattern.match(database)
-        db_prefix = m.group('prefix')
-        db_type = m.group('type')
-        assembly = m.group('assembly')
-        return db_prefix, db_type, assembly
-    elif compara_pattern.match(database):
-        m = compara_pattern.match(database)
-        division = m.group('division')
-        db_prefix = division if division else 'vertebrates'
-        return db_prefix, 'compara', None
-    elif ancestral_pattern.match(database):
-        m = ancestral_pattern.match(database)
-        division = m.group('division')
-        db_prefix = division if division else 'vertebrates'
-        return db_prefix, 'ancestral', None
-    else:
-        raise ValueError("Database type for %s is not expected. Please contact the Production team" % database)
+    name = dbnames.parse(database)
+    return name.prefix, name.type, name.assembly
+
+
+def check_handover_spec(spec):
+    """Syntactic checks of a handover submission, without connecting to any server"""
+    src_url = make_url(spec['src_uri'])
+    if not src_url.database:
+        raise ValueError("No database in %s" % spec['src_uri'])
+    db_prefix, db_type, assembly = parse_db_infos(src_url.database)
+    if db_type not in db_types_list:
+        raise ValueError("Handover failed, %s has been handed over after deadline. Please contact the Production team"
+                         % spec['src_uri'])
+    spec.setdefault('database', src_url.database)
+    return spec
 
 
-def check_staging_server(spec, db_type, db_prefix, assembly):
+def check_staging_server(spec, db_type, db_prefix, assembly, lookups=default_lookups):
     """Find which staging server should be used. secondary_staging for GRCh37 and Bacteria, staging for the rest"""
     qualified_uri = qualified_name(spec['src_uri'])
     if 'bacteria' in db_prefix:
@@ -254,7 +271,7 @@ def check_staging_server(spec, db_type, db_prefix, assembly):
         live_uri = cfg.secondary_live_uri
         spec['GRCh37'] = 1
         spec['progress_total'] = 2
-    elif db_type == 'compara' and check_grch37(qualified_uri, 'homo_sapiens'):
+    elif db_type == 'compara' and lookups.grch37(qualified_uri):
         staging_uri = cfg.secondary_staging_uri
         live_uri = cfg.secondary_live_uri
         spec['GRCh37'] = 1
@@ -270,51 +287,127 @@ def get_tgt_uri(src_url, staging_uri):
     return '%s%s' % (staging_uri, src_url.database)
 
 
-def drop_current_databases(current_db_list, spec, target_db_delete=None):
-    """[Drop databases on a previous assembly or previous genebuild (e.g: Wormbase) from the staging MySQL server]
+def drop_target_database(spec):
+    """Drop the database copied to the staging server, returns whether it was dropped"""
+    # only needed on the celery workers, kept out of the web app startup
+    from sqlalchemy_utils.functions import drop_database
 
-    Args:
-        current_db_list ([List]): [List of databases names to be dropped]
-        spec ([Dict]): [Handover payload with details ]
-        target_db_delete ([Boolean], optional): [Flag to delete given list of databases]. Defaults to None.
+    try:
+        drop_database(spec['tgt_uri'])
+        return True
+    except Exception as e:
+        logger.error("Unable to drop %s: %s", spec['tgt_uri'], e)
+        return False
 
-    Returns:
-        [Boolean]: [status of dropdatabase method]
-    """
 
+def drop_databases(server_uri, databases):
+    """Drop the databases existing on the MySQL server, over a single connection. Nothing is published, so that it
+    can run in any thread.
+    Returns the databases dropped and the errors of the others, by database. When the server cannot be reached or
+    the connection is lost, the databases left are reported with the error."""
+    dropped, errors = [], {}
+    left = list(databases)
     try:
+        with tracing.span('mysql DROP DATABASE', server=server_uri, databases=databases):
+            existing = database_listings.listing(server_uri, refresh=True)
+            with engines.engine(server_uri).connect() as connection:
+                connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+                while left:
+                    database = left[0]
+                    if database in existing:
+                        try:
+                            connection.execute(text(f"DROP DATABASE `{database_name(server_uri + database)}`"))
+                            dropped.append(database)
+                        except Exception as e:
+                            if getattr(e, 'connection_invalidated', False):
+                                # the connection is lost, the databases left are reported below
+                                raise
+                            errors[database] = str(e)
+                    left.pop(0)
+    except Exception as e:
+        errors.update({database: str(e) for database in left})
+    finally:
+        database_listings.invalidate(server_uri)
+    return dropped, errors
 
-        if target_db_delete:
-            drop_database(spec['tgt_uri'])
-            return True
 
-        tgt_uri = spec['tgt_uri']
-        staging_uri = spec['staging_uri']
-        tgt_url = make_url(tgt_uri)
+def process_metadata_events(spec, events):
+    """Stage following a successful metadata load: drop the databases replaced by the new ones on the staging server,
+    in up to drop_concurrency batches run in parallel, and send a single email for all the BLAT species with a new
+    assembly. Events and databases that cannot be processed are reported one by one without stopping the others.
+
+    Returns:
+        dict: databases dropped, errors by event genome or database, BLAT species notified
+    """
+    tgt_uri = spec['tgt_uri']
+    tgt_database = make_url(tgt_uri).database
+    to_drop, new_assemblies, errors = [], [], {}
+    for event in events:
+        try:
+            details = json.loads(event['details'])
+        except (KeyError, TypeError, ValueError) as e:
+            errors[event.get('genome')] = str(e)
+            log_and_publish(make_report('WARNING', 'Unable to read the details of the %s event for %s: %s' % (
+                event.get('type'), event.get('genome'), e), spec, tgt_uri))
+            continue
+        current_db_list = details.get('current_database_list') or []
         # Check if the new database has the same name as the one on staging. In this case DO NOT drop it
         # This can happen if the assembly get renamed or genebuild version has changed for Wormbase
-        if tgt_url.database in current_db_list:
-            msg = 'The assembly or genebuild has been updated but the new database %s is the same as old one' % tgt_url.database
+        if tgt_database in current_db_list:
+            msg = 'The assembly or genebuild has been updated but the new database %s is the same as old one' % tgt_database
             log_and_publish(make_report('DEBUG', msg, spec, tgt_uri))
         else:
-            for database in current_db_list:
-                db_uri = staging_uri + database
-                if database_exists(db_uri):
-                    msg = 'Dropping database %s' % database
-                    log_and_publish(make_report('INFO', msg, spec, tgt_uri))
-                    drop_database(db_uri)
-    except Exception as e:
-        return False
-
-
-def process_handover_payload(spec):
-    """ """
+            to_drop.extend(database for database in current_db_list if database not in to_drop)
+        if event.get('genome') in cfg.BLAT_SPECIES and event.get('type') == 'new_assembly':
+            new_assemblies.append(event['genome'])
+
+    dropped = []
+    batches = [to_drop[i::cfg.drop_concurrency] for i in range(min(cfg.drop_concurrency, len(to_drop)))]
+    with ThreadPoolExecutor(max_workers=len(batches) + 1) as executor:
+        futures = [executor.submit(drop_databases, spec['staging_uri'], batch) for batch in batches]
+        notification = executor.submit(notify_new_assemblies, new_assemblies) if new_assemblies else None
+        # reports are published from this thread only, the spec holding the last report of the handover
+        for batch, future in zip(batches, futures):
+            try:
+                batch_dropped, batch_errors = future.result()
+            except Exception as e:
+                batch_dropped, batch_errors = [], {database: str(e) for database in batch}
+            for database in batch_dropped:
+                log_and_publish(make_report('INFO', 'Dropped database %s' % database, spec, tgt_uri))
+            for database, error in batch_errors.items():
+                log_and_publish(make_report('WARNING', 'Unable to drop database %s: %s' % (database, error), spec,
+                                            tgt_uri))
+            dropped.extend(batch_dropped)
+            errors.update(batch_errors)
+        if notification is not None:
+            try:
+                notification.result()
+            except Exception as e:
+                errors['blat_notification'] = str(e)
+                logger.error("Unable to send the BLAT species notification for %s: %s", new_assemblies, e)
+    return {'dropped': dropped, 'errors': errors, 'blat_species': new_assemblies}
+
+
+def notify_new_assemblies(genomes):
+    msg = 'The following species %s have a new assembly, please update the port number for these species here and ' \
+          'communicate to Web: https://github.com/Ensembl/ensembl-production/blob/master/modules/Bio/EnsEMBL/' \
+          'Production/Pipeline/PipeConfig/DumpCore_conf.pm#L107' % ', '.join(genomes)
+    send_email(to_address=cfg.production_email,
+               subject='BLAT species list needs updating in FTP Dumps config',
+               body=msg, smtp_server=cfg.smtp_server)
+
+
+def process_handover_payload(spec, lookups=default_lookups, handover_token=None):
+    """Check the database can be handed over and complete the spec, lookups being shared by the handovers of
+    a batch. handover_token is the token already given to the submitter of an asynchronous submission."""
     src_uri = spec['src_uri']
     # create unique identifier
-    spec['handover_token'] = str(uuid.uuid1())
+    spec['handover_token'] = handover_token or str(uuid.uuid1())
     spec['progress_total'] = 3
     qualified_uri = qualified_name(src_uri)
-    if not database_exists(qualified_uri):
+    with metrics.timed(metrics.submission_seconds, step='database_exists'):
+        exists = lookups.database_exists(qualified_uri)
+    if not exists:
         msg = "Handover failed, %s does not exist" % src_uri
         log_and_publish(make_report('ERROR', msg, spec, src_uri))
         raise ValueError("%s does not exist" % src_uri)
@@ -330,16 +423,17 @@ def process_handover_payload(spec):
         raise ValueError(msg)
     # Check if the database release match the handover service
     if db_type == 'compara':
-        if check_grch37(qualified_uri, 'homo_sapiens') and cfg.HANDOVER_TYPE != 'grch37':
-            raise ValueError("Please use the dedicated handover for Grch37 databases. Contact Production team")
-        db_release = get_release_compara(qualified_uri)
+        with metrics.timed(metrics.submission_seconds, step='release'):
+            if lookups.grch37(qualified_uri) and cfg.HANDOVER_TYPE != 'grch37':
+                raise ValueError("Please use the dedicated handover for Grch37 databases. Contact Production team")
+            db_release = lookups.release_compara(qualified_uri)
     else:
-        db_release = get_release(qualified_uri)
+        with metrics.timed(metrics.submission_seconds, step='release'):
+            db_release = lookups.release(qualified_uri)
         logger.info("Db_release %s %s", db_type, db_release)
         if db_prefix == 'homo_sapiens' and assembly == '37' and cfg.HANDOVER_TYPE != 'grch37':
             raise ValueError("Please use the dedicated handover for Grch37 databases. Contact Production team")
-        elif (db_type in cfg.dispatch_targets.keys() and any(
-                db_prefix in val for val in cfg.compara_species)) or cfg.dispatch_all:
+        elif (db_type in cfg.dispatch_targets and cfg.compara_species.matches(db_prefix)) or cfg.dispatch_all:
             logger.info("Adding dispatch step to total")
             spec['progress_total'] = 4
     if release != db_release:
@@ -349,14 +443,16 @@ def process_handover_payload(spec):
         log_and_publish(make_report('ERROR', msg, spec, src_uri))
         raise ValueError(msg)
     # Check to which staging server the database need to be copied to
-    spec, staging_uri, live_uri = check_staging_server(spec, db_type, db_prefix, assembly)
+    with metrics.timed(metrics.submission_seconds, step='staging_server'):
+        spec, staging_uri, live_uri = check_staging_server(spec, db_type, db_prefix, assembly, lookups)
     if 'tgt_uri' not in spec:
         spec['tgt_uri'] = get_tgt_uri(src_url, staging_uri)
     # Check that the database division match the target staging server
     if db_type in ['compara', 'ancestral']:
         db_division = db_prefix
     else:
-        db_division = get_division(qualified_uri, qualified_name(spec['tgt_uri']), db_type)
+        with metrics.timed(metrics.submission_seconds, step='division'):
+            db_division = lookups.division(qualified_uri, qualified_name(spec['tgt_uri']), db_type)
 
     if db_division not in allowed_divisions_list:
         raise ValueError(
@@ -367,12 +463,13 @@ def process_handover_payload(spec):
     spec['db_type'] = db_type
     msg = "Handling %s" % spec
     logger.info("Handover Specs %s", spec)
-    log_and_publish(make_report('INFO', msg, spec, src_uri))
+    with metrics.timed(metrics.submission_seconds, step='report'):
+        log_and_publish(make_report('INFO', msg, spec, src_uri))
     return spec, src_url, db_type
 
 
 # submit handover jobs to respective
-def submit_dc(spec, src_url, db_type):
+def submit_dc(spec, src_url, db_type, lookups=default_lookups):
     """Submit the source database for checking. Returns a celery job identifier"""
     try:
         src_uri = spec['src_uri']
@@ -392,7 +489,7 @@ def submit_dc(spec, src_url, db_type):
             dc_job_id = dc_client.submit_job(server_url, src_url.database, None, None,
                                              'core', None, 'ancestral', 'critical', None, handover_token, staging_uri)
         elif db_type in ['rnaseq', 'cdna', 'otherfeatures']:
-            division_msg = 'division: %s' % get_division(qualified_uri, qualified_name(tgt_uri), db_type)
+            division_msg = 'division: %s' % lookups.division(qualified_uri, qualified_name(tgt_uri), db_type)
             log_and_publish(make_report('DEBUG', division_msg, spec, src_uri))
             log_and_publish(submitting_dc_report)
             dc_group = 'corelike,rapid_release' if cfg.HANDOVER_TYPE == 'rapid' else 'corelike'
@@ -401,7 +498,7 @@ def submit_dc(spec, src_url, db_type):
         else:
             db_msg = 'src_uri: %s dbtype %s server_url %s' % (src_uri, db_type, server_url)
             log_and_publish(make_report('DEBUG', db_msg, spec, src_uri))
-            division_msg = 'division: %s' % get_division(qualified_uri, qualified_name(tgt_uri), db_type)
+            division_msg = 'division: %s' % lookups.division(qualified_uri, qualified_name(tgt_uri), db_type)
             log_and_publish(make_report('DEBUG', division_msg, spec, src_uri))
             log_and_publish(submitting_dc_report)
             dc_group = db_type + ',rapid_release' if cfg.HANDOVER_TYPE == 'rapid' else db_type
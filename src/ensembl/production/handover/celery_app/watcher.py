@@ -0,0 +1,246 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Completion notification for the handover pipeline.
+# With completion_mode set to 'notify', a task waiting for a datacheck, copy, metadata or dispatch job
+# registers the job in the pending index and releases its worker slot instead of retrying.
+# The watch_handover_jobs task (scheduled by celery beat every watch_interval seconds, or triggered by
+# PUT /jobs/notify) checks all pending jobs in one batch and resumes the handover chain once the job is over.
+# '''
+
+import datetime
+import json
+import logging
+import time
+
+from celery import Task
+from celery.exceptions import Ignore
+from elasticsearch import NotFoundError
+from elasticsearch.helpers import scan
+
+from ensembl.production.core.reporting import make_report
+from ensembl.production.handover import metrics, tracing
+from ensembl.production.handover.celery_app.backoff import next_poll_delay, history, learned_backoff
+from ensembl.production.handover.celery_app.poller import poller
+from ensembl.production.handover.celery_app.utils import dc_client, db_copy_client, metadata_client, log_and_publish
+from ensembl.production.handover.config import HandoverConfig as cfg
+from ensembl.production.handover.es import ElasticsearchConnection
+
+logger = logging.getLogger(__name__)
+
+# downstream job statuses meaning the job is still running, per pipeline stage
+RUNNING_STATUSES = {
+    'datacheck': ('incomplete', 'running', 'submitted'),
+    'dbcopy': ('Scheduled', 'Running', 'Submitted'),
+    'metadata': ('incomplete', 'running', 'submitted'),
+    'dispatch': ('Scheduled', 'Running', 'Submitted'),
+}
+
+
+def stage_client(stage):
+    """Return the REST client holding the jobs of the given pipeline stage"""
+    return {
+        'datacheck': dc_client,
+        'dbcopy': db_copy_client,
+        'metadata': metadata_client,
+        'dispatch': db_copy_client,
+    }[stage]
+
+
+def job_status(stage, result):
+    """Extract the status from a job retrieved from the stage client"""
+    if stage in ('dbcopy', 'dispatch'):
+        return result.get('overall_status')
+    return result.get('status')
+
+
+def is_running(stage, result):
+    return job_status(stage, result) in RUNNING_STATUSES[stage]
+
+
+def record_check(stage, job_id, spec):
+    """Count a status check of the downstream job in the stage timeline of the handover"""
+    timeline = spec.get('timeline', {}).get(stage)
+    if timeline is not None:
+        timeline['job_id'] = str(job_id)
+        timeline['polls'] = timeline.get('polls', 0) + 1
+
+
+class PendingJobRegistry:
+    """Downstream jobs handovers are waiting for, stored as one document per job in ES_PENDING_INDEX.
+    The task arguments and the remaining chain are kept as a json payload to resume the handover."""
+    doc_type = '_doc'
+
+    def __init__(self, index=None):
+        self.index = index or cfg.ES_PENDING_INDEX
+
+    @staticmethod
+    def job_key(stage, job_id):
+        return f"{stage}-{job_id}"
+
+    @staticmethod
+    def connect():
+        return ElasticsearchConnection()
+
+    def register(self, stage, job_id, spec, payload, next_check):
+        doc = {
+            'stage': stage,
+            'job_id': str(job_id),
+            'handover_token': spec.get('handover_token', ''),
+            'registered_at': datetime.datetime.now().isoformat(),
+            'next_check': next_check,
+            'payload': json.dumps(payload)
+        }
+        with self.connect() as es:
+            es.client.index(index=self.index, doc_type=self.doc_type, id=self.job_key(stage, job_id), body=doc,
+                            refresh='wait_for')
+
+    def pending(self, stage=None, job_id=None, due=False):
+        """Yield the pending documents, optionally restricted to a stage and job id or to the jobs due for a check"""
+        must = []
+        if due:
+            must.append({"range": {"next_check": {"lte": time.time()}}})
+        if stage:
+            must.append({"term": {"stage.keyword": stage}})
+        if job_id is not None:
+            must.append({"term": {"job_id.keyword": str(job_id)}})
+        with self.connect() as es:
+            if not es.client.indices.exists(index=self.index):
+                return
+            for hit in scan(es.client, index=self.index, query={"query": {"bool": {"must": must}}}):
+                doc = hit['_source']
+                doc['payload'] = json.loads(doc['payload'])
+                yield doc
+
+    def update(self, stage, job_id, payload, next_check):
+        with self.connect() as es:
+            es.client.update(index=self.index, doc_type=self.doc_type, id=self.job_key(stage, job_id),
+                             body={"doc": {'payload': json.dumps(payload), 'next_check': next_check}})
+
+    def claim(self, stage, job_id):
+        """Remove the job from the registry, only the caller getting True is allowed to resume the handover"""
+        try:
+            with self.connect() as es:
+                es.client.delete(index=self.index, doc_type=self.doc_type, id=self.job_key(stage, job_id))
+        except NotFoundError:
+            return False
+        return True
+
+    def discard(self, handover_token):
+        """Forget any job pending for the given handover"""
+        with self.connect() as es:
+            if es.client.indices.exists(index=self.index):
+                es.client.delete_by_query(index=self.index, doc_type=self.doc_type, body={
+                    "query": {"term": {"handover_token.keyword": str(handover_token)}}
+                })
+
+
+registry = PendingJobRegistry()
+
+
+class HandoverTask(Task):
+    """Base class for the pipeline tasks waiting for a downstream job"""
+
+    def stage_started(self, stage, spec):
+        spec.setdefault('timeline', {})[stage] = {'start': datetime.datetime.now().isoformat(), 'polls': 0}
+
+    def job_checked(self, stage, job_id, spec):
+        record_check(stage, job_id, spec)
+
+    def stage_completed(self, stage, spec):
+        """Record the end of the stage, and its duration for the metrics and the learned backoff"""
+        timeline = spec.get('timeline', {}).get(stage)
+        if not timeline:
+            return
+        end = datetime.datetime.now()
+        timeline['end'] = end.isoformat()
+        duration = (end - datetime.datetime.fromisoformat(timeline['start'])).total_seconds()
+        timeline['duration'] = duration
+        metrics.stage_seconds.labels(stage, spec.get('db_type', '')).observe(duration)
+        if learned_backoff() and spec.get('db_type'):
+            try:
+                history.record(spec['db_type'], stage, duration)
+            except Exception as e:
+                logger.warning("Unable to record %s duration for %s: %s", stage, spec['db_type'], e)
+
+    def wait_for_job(self, stage, job_id, spec):
+        """Wait for the downstream job of this stage to complete, always raises.
+
+        The next poll is scheduled according to the backoff policy of the stage for the db_type.
+        In notify mode the job is registered with the watcher and the task ends, releasing the worker slot,
+        the watcher resumes the chain once the job is over. Otherwise, or whenever the registration fails,
+        the task is retried.
+        """
+        delay = next_poll_delay(stage, spec, self.request.retries)
+        metrics.stage_retries.labels(stage).inc()
+        if self.app.conf.get('completion_mode', 'poll') == 'notify':
+            payload = {
+                'task': self.name,
+                'args': list(self.request.args),
+                'chain': self.request.chain,
+                'retries': self.request.retries + 1,
+                'trace': tracing.current_context()
+            }
+            try:
+                registry.register(stage, job_id, spec, payload, time.time() + delay)
+            except Exception as e:
+                logger.warning("Unable to register %s job %s with the watcher, polling instead: %s", stage, job_id, e)
+            else:
+                self.request.chain = None
+                raise Ignore()
+        raise self.retry(countdown=delay)
+
+
+def resume_handover(app, payload):
+    """Run the waiting task again with its remaining chain, in the trace of its handover"""
+    with tracing.use(payload.get('trace')):
+        app.send_task(payload['task'], args=payload['args'], chain=payload['chain'], retries=payload['retries'])
+
+
+def check_pending_jobs(app, stage=None, job_id=None):
+    """Retrieve every pending job due for a check, each backend being queried once, and resume the handovers whose
+    job is over. A job given explicitly is checked straight away. Returns the number of handovers resumed."""
+    docs = list(registry.pending(stage, job_id, due=job_id is None))
+    if not docs:
+        return 0
+    results = poller.poll([(doc['stage'], doc['job_id']) for doc in docs], stage_client)
+    resumed = 0
+    for doc in docs:
+        if check_pending_job(app, doc['stage'], doc['job_id'], doc['payload'], results[(doc['stage'], doc['job_id'])]):
+            resumed += 1
+    return resumed
+
+
+def check_pending_job(app, stage, job_id, payload, result):
+    """Resume the handover waiting for the job if it is over, result being the retrieved job or the retrieval error"""
+    if isinstance(result, Exception):
+        # let the task report the failure as it would have when polling
+        logger.error("Cannot retrieve %s job %s: %s", stage, job_id, result)
+    elif is_running(stage, result):
+        update_progress(stage, job_id, payload, result)
+        return False
+    if registry.claim(stage, job_id):
+        resume_handover(app, payload)
+        return True
+    return False
+
+
+def update_progress(stage, job_id, payload, result):
+    """Schedule the next check of a running job, keeping the datacheck progress reported"""
+    spec = payload['args'][0]
+    record_check(stage, job_id, spec)
+    if stage == 'datacheck' and result.get('progress', None) and result['progress'] != spec.get('job_progress'):
+        spec['job_progress'] = result['progress']
+        log_and_publish(make_report('INFO', 'Datachecks in progress', spec, spec['src_uri']))
+    delay = next_poll_delay(stage, spec, payload['retries'])
+    payload['retries'] += 1
+    registry.update(stage, job_id, payload, time.time() + delay)
@@ -0,0 +1,119 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Proxy of the submission form autocompletion to the dbcopy service.
+# Requests go through a keep-alive session with connect and read timeouts. Identical queries in flight are sent
+# once, and answers are cached dropdown_cache_ttl seconds. When dbcopy is slow or down, the last answer to the same
+# query is used, however old.
+# '''
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ensembl.production.handover.config import HandoverConfig as cfg
+from ensembl.production.handover.lazy import Lazy
+
+logger = logging.getLogger(__name__)
+
+# most databases answered by the autocompletion of the submission form
+MAX_DROPDOWN_RESULTS = 1000
+
+
+class _Pending:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DropdownProxy:
+    """Cached and coalesced GET requests to base_uri"""
+
+    def __init__(self, base_uri, connect_timeout=2, read_timeout=5, cache_ttl=30, pool_size=10, max_entries=1024):
+        self.base_uri = base_uri
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic(), value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, path, **params):
+        """Json answer of base_uri/path for the query parameters"""
+        key = (path, tuple(sorted(params.items())))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.cache_ttl:
+                self._entries.move_to_end(key)
+                return entry[1]
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = _Pending()
+        if not owner:
+            if not pending.event.wait(sum(self.timeout)):
+                raise requests.Timeout(f"No answer from {self.base_uri}{path}")
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+        try:
+            res = self.session.get(f"{self.base_uri}{path}", params=params, timeout=self.timeout)
+            res.raise_for_status()
+            pending.result = res.json()
+            self._store(key, pending.result)
+        except requests.RequestException as e:
+            if entry is None:
+                pending.error = e
+                raise
+            logger.warning("Using the last answer of %s%s: %s", self.base_uri, path, e)
+            pending.result = entry[1]
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.event.set()
+        return pending.result
+
+
+def listing_server(host, port):
+    """Uri of the MySQL server to list the databases of with the read only dropdown_mysql_user, None unless the
+    server is one of the dropdown_mysql_servers or a source host known to dbcopy"""
+    server = f"{host}:{port}"
+    known = server in [s.strip() for s in cfg.dropdown_mysql_servers.split(',')]
+    if not known:
+        hosts = dropdown_proxy.get('api/dbcopy/srchost', name=host)
+        hosts = hosts.get('results', []) if isinstance(hosts, dict) else hosts
+        known = any(item.get('name') == host and str(item.get('port')) == str(port) for item in hosts)
+    return f"mysql://{cfg.dropdown_mysql_user}@{server}/" if known else None
+
+
+dropdown_proxy = Lazy('dropdown_proxy', lambda: DropdownProxy(cfg.copy_uri_dropdown,
+                                                              connect_timeout=cfg.dropdown_connect_timeout,
+                                                              read_timeout=cfg.dropdown_read_timeout,
+                                                              cache_ttl=cfg.dropdown_cache_ttl,
+                                                              pool_size=cfg.dropdown_pool_size))
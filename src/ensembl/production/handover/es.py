@@ -0,0 +1,105 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Process wide Elasticsearch client.
+# The client and its connection pool (ES_POOL_SIZE connections) are created on first use in each process, so that
+# gunicorn and celery prefork children never share sockets with their parent, and reused by every request.
+# The cluster is pinged at most every ES_HEALTH_CHECK_INTERVAL seconds.
+# '''
+
+import os
+import ssl
+import threading
+import time
+
+import urllib3
+from elasticsearch import Elasticsearch, NotFoundError, Transport
+from elasticsearch.connection import create_ssl_context
+
+from ensembl.production.handover import metrics, tracing
+from ensembl.production.handover.config import HandoverConfig as cfg
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_last_check = 0.0
+
+
+def es_endpoint(method, url):
+    """Endpoint of a request for the metrics, e.g. 'POST _search', without the index and document ids"""
+    parts = [part for part in url.split('?')[0].split('/') if part]
+    api = next((part for part in reversed(parts) if part.startswith('_')), None)
+    return f"{method} {api or ('index' if parts else '/')}"
+
+
+class InstrumentedTransport(Transport):
+    """Transport recording the latency and failures of the requests by endpoint, and a span per request"""
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        endpoint = es_endpoint(method, url)
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"es {endpoint}", url=url):
+                return super().perform_request(method, url, headers=headers, params=params, body=body)
+        except NotFoundError:
+            raise
+        except Exception:
+            metrics.es_errors.labels(endpoint).inc()
+            raise
+        finally:
+            metrics.es_seconds.labels(endpoint).observe(time.perf_counter() - start)
+
+
+def create_es_client(host, port, user='', password='', with_ssl=False, pool_size=10, timeout=10):
+    urllib3.disable_warnings(category=urllib3.connectionpool.InsecureRequestWarning)
+    ssl_context = create_ssl_context()
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    return Elasticsearch(hosts=[{'host': host, 'port': port}],
+                         scheme="https" if with_ssl else "http",
+                         ssl_context=ssl_context,
+                         http_auth=(user, password),
+                         maxsize=pool_size,
+                         timeout=timeout,
+                         transport_class=InstrumentedTransport)
+
+
+def get_es_client():
+    """Return the Elasticsearch client of the current process"""
+    global _client, _client_pid, _last_check
+    with _lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = create_es_client(cfg.ES_HOST, int(cfg.ES_PORT), cfg.ES_USER, cfg.ES_PASSWORD, cfg.ES_SSL,
+                                       pool_size=cfg.ES_POOL_SIZE, timeout=cfg.ES_TIMEOUT)
+            _client_pid = os.getpid()
+            _last_check = 0.0
+        if time.monotonic() - _last_check > cfg.ES_HEALTH_CHECK_INTERVAL:
+            if not _client.ping():
+                raise RuntimeError(
+                    f"Cannot connect to Elasticsearch server. User: {cfg.ES_USER}, Host: {cfg.ES_HOST}:{cfg.ES_PORT}")
+            _last_check = time.monotonic()
+        return _client
+
+
+class ElasticsearchConnection:
+    """Drop-in replacement of ElasticsearchConnectionManager using the process wide client,
+    which stays open when leaving the context"""
+
+    def __init__(self):
+        self.client = None
+
+    def __enter__(self):
+        self.client = get_es_client()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.client = None
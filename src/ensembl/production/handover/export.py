@@ -0,0 +1,104 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Export of the handovers of a release for offline analysis, as json lines or csv, streamed as they are read.
+# The handover states are read export_page_size at a time with search_after and, when asked for, the reports of each
+# page with a single scroll sorted like the page, so that only one page of handovers and the reports of one handover
+# are held in memory, however many handovers and reports the release has.
+# '''
+
+import csv
+import io
+import itertools
+import json
+
+from ensembl.production.handover.celery_app.state import state_store, STAGES
+from ensembl.production.handover.config import HandoverConfig as cfg
+
+# mime type of each export format
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+# state fields of the csv export, in column order
+HANDOVER_FIELDS = ('handover_token', 'database', 'src_uri', 'tgt_uri', 'db_type', 'db_division', 'contact', 'comment',
+                   'status', 'message', 'submission_time', 'report_time', 'progress_complete', 'progress_total')
+# report fields of the exports
+REPORT_FIELDS = ('report_time', 'report_type', 'message', 'resource')
+# csv columns of the report fields, apart from the last report time and message of the handover state
+REPORT_COLUMNS = ('reported_at', 'report_type', 'report_message', 'report_resource')
+
+
+def report_record(report):
+    return {
+        'report_time': report.get('report_time'),
+        'report_type': report.get('report_type'),
+        'message': report.get('msg', report.get('message', '')),
+        'resource': report.get('resource', ''),
+    }
+
+
+def handovers(query, reports=False, page_size=None, store=None):
+    """Yield the state documents matching the query in handover token order, each with the list of its reports in
+    time order under 'reports' when asked for"""
+    store = store or state_store
+    for page in store.pages(query, page_size or cfg.export_page_size):
+        if not reports:
+            yield from page
+            continue
+        history = itertools.groupby(store.reports([state['handover_token'] for state in page]),
+                                    key=lambda hit: hit['_source']['params']['handover_token'])
+        token, hits = next(history, (None, None))
+        for state in page:
+            state['reports'] = []
+            # both sorted by token, the reports of handovers no longer in the state index being skipped
+            while token is not None and token <= state['handover_token']:
+                if token == state['handover_token']:
+                    state['reports'] = [report_record(hit['_source']) for hit in hits]
+                token, hits = next(history, (None, None))
+            yield state
+
+
+def ndjson_lines(states):
+    for state in states:
+        yield json.dumps(state) + '\n'
+
+
+def csv_row(values):
+    line = io.StringIO()
+    csv.writer(line).writerow(values)
+    return line.getvalue()
+
+
+def csv_lines(states, reports=False):
+    """Csv lines of the handovers with the duration of their completed stages, one line per report when asked for"""
+    columns = list(HANDOVER_FIELDS) + [f"{stage}_seconds" for stage in STAGES]
+    yield csv_row(columns + list(REPORT_COLUMNS) if reports else columns)
+    for state in states:
+        timeline = state.get('timeline') or {}
+        values = [state.get(field, '') for field in HANDOVER_FIELDS]
+        values += [timeline.get(stage, {}).get('duration', '') for stage in STAGES]
+        if not reports:
+            yield csv_row(values)
+            continue
+        for report in state.get('reports') or [{}]:
+            yield csv_row(values + [report.get(field, '') for field in REPORT_FIELDS])
+
+
+def export(query, fmt, reports=False):
+    """Lines of the export of the handovers matching the query in the given format"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported export format {fmt}, expected one of {', '.join(FORMATS)}")
+    states = handovers(query, reports)
+    if fmt == 'csv':
+        return csv_lines(states, reports)
+    return ndjson_lines(states)
@@ -0,0 +1,54 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Objects created on first use in each process.
+# Module level clients and publishers are declared as Lazy proxies so that importing a module, forking a worker or
+# running the tests doesn't create them. The time taken to create each of them is kept for the startup report.
+# '''
+
+import os
+import threading
+import time
+
+# seconds taken to create each lazy object, by name
+timings = {}
+
+
+class Lazy:
+    """Proxy to the object returned by factory, called on first attribute access and again in forked processes"""
+
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._instance = None
+        self._pid = None
+
+    def get(self):
+        if self._instance is None or self._pid != os.getpid():
+            with self._lock:
+                if self._instance is None or self._pid != os.getpid():
+                    start = time.perf_counter()
+                    self._instance = self._factory()
+                    self._pid = os.getpid()
+                    timings[self._name] = time.perf_counter() - start
+        return self._instance
+
+    @property
+    def created(self):
+        return self._instance is not None and self._pid == os.getpid()
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __repr__(self):
+        return f"<Lazy {self._name}: {self._instance if self.created else 'not created'}>"
@@ -0,0 +1,169 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Prometheus metrics of the web app and celery workers, served by GET /metrics and by the worker metrics server.
+# The metrics are no-ops when metrics_enabled is off, or with a warning when the prometheus_client package is missing.
+# Under gunicorn and prefork celery workers, PROMETHEUS_MULTIPROC_DIR must be set to an empty directory shared by the
+# processes before they start: each process writes its samples there and they are added up when exported.
+# '''
+
+import contextlib
+import functools
+import logging
+import os
+import time
+
+from ensembl.production.handover import tracing
+from ensembl.production.handover.config import HandoverConfig as cfg
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+if prometheus_client is None and cfg.metrics_enabled:
+    logger.warning("prometheus_client is not installed, metrics are not recorded and /metrics is empty")
+enabled = prometheus_client is not None and cfg.metrics_enabled
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a cached lookup to a slow downstream service
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# seconds, from a quick datacheck run to a day long copy
+STAGE_BUCKETS = (60, 300, 600, 1800, 3600, 7200, 14400, 43200, 86400)
+
+
+class _NoopMetric:
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+
+_noop = _NoopMetric()
+
+
+def histogram(name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+    if not enabled:
+        return _noop
+    return prometheus_client.Histogram(name, documentation, labels, buckets=buckets)
+
+
+def counter(name, documentation, labels=()):
+    if not enabled:
+        return _noop
+    return prometheus_client.Counter(name, documentation, labels)
+
+
+def gauge(name, documentation, labels=(), multiprocess_mode='livesum'):
+    if not enabled:
+        return _noop
+    return prometheus_client.Gauge(name, documentation, labels, multiprocess_mode=multiprocess_mode)
+
+
+submission_seconds = histogram('handover_submission_step_seconds',
+                               'Time spent validating a handover submission, by step', ['step'])
+stage_seconds = histogram('handover_stage_seconds', 'Duration of the pipeline stages', ['stage', 'db_type'],
+                          buckets=STAGE_BUCKETS)
+stage_retries = counter('handover_stage_retries', 'Checks of a downstream job still running', ['stage'])
+client_seconds = histogram('handover_client_request_seconds', 'Latency of the downstream service calls',
+                           ['client', 'method'])
+client_errors = counter('handover_client_errors', 'Failed downstream service calls', ['client', 'method'])
+es_seconds = histogram('handover_es_request_seconds', 'Latency of the Elasticsearch requests', ['endpoint'])
+es_errors = counter('handover_es_errors', 'Failed Elasticsearch requests', ['endpoint'])
+http_seconds = histogram('handover_http_request_seconds', 'Latency of the web requests',
+                         ['endpoint', 'method', 'status'])
+report_seconds = histogram('handover_report_publish_seconds', 'Time spent by the callers publishing a report')
+amqp_seconds = histogram('handover_amqp_publish_seconds', 'Latency of the reports from queueing to broker confirm')
+amqp_published = counter('handover_amqp_published', 'Reports confirmed by the broker')
+amqp_dropped = counter('handover_amqp_dropped', 'Reports dropped, the queue being full or the broker unreachable')
+amqp_failed_batches = counter('handover_amqp_failed_batches', 'Report batches which failed to be published')
+amqp_reconnections = counter('handover_amqp_reconnections', 'Connections opened to the report exchange')
+amqp_queue_depth = gauge('handover_amqp_queue_depth', 'Reports queued for publishing')
+
+
+@contextlib.contextmanager
+def timed(metric, **labels):
+    """Observe the time spent in the block, also usable as a decorator"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        (metric.labels(**labels) if labels else metric).observe(time.perf_counter() - start)
+
+
+class InstrumentedClient:
+    """Proxy to a REST client recording the latency and failures of its method calls, and a span per call"""
+
+    def __init__(self, name, client):
+        self._name = name
+        self._client = client
+
+    def __getattr__(self, attr):
+        value = getattr(self._client, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+        return functools.wraps(value)(functools.partial(self.call, attr, value))
+
+    def call(self, attr, func, *args, **kwargs):
+        """Call func, recorded as the attr method of the client, e.g. a request to the service made without it"""
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"{self._name}.{attr}"):
+                return func(*args, **kwargs)
+        except Exception:
+            client_errors.labels(self._name, attr).inc()
+            raise
+        finally:
+            client_seconds.labels(self._name, attr).observe(time.perf_counter() - start)
+
+    def __repr__(self):
+        return f"<InstrumentedClient {self._name}: {self._client!r}>"
+
+
+def registry():
+    """Registry of the process, or of all the processes sharing PROMETHEUS_MULTIPROC_DIR"""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        shared = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(shared)
+        return shared
+    return prometheus_client.REGISTRY
+
+
+def export():
+    """Metrics in the Prometheus text format"""
+    return prometheus_client.generate_latest(registry())
+
+
+def start_server(port):
+    """Serve the metrics on port from a background thread"""
+    if not enabled:
+        logger.warning("Metrics disabled, not serving them on port %s", port)
+        return
+    prometheus_client.start_http_server(port, registry=registry())
+    logger.info("Serving metrics on port %s", port)
+
+
+def mark_process_dead(pid):
+    """Forget the live gauges of a process which exited"""
+    if enabled and 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,63 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Startup profile of the web app and celery workers, to be run in a fresh process:
+#     python -m ensembl.production.handover.startup [--create]
+# Each module is imported in the order a worker imports them, the time reported being the time spent importing what
+# the previous modules didn't already load. --create also creates the lazy clients and publisher.
+# '''
+
+import argparse
+import importlib
+import time
+
+MODULES = (
+    'ensembl.production.handover.config',
+    'ensembl.production.handover.celery_app.utils',
+    'ensembl.production.handover.celery_app.tasks',
+    'ensembl.production.handover.app.main',
+)
+LAZY_OBJECTS = ('publisher', 'dc_client', 'db_copy_client', 'metadata_client', 'event_client')
+
+
+def profile(modules=MODULES, create=False):
+    """List of (step, seconds)"""
+    steps = []
+    for module in modules:
+        start = time.perf_counter()
+        importlib.import_module(module)
+        steps.append((f"import {module}", time.perf_counter() - start))
+    if create:
+        from ensembl.production.handover import lazy
+        from ensembl.production.handover.celery_app import utils
+        for name in LAZY_OBJECTS:
+            getattr(utils, name).get()
+            steps.append((f"create {name}", lazy.timings[name]))
+    return steps
+
+
+def report(steps):
+    width = max(len(step) for step, _ in steps + [('total', 0)])
+    lines = [f"{step:<{width}}  {seconds * 1000:9.1f} ms" for step, seconds in steps]
+    lines.append(f"{'total':<{width}}  {sum(seconds for _, seconds in steps) * 1000:9.1f} ms")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Startup profile of the handover web app and celery workers')
+    parser.add_argument('--create', action='store_true', help='also create the lazy clients and publisher')
+    args = parser.parse_args(argv)
+    print(report(profile(create=args.create)))
+
+
+if __name__ == '__main__':
+    main()
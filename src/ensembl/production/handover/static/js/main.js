@@ -4,12 +4,17 @@ $(function () {
 
     console.log('Handover autocomplete');
     var SelectedHostDetails;
+    // pending autocompletion requests, aborted when superseded by the next keystroke
+    var hostRequest, databaseRequest;
 
     console.log(copy_url);
 
     $("#src_uri").autocomplete({
         source: function (request, response) {
-            $.ajax({
+            if (hostRequest) {
+                hostRequest.abort();
+            }
+            hostRequest = $.ajax({
                 url: `${script_name}/jobs/dropdown/src_host`,
                 dataType: "json",
                 data: {
@@ -51,7 +56,10 @@ $(function () {
     //add dblist dropdown
     $("#database").autocomplete({
         source: function (request, response) {
-            $.ajax({
+            if (databaseRequest) {
+                databaseRequest.abort();
+            }
+            databaseRequest = $.ajax({
                 url: `${script_name}/jobs/dropdown/databases/${SelectedHostDetails.name}/${SelectedHostDetails.port}`,
                 // url: `/dropdown/databases/${SelectedHostDetails.name}/${SelectedHostDetails.port}`,
                 dataType: "json",
@@ -0,0 +1,289 @@
+# .. See the NOTICE file distributed with this work for additional information
+#    regarding copyright ownership.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#        https://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+# '''
+# Tracing of each handover, from its submission to the end of its last task.
+# The trace id is derived from the handover token. The trace context is started at submission, sent along with every
+# celery task message in the handover_trace header, and spans are recorded around each task run (one per retry) and
+# each call to the downstream services, Elasticsearch, MySQL and the report exchange made on behalf of the handover.
+# Spans are handed to the exporter set with tracing_exporter: none, memory, file (json lines appended to tracing_file)
+# or module:callable returning an object with an export(span) method. To print the spans of a handover:
+#     python -m ensembl.production.handover.tracing /tmp/handover_spans.jsonl <handover_token>
+# '''
+
+import argparse
+import collections
+import contextlib
+import contextvars
+import hashlib
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from ensembl.production.handover.config import HandoverConfig as cfg
+
+logger = logging.getLogger(__name__)
+
+# name of the celery message header holding the trace context
+HEADER = 'handover_trace'
+
+SpanContext = collections.namedtuple('SpanContext', ['trace_id', 'span_id', 'handover_token'])
+
+_current = contextvars.ContextVar('handover_trace', default=None)
+
+
+def trace_id(handover_token):
+    """Trace id of the handover, the token itself when it is a uuid"""
+    try:
+        return uuid.UUID(str(handover_token)).hex
+    except ValueError:
+        return hashlib.sha1(str(handover_token).encode()).hexdigest()[:32]
+
+
+class Span:
+    """Timed operation of a trace, times in seconds since the epoch"""
+
+    def __init__(self, name, context, parent_id, attributes):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.end = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.context.trace_id,
+            'span_id': self.context.span_id,
+            'parent_id': self.parent_id,
+            'handover_token': self.context.handover_token,
+            'start': self.start,
+            'end': self.end,
+            'duration': self.end - self.start if self.end is not None else None,
+            'attributes': self.attributes,
+            'error': self.error,
+            'pid': os.getpid(),
+        }
+
+
+class MemoryExporter:
+    """Last max_spans spans of the process"""
+
+    def __init__(self, max_spans=10000):
+        self._spans = collections.deque(maxlen=max_spans)
+
+    def export(self, span):
+        self._spans.append(span)
+
+    def spans(self, handover_token=None):
+        return [span for span in list(self._spans)
+                if handover_token is None or span['handover_token'] == handover_token]
+
+    def clear(self):
+        self._spans.clear()
+
+
+class FileExporter:
+    """Spans appended as json lines to a file shared by the web and celery processes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def export(self, span):
+        line = json.dumps(span, default=str) + '\n'
+        with self._lock:
+            if self._file is None or self._pid != os.getpid():
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._file = open(self.path, 'a', buffering=1)
+                self._pid = os.getpid()
+            self._file.write(line)
+
+
+def create_exporter(name, path=None):
+    """Exporter for the tracing_exporter setting, None when tracing is off"""
+    if not name or name == 'none':
+        return None
+    if name == 'memory':
+        return MemoryExporter()
+    if name == 'file':
+        return FileExporter(path)
+    module, _, attr = name.partition(':')
+    if not attr:
+        raise ValueError(f"Unsupported tracing exporter {name}, expected none, memory, file or module:callable")
+    return getattr(importlib.import_module(module), attr)()
+
+
+exporter = create_exporter(cfg.tracing_exporter, cfg.tracing_file)
+
+
+def export(span):
+    try:
+        exporter.export(span.to_dict())
+    except Exception as e:
+        logger.warning("Unable to export span %s: %s", span.name, e)
+
+
+def start_span(name, context=None, **attributes):
+    """Span child of context (by default the current one), None outside of a handover trace or when tracing is off"""
+    parent = context or _current.get()
+    if exporter is None or parent is None:
+        return None
+    return Span(name, parent._replace(span_id=uuid.uuid4().hex[:16]), parent.span_id, attributes)
+
+
+def end_span(span, error=None):
+    if span is None:
+        return
+    span.end = time.time()
+    if error is not None:
+        span.error = f"{type(error).__name__}: {error}"
+    export(span)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Record the block as a span of the current handover trace, yields None when not traced"""
+    current = start_span(name, **attributes)
+    if current is None:
+        yield None
+        return
+    reset = _current.set(current.context)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(reset)
+        end_span(current)
+
+
+@contextlib.contextmanager
+def trace(handover_token, name, **attributes):
+    """Record the block as a root span of the handover trace"""
+    reset = _current.set(SpanContext(trace_id(handover_token), None, handover_token))
+    try:
+        with span(name, **attributes) as root:
+            yield root
+    finally:
+        _current.reset(reset)
+
+
+def current_context():
+    """Trace context to send along with a message, None outside of a handover trace"""
+    context = _current.get()
+    return context._asdict() if context is not None else None
+
+
+@contextlib.contextmanager
+def use(context):
+    """Run the block in the trace context received with a message"""
+    if not context:
+        yield
+        return
+    reset = _current.set(SpanContext(**context))
+    try:
+        yield
+    finally:
+        _current.reset(reset)
+
+
+class TaskSpans:
+    """Spans of the task runs of the process, started and ended from the celery signals"""
+
+    def __init__(self):
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def start(self, task_id, name, context, **attributes):
+        """Start the span of a task run, a task received without trace context running outside of any trace"""
+        if exporter is None:
+            return
+        current = start_span(name, SpanContext(**context), **attributes) if context else None
+        reset = _current.set(current.context if current is not None else None)
+        with self._lock:
+            self._running[task_id] = (current, reset)
+
+    def end(self, task_id, state=None, error=None):
+        with self._lock:
+            running = self._running.pop(task_id, None)
+        if running is None:
+            return
+        current, reset = running
+        try:
+            _current.reset(reset)
+        except ValueError:
+            # ended from another context than the one it started in
+            _current.set(None)
+        if current is not None:
+            current.set_attribute('state', state)
+            end_span(current, error)
+
+
+task_spans = TaskSpans()
+
+
+def load(path, handover_token):
+    """Spans of the handover from a file written by the FileExporter, in start order"""
+    spans = []
+    with open(path) as f:
+        for line in f:
+            span_dict = json.loads(line)
+            if span_dict['handover_token'] == handover_token:
+                spans.append(span_dict)
+    return sorted(spans, key=lambda span_dict: span_dict['start'])
+
+
+def report(spans):
+    """Spans as an indented tree, with their offset from the start of the trace and duration"""
+    if not spans:
+        return 'No span recorded'
+    children = collections.defaultdict(list)
+    ids = {span_dict['span_id'] for span_dict in spans}
+    for span_dict in spans:
+        children[span_dict['parent_id'] if span_dict['parent_id'] in ids else None].append(span_dict)
+    origin = spans[0]['start']
+    lines = []
+
+    def walk(parent_id, depth):
+        for span_dict in children[parent_id]:
+            duration = span_dict['duration'] or 0
+            error = f"  {span_dict['error']}" if span_dict['error'] else ''
+            lines.append(f"{span_dict['start'] - origin:10.3f}s {duration:10.3f}s  {'  ' * depth}{span_dict['name']}"
+                         f"{error}")
+            walk(span_dict['span_id'], depth + 1)
+
+    walk(None, 0)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Spans recorded for a handover')
+    parser.add_argument('path', help='file written by the file tracing exporter')
+    parser.add_argument('handover_token')
+    args = parser.parse_args(argv)
+    print(report(load(args.path, args.handover_token)))
+
+
+if __name__ == '__main__':
+    main()
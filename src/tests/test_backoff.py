@@ -0,0 +1,81 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+import unittest
+from unittest import mock
+
+from ensembl.production.handover.celery_app import backoff
+from ensembl.production.handover.celery_app.backoff import BackoffPolicy, StageDurationHistory, backoff_policy
+
+policies = {
+    'default': {'initial': 120},
+    'metadata': {'initial': 10, 'factor': 2, 'cap': 300},
+    'core': {
+        'datacheck': {'initial': 300, 'factor': 1.5, 'cap': 1800, 'jitter': 0.1}
+    }
+}
+
+
+class TestBackoffPolicy(unittest.TestCase):
+
+    def test_fixed_delay(self):
+        policy = BackoffPolicy(60)
+        self.assertEqual([60] * 5, [policy.delay(attempt) for attempt in range(5)])
+
+    def test_exponential_delay_capped(self):
+        policy = BackoffPolicy(10, factor=2, cap=100)
+        self.assertEqual([10, 20, 40, 80, 100, 100], [policy.delay(attempt) for attempt in range(6)])
+
+    def test_jitter(self):
+        policy = BackoffPolicy(100, jitter=0.2)
+        for attempt in range(20):
+            self.assertTrue(80 <= policy.delay(attempt) <= 120)
+
+    def test_learned_first_delay(self):
+        policy = BackoffPolicy(10, factor=2, cap=100)
+        self.assertEqual([3600, 10, 20, 40], [policy.delay(attempt, first=3600) for attempt in range(4)])
+
+    def test_policy_lookup(self):
+        self.assertEqual(300, backoff_policy('datacheck', 'core', policies, 60).initial)
+        self.assertEqual(120, backoff_policy('datacheck', 'variation', policies, 60).initial)
+        self.assertEqual(10, backoff_policy('metadata', 'core', policies, 60).initial)
+        self.assertEqual(60, backoff_policy('dbcopy', 'core', {}, 60).delay(3))
+
+
+class TestLearnedBackoff(unittest.TestCase):
+
+    def setUp(self):
+        self.history = StageDurationHistory(index='stats', cache_ttl=60, max_entries=2)
+        connect = mock.patch.object(self.history, 'connect').start()
+        self.addCleanup(mock.patch.stopall)
+        self.client = connect.return_value.__enter__.return_value.client
+        self.client.get.return_value = {'_source': {'mean': 3600}}
+
+    def test_means_cached_for_the_last_stages_read(self):
+        for db_type in ('core', 'variation', 'core', 'funcgen', 'core'):
+            self.assertEqual(3600, self.history.mean(db_type, 'datacheck'))
+        self.assertEqual(3, self.client.get.call_count)
+        self.assertEqual(['funcgen-datacheck', 'core-datacheck'], list(self.history._cache))
+        with mock.patch.object(backoff.time, 'time', return_value=time.time() + 61):
+            self.history.mean('core', 'datacheck')
+        self.assertEqual(4, self.client.get.call_count)
+
+    def test_first_delay_learned_when_enabled(self):
+        spec = {'db_type': 'core'}
+        with mock.patch.object(backoff, 'history', self.history), \
+                mock.patch.object(backoff, 'backoff_policy', return_value=BackoffPolicy(60)):
+            with mock.patch.object(backoff.HandoverCeleryConfig, 'learned_backoff', True), \
+                    mock.patch.object(backoff.HandoverCeleryConfig, 'learned_backoff_ratio', 0.5):
+                self.assertEqual(1800, backoff.next_poll_delay('datacheck', spec, 0))
+            with mock.patch.object(backoff.HandoverCeleryConfig, 'learned_backoff', False):
+                self.assertEqual(60, backoff.next_poll_delay('datacheck', spec, 0))
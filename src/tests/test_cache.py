@@ -0,0 +1,94 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+from unittest import mock
+
+from ensembl.production.handover.app import main
+from ensembl.production.handover.cache import LocalCache, ResponseCache
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache(LocalCache(), ttl=60)
+        self.build = mock.Mock(return_value=[{'handover_token': 'token'}])
+
+    def test_local_cache_expiry(self):
+        backend = LocalCache(max_entries=2)
+        backend.set('a', 1, ttl=0.01)
+        backend.set('b', 2)
+        backend.set('c', 3)
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(2, backend.get('b'))
+        with mock.patch('time.monotonic', return_value=10 ** 9):
+            backend.set('d', 4, ttl=1)
+        self.assertEqual(3, backend.get('c'))
+
+    def test_response_cached(self):
+        first = self.cache.get_or_set('key', self.build)
+        second = self.cache.get_or_set('key', self.build)
+        self.assertEqual(first, second)
+        self.build.assert_called_once()
+
+    def test_invalidate(self):
+        detail_key = self.cache.detail_key('token')
+        list_key = self.cache.list_key({'release': '110'})
+        self.cache.get_or_set(detail_key, self.build)
+        self.cache.get_or_set(list_key, self.build)
+        self.cache.invalidate('token')
+        self.assertNotEqual(list_key, self.cache.list_key({'release': '110'}))
+        self.cache.get_or_set(detail_key, self.build)
+        self.assertEqual(3, self.build.call_count)
+
+    def test_disabled(self):
+        cache = ResponseCache(LocalCache(), ttl=0)
+        cache.get_or_set('key', self.build)
+        cache.get_or_set('key', self.build)
+        self.assertEqual(2, self.build.call_count)
+
+    def test_backend_errors_ignored(self):
+        backend = mock.Mock(**{'get.side_effect': ConnectionError(), 'set.side_effect': ConnectionError()})
+        cache = ResponseCache(backend, ttl=60)
+        self.assertEqual('[{"handover_token": "token"}]', cache.get_or_set(cache.list_key({}), self.build)['body'])
+
+
+class TestCachedEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.client = main.app.test_client()
+        mock.patch.object(main, 'response_cache', ResponseCache(LocalCache(), ttl=60)).start()
+        self.get = mock.patch.object(main.state_store, 'get', return_value={
+            'handover_token': 'token', 'message': 'Datachecks in progress', 'report_time': '2023-01-01T10:00:00.000'
+        }).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_detail_not_modified(self):
+        response = self.client.get('/jobs/token?format=json')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('token', response.json[0]['handover_token'])
+        etag = response.headers['ETag']
+        response = self.client.get('/jobs/token?format=json', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.get.assert_called_once()
+
+    def test_detail_invalidated(self):
+        self.client.get('/jobs/token?format=json')
+        main.response_cache.invalidate('token')
+        self.client.get('/jobs/token?format=json')
+        self.assertEqual(2, self.get.call_count)
+
+    def test_unknown_handover_not_cached(self):
+        self.get.return_value = None
+        self.assertEqual(404, self.client.get('/jobs/token?format=json').status_code)
+        self.assertEqual(404, self.client.get('/jobs/token?format=json').status_code)
+        self.assertEqual(2, self.get.call_count)
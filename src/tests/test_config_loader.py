@@ -10,13 +10,19 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import tempfile
+import threading
 import unittest
 import warnings
 from pathlib import Path
+from unittest import mock
 
 import requests
+from celery.exceptions import WorkerShutdown
 
-from ensembl.production.handover.config import ComparaDispatchConfig, HandoverConfig
+from ensembl.production.handover.celery_app import utils
+from ensembl.production.handover.config import ComparaDispatchConfig, ComparaSpecies, ComparaSpeciesIndex, \
+    HandoverConfig
 from sqlalchemy.exc import MovedIn20Warning
 
 warnings.filterwarnings("ignore", category=MovedIn20Warning)
@@ -49,6 +55,112 @@ class TestHOConfigLoader(unittest.TestCase):
             ComparaDispatchConfig.load_division(None, 'plants')
 
 
+class TestComparaSpecies(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.divisions = {'vertebrates': ['homo_sapiens', 'mus_musculus'], 'plants': ['zea_mays']}
+        self.load_divisions = mock.patch.object(ComparaDispatchConfig, 'load_divisions',
+                                                return_value=self.divisions).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def species(self):
+        return ComparaSpecies('110', self.tmp_dir.name)
+
+    def test_warm_and_snapshot(self):
+        species = self.species()
+        self.load_divisions.assert_not_called()
+        species.warm()
+        self.assertIn('zea_mays', species)
+        self.assertEqual(3, len(species))
+        self.load_divisions.assert_called_once_with('110')
+        # other processes start from the snapshot
+        self.load_divisions.side_effect = requests.ConnectionError('offline')
+        self.assertEqual(['zea_mays', 'homo_sapiens', 'mus_musculus'], list(self.species()))
+        self.load_divisions.assert_called_once()
+
+    def test_fetched_in_background_without_snapshot(self):
+        fetching = threading.Event()
+        self.load_divisions.side_effect = lambda version: fetching.wait(5) and self.divisions
+        species = self.species()
+        # answered straight away while the lists are fetched
+        self.assertFalse(species)
+        self.assertFalse(species.matches('homo_sapiens'))
+        self.assertTrue(species.refreshing())
+        fetching.set()
+        species.refresh().join()
+        self.assertIn('zea_mays', species)
+        self.load_divisions.assert_called_once_with('110')
+
+    def test_stale_snapshot_refreshed_in_background(self):
+        self.species().warm()
+        species = self.species()
+        species.max_age = 0
+        self.load_divisions.return_value = {'vertebrates': ['homo_sapiens', 'danio_rerio']}
+        self.assertIn('zea_mays', species)
+        species.refresh().join()
+        self.assertNotIn('zea_mays', species)
+        self.assertIn('danio_rerio', self.species())
+
+    def test_offline_without_snapshot(self):
+        self.load_divisions.side_effect = RuntimeError('Unable to load any configuration for plants')
+        species = self.species()
+        self.assertFalse(species.available())
+        # the background fetch started by the first use
+        species._refresher.join()
+        self.load_divisions.side_effect = None
+        self.assertFalse(species.available())
+        self.assertEqual(1, self.load_divisions.call_count)
+        species.retry_interval = 0
+        self.assertTrue(species.warm())
+        self.assertTrue(species)
+
+    def test_worker_not_started_without_lists(self):
+        self.load_divisions.side_effect = requests.ConnectionError('offline')
+        with mock.patch.object(utils.cfg, 'compara_species', self.species()), \
+                mock.patch.object(utils.cfg, 'dispatch_all', False):
+            with self.assertRaises(WorkerShutdown):
+                utils.warm_compara_species()
+            self.load_divisions.side_effect = None
+            utils.cfg.compara_species.retry_interval = 0
+            utils.warm_compara_species()
+
+
+class TestComparaSpeciesIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.divisions = {'vertebrates': ['homo_sapiens', 'canis_lupus_familiaris', 'mus_musculus'],
+                          'plants': ['zea_mays', 'arabidopsis_thaliana'],
+                          'metazoa': ['drosophila_melanogaster', 'mus_musculus']}
+        self.index = ComparaSpeciesIndex(self.divisions)
+
+    def test_membership(self):
+        self.assertIn('zea_mays', self.index)
+        self.assertNotIn('zea', self.index)
+        self.assertEqual({'vertebrates', 'metazoa'}, self.index.divisions_of['mus_musculus'])
+        self.assertEqual(frozenset(['zea_mays', 'arabidopsis_thaliana']), self.index.by_division['plants'])
+
+    def test_matches_same_as_substring_scan(self):
+        species = [s for division in self.divisions.values() for s in division]
+        for name in ('homo_sapiens', 'canis_lupus', 'lupus_familiaris', 'musculus', 'sapiens_core', 'danio_rerio',
+                     'bacteria_0_collection', 's_m', ''):
+            self.assertEqual(any(name in val for val in species), self.index.matches(name), name)
+
+    def test_matches_memo_bounded(self):
+        index = ComparaSpeciesIndex(self.divisions, max_matches=2)
+        for name in ('homo', 'zea', 'mus', 'homo'):
+            index.matches(name)
+        info = index.matches.cache_info()
+        self.assertEqual(2, info.currsize)
+        self.assertEqual(4, info.misses)
+
+    def test_empty(self):
+        index = ComparaSpeciesIndex({})
+        self.assertFalse(index.matches('homo_sapiens'))
+        self.assertFalse(index.matches(''))
+
+
 class TestAPPVersion(unittest.TestCase):
 
     def test_config_app_version(self):
@@ -0,0 +1,67 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+
+from ensembl.production.handover.celery_app import dbnames
+from ensembl.production.handover.celery_app.dbnames import DatabaseName
+
+
+class TestDatabaseNames(unittest.TestCase):
+
+    def test_species(self):
+        self.assertEqual(DatabaseName('homo_sapiens_core_110_38', 'homo_sapiens', 'core', 110, None, '38', 'vertebrates'),
+                         dbnames.classify('homo_sapiens_core_110_38'))
+        self.assertEqual(DatabaseName('hordeum_vulgare_variation_57_110_3', 'hordeum_vulgare', 'variation', 110, 57, '3',
+                                      None),
+                         dbnames.classify('hordeum_vulgare_variation_57_110_3'))
+
+    def test_collections(self):
+        name = dbnames.classify('bacteria_101_collection_core_57_110_1')
+        self.assertEqual(('bacteria_101_collection', 'core', 'bacteria'), (name.prefix, name.type, name.division))
+
+    def test_compara_and_ancestral(self):
+        self.assertEqual(DatabaseName('ensembl_compara_110', 'vertebrates', 'compara', 110, None, None, 'vertebrates'),
+                         dbnames.classify('ensembl_compara_110'))
+        self.assertEqual(DatabaseName('ensembl_compara_pan_homology_57_110', 'pan', 'compara', 110, 57, None, 'pan'),
+                         dbnames.classify('ensembl_compara_pan_homology_57_110'))
+        self.assertEqual(DatabaseName('ensembl_ancestral_110', 'vertebrates', 'ancestral', 110, None, None,
+                                      'vertebrates'),
+                         dbnames.classify('ensembl_ancestral_110'))
+
+    def test_unexpected_names(self):
+        for database in ('homo_sapiens_cdna_100', 'ensembl_compara_100_grch37', 'ensembl_website', '', None):
+            self.assertIsNone(dbnames.classify(database))
+        with self.assertRaises(ValueError):
+            dbnames.parse('ensembl_ancestral')
+
+    def test_memoized(self):
+        self.assertIs(dbnames.classify('mus_musculus_core_110_39'), dbnames.classify('mus_musculus_core_110_39'))
+
+    def test_classify_all(self):
+        names = [f'species_{i}_core_110_1' for i in range(2000)] + ['ensembl_website']
+        classified = dbnames.classify_all(names)
+        self.assertEqual(2001, len(classified))
+        self.assertIsNone(classified['ensembl_website'])
+        self.assertEqual('species_1999', classified['species_1999_core_110_1'].prefix)
+
+    def test_releases(self):
+        self.assertEqual([110], dbnames.releases('homo_sapiens_core_110_38'))
+        self.assertEqual([110, 57], dbnames.releases('ensembl_compara_fungi_57_110'))
+
+    def test_databases_of_release(self):
+        for database in ('ensembl_compara_fungi_48_101', 'ensembl_compara_pan_homology_48_101', 'ensembl_compara_101',
+                         'bacteria_101_collection_core_48_101_1', 'fungi_ascomycota1_collection_core_48_101_1',
+                         'capra_hircus_core_101_1', 'ovis_aries_core_101_31'):
+            self.assertIn(101, dbnames.releases(database), database)
+        for database in ('zonotrichia_albicollis_rnaseq_96_101', 'zonotrichia_albicollis_core_96_101'):
+            self.assertNotIn(101, dbnames.releases(database), database)
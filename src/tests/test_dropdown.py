@@ -0,0 +1,63 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import requests
+
+from ensembl.production.handover.dropdown import DropdownProxy
+
+
+class TestDropdownProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = DropdownProxy('http://dbcopy/', cache_ttl=60)
+        self.session_get = mock.patch.object(self.proxy.session, 'get').start()
+        self.session_get.return_value.json.return_value = ['homo_sapiens_core_110_38']
+        self.addCleanup(mock.patch.stopall)
+
+    def test_answers_cached(self):
+        self.assertEqual(['homo_sapiens_core_110_38'], self.proxy.get('api/dbcopy/databases/host/3306', search='homo'))
+        self.proxy.get('api/dbcopy/databases/host/3306', search='homo')
+        self.proxy.get('api/dbcopy/databases/host/3306', search='mus')
+        self.assertEqual(2, self.session_get.call_count)
+        self.session_get.assert_any_call('http://dbcopy/api/dbcopy/databases/host/3306', params={'search': 'homo'},
+                                         timeout=(2, 5))
+
+    def test_identical_queries_coalesced(self):
+        def slow_get(*args, **kwargs):
+            time.sleep(0.05)
+            return self.session_get.return_value
+
+        self.session_get.side_effect = slow_get
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: self.proxy.get('api/dbcopy/srchost', name='mysql'), range(8)))
+        self.assertEqual([['homo_sapiens_core_110_38']] * 8, results)
+        self.session_get.assert_called_once()
+
+    def test_last_answer_used_when_dbcopy_fails(self):
+        self.proxy.cache_ttl = 0
+        self.proxy.get('api/dbcopy/srchost', name='mysql')
+        self.session_get.side_effect = requests.Timeout('Read timed out')
+        self.assertEqual(['homo_sapiens_core_110_38'], self.proxy.get('api/dbcopy/srchost', name='mysql'))
+        with self.assertRaises(requests.Timeout):
+            self.proxy.get('api/dbcopy/srchost', name='other')
+
+    def test_oldest_answers_evicted(self):
+        self.proxy.max_entries = 2
+        for name in ('a', 'b', 'c'):
+            self.proxy.get('api/dbcopy/srchost', name=name)
+        self.proxy.get('api/dbcopy/srchost', name='a')
+        self.assertEqual(4, self.session_get.call_count)
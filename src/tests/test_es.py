@@ -0,0 +1,46 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+from unittest import mock
+
+from ensembl.production.handover import es
+
+
+class TestElasticsearchClient(unittest.TestCase):
+
+    def setUp(self):
+        es._client = None
+        es._client_pid = None
+        self.create = mock.patch.object(es, 'create_es_client', side_effect=lambda *a, **kw: mock.Mock()).start()
+        self.addCleanup(mock.patch.stopall)
+        self.addCleanup(setattr, es, '_client', None)
+
+    def test_client_reused(self):
+        with es.ElasticsearchConnection() as first, es.ElasticsearchConnection() as second:
+            self.assertIs(first.client, second.client)
+        self.assertEqual(1, self.create.call_count)
+        self.assertEqual(1, es._client.ping.call_count)
+
+    def test_client_recreated_after_fork(self):
+        client = es.get_es_client()
+        es._client_pid = -1
+        self.assertIsNot(client, es.get_es_client())
+        self.assertEqual(2, self.create.call_count)
+
+    def test_unreachable_cluster(self):
+        self.create.side_effect = lambda *a, **kw: mock.Mock(**{'ping.return_value': False})
+        with self.assertRaises(RuntimeError):
+            es.get_es_client()
+        with self.assertRaises(RuntimeError):
+            es.get_es_client()
+        self.assertEqual(1, self.create.call_count)
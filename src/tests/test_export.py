@@ -0,0 +1,128 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import csv
+import io
+import json
+import unittest
+from unittest import mock
+
+from ensembl.production.handover import export
+from ensembl.production.handover.app import main
+from ensembl.production.handover.celery_app.state import HandoverStateStore
+
+
+def state(token, **fields):
+    return {'handover_token': token, 'database': f'{token}_core_110_1', 'status': 'successful',
+            'message': 'Handover successful', 'report_time': '2023-05-02T12:00:00.000', **fields}
+
+
+def report_hit(token, report_time, msg):
+    return {'_source': {'params': {'handover_token': token}, 'report_time': report_time, 'report_type': 'INFO',
+                        'msg': msg, 'resource': ''}}
+
+
+class FakeStore:
+
+    def __init__(self, pages, reports):
+        self._pages = pages
+        self._reports = reports
+        self.fetched = 0
+
+    def pages(self, query, size):
+        for page in self._pages:
+            self.fetched += 1
+            yield [dict(doc) for doc in page]
+
+    def reports(self, handover_tokens):
+        return iter([hit for hit in self._reports if hit['_source']['params']['handover_token'] in handover_tokens])
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FakeStore(
+            [[state('a', timeline={'datacheck': {'duration': 60.0}}), state('b')], [state('d')]],
+            [report_hit('a', '2023-05-02T10:00:00.000', 'Datachecks in progress'),
+             report_hit('a', '2023-05-02T11:00:00.000', 'Handover successful'),
+             # deleted handover, no longer in the state index
+             report_hit('c', '2023-05-02T10:00:00.000', 'Copying'),
+             report_hit('d', '2023-05-02T10:00:00.000', 'Handover successful')])
+
+    def test_handovers_read_a_page_at_a_time(self):
+        handovers = export.handovers({}, store=self.store)
+        self.assertEqual('a', next(handovers)['handover_token'])
+        self.assertEqual(1, self.store.fetched)
+        self.assertEqual(['b', 'd'], [doc['handover_token'] for doc in handovers])
+
+    def test_reports_matched_to_their_handover(self):
+        a, b, d = export.handovers({}, reports=True, store=self.store)
+        self.assertEqual(['Datachecks in progress', 'Handover successful'], [r['message'] for r in a['reports']])
+        self.assertEqual([], b['reports'])
+        self.assertEqual(['Handover successful'], [r['message'] for r in d['reports']])
+
+    def test_csv(self):
+        with mock.patch.object(export, 'state_store', self.store):
+            rows = list(csv.DictReader(io.StringIO(''.join(export.export({}, 'csv')))))
+        self.assertEqual(['a', 'b', 'd'], [row['handover_token'] for row in rows])
+        self.assertEqual('60.0', rows[0]['datacheck_seconds'])
+        self.assertEqual('', rows[1]['datacheck_seconds'])
+
+    def test_csv_with_reports(self):
+        with mock.patch.object(export, 'state_store', self.store):
+            rows = list(csv.DictReader(io.StringIO(''.join(export.export({}, 'csv', reports=True)))))
+        self.assertEqual(['a', 'a', 'b', 'd'], [row['handover_token'] for row in rows])
+        self.assertEqual('2023-05-02T11:00:00.000', rows[1]['reported_at'])
+        self.assertEqual('', rows[2]['report_message'])
+
+    def test_ndjson(self):
+        with mock.patch.object(export, 'state_store', self.store):
+            lines = list(export.export({}, 'ndjson'))
+        self.assertEqual(['a', 'b', 'd'], [json.loads(line)['handover_token'] for line in lines])
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            export.export({}, 'xlsx')
+
+
+class TestStatePages(unittest.TestCase):
+
+    def test_pages_follow_the_cursor(self):
+        store = HandoverStateStore(index='state')
+        with mock.patch.object(store, 'page', side_effect=[
+            (3, [{'handover_token': 'a'}, {'handover_token': 'b'}], ['b']),
+            (3, [{'handover_token': 'c'}], None),
+        ]) as page:
+            pages = list(store.pages({}, size=2))
+        self.assertEqual([['a', 'b'], ['c']], [[doc['handover_token'] for doc in p] for p in pages])
+        self.assertEqual(['b'], page.call_args[1]['search_after'])
+        self.assertEqual('handover_token', page.call_args[1]['sort'])
+
+
+class TestExportEndpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.client = main.app.test_client()
+        self.store = FakeStore([[state('a')]], [])
+
+    def test_streamed_attachment(self):
+        with mock.patch.object(export, 'state_store', self.store):
+            response = self.client.get('/jobs/export?release=110&format=csv')
+            self.assertEqual(200, response.status_code)
+            self.assertTrue(response.is_streamed)
+            self.assertEqual('text/csv', response.mimetype)
+            self.assertIn('handovers_110.csv', response.headers['Content-Disposition'])
+            self.assertEqual(2, len(response.get_data(as_text=True).splitlines()))
+
+    def test_invalid_parameters(self):
+        self.assertEqual(400, self.client.get('/jobs/export?format=xlsx').status_code)
+        self.assertEqual(400, self.client.get('/jobs/export?release=latest').status_code)
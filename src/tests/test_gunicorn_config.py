@@ -0,0 +1,37 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import importlib.util
+import unittest
+from pathlib import Path
+from unittest import mock
+
+
+class TestGunicornConfig(unittest.TestCase):
+
+    def load(self, **environ):
+        spec = importlib.util.spec_from_file_location('gunicorn_config', Path(__file__).parents[2] / 'gunicorn_config.py')
+        module = importlib.util.module_from_spec(spec)
+        with mock.patch.dict('os.environ', environ):
+            spec.loader.exec_module(module)
+        return module
+
+    def test_defaults(self):
+        with mock.patch('multiprocessing.cpu_count', return_value=2):
+            config = self.load()
+        self.assertEqual(5, config.workers)
+        self.assertEqual('gthread', config.worker_class)
+        self.assertEqual(4, config.threads)
+
+    def test_environment(self):
+        config = self.load(GUNICORN_WORKERS='2', GUNICORN_THREADS='1', GUNICORN_WORKER_CLASS='sync')
+        self.assertEqual((2, 1, 'sync'), (config.workers, config.threads, config.worker_class))
@@ -11,51 +11,17 @@
 #   limitations under the License.
 
 import unittest
+from unittest import mock
 
-from ensembl.production.handover.app.main import valid_handover
-from ensembl.production.handover.celery_app import utils as ut
+from ensembl.production.core.reporting import make_report
+from ensembl.production.handover.app import main
+from ensembl.production.handover.celery_app import tasks, utils as ut
+from ensembl.production.handover.celery_app.state import state_store
 from ensembl.production.handover.celery_app.utils import parse_db_infos
 
 
 class TestHandover(unittest.TestCase):
 
-    def test_valid_handover_valid(self):
-        release = '101'
-        valid_uris = [
-            'mysql://ensro@mysql-ens-vertannot-staging.ebi.ac.uk:4573/ensembl_compara_fungi_48_101',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/ensembl_compara_metazoa_48_101',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/ensembl_compara_pan_homology_48_101',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/ensembl_compara_plants_48_101',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/ensembl_compara_protists_48_101',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/ensembl_compara_bacteria_48_101',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/ensembl_compara_101',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/bacteria_0_collection_core_48_101_1',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/bacteria_100_collection_core_48_101_1',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/bacteria_101_collection_core_48_101_1',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/fungi_ascomycota1_collection_core_48_101_1',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/fungi_ascomycota2_collection_core_48_101_1',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/capra_hircus_core_101_1',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/ovis_aries_core_101_31',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/capra_hircus_core_101_1',
-        ]
-        for uri in valid_uris:
-            doc = {'_source': {'params': {'src_uri': uri}}}
-            try:
-                self.assertTrue(valid_handover(doc, release))
-            except AssertionError as e:
-                raise AssertionError('Invalid Uri: %s' % uri) from e
-
-    def test_valid_handover_invalid(self):
-        release = '101'
-        invalid_uris = [
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/zonotrichia_albicollis_rnaseq_96_101',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/zonotrichia_albicollis_otherfeatures_96_101',
-            'mysql://ensro@mysql-ens-vertannot-staging:4573/zonotrichia_albicollis_core_96_101',
-        ]
-        for uri in invalid_uris:
-            doc = {'_source': {'params': {'src_uri': uri}}}
-            self.assertFalse(valid_handover(doc, release))
-
     def test_valid_core_database(self):
         expect_db_type = 'core'
         dbname = 'zonotrichia_albicollis_core_96_101'
@@ -179,3 +145,93 @@ class ParseDbInfosTest(unittest.TestCase):
         ]
         for src, qualified in zip(src_uri, qualified_src_uri):
             self.assertEqual(qualified, qualified_name(src))
+
+
+class LogAndPublishTest(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = mock.patch.object(ut, 'publisher').start()
+        self.state_writer = mock.patch.object(ut, 'state_writer').start()
+        self.addCleanup(mock.patch.stopall)
+        self.spec = {'handover_token': 'token', 'progress_complete': 0}
+
+    def test_unchanged_progress_published_once(self):
+        for _ in range(3):
+            ut.log_and_publish(make_report('INFO', 'Datachecks in progress', self.spec, 'uri'))
+        self.assertEqual(1, self.publisher.publish.call_count)
+        published = self.publisher.publish.call_args[0][0]
+        self.assertNotIn(ut.REPORT_STATE_KEY, published['params'])
+        self.state_writer.record.assert_called_once_with(published)
+
+    def test_changed_progress_published(self):
+        ut.log_and_publish(make_report('INFO', 'Datachecks in progress', self.spec, 'uri'))
+        self.spec['job_progress'] = {'complete': 10, 'total': 200}
+        ut.log_and_publish(make_report('INFO', 'Datachecks in progress', self.spec, 'uri'))
+        self.spec['progress_complete'] = 1
+        ut.log_and_publish(make_report('INFO', 'Datachecks in progress', self.spec, 'uri'))
+        ut.log_and_publish(make_report('INFO', 'Datachecks successful, starting copy', self.spec, 'uri'))
+        self.assertEqual(4, self.publisher.publish.call_count)
+
+    def test_errors_always_published(self):
+        for _ in range(2):
+            ut.log_and_publish(make_report('ERROR', 'Handover failed', self.spec, 'uri'))
+        self.assertEqual(2, self.publisher.publish.call_count)
+
+    def test_heartbeat(self):
+        report = make_report('INFO', 'Datachecks in progress', self.spec, 'uri')
+        ut.log_and_publish(report)
+        last_time = self.spec[ut.REPORT_STATE_KEY]['time']
+        self.assertTrue(ut.is_duplicate_report(report, now=last_time + 60))
+        with mock.patch.object(ut.cfg, 'report_heartbeat', 1):
+            self.assertFalse(ut.is_duplicate_report(report, now=last_time + 60))
+        with mock.patch.object(ut.cfg, 'report_heartbeat', 0):
+            self.assertTrue(ut.is_duplicate_report(report, now=last_time + 3600 * 24))
+
+
+class DeleteHandoverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = main.app.test_client()
+        self.calls = mock.Mock()
+        for target, name in ((tasks, 'registry'), (tasks, 'AsyncResult'), (tasks, 'log_and_publish'),
+                             (main, 'state_writer'), (main, 'ElasticsearchConnection'), (state_store, 'delete')):
+            self.calls.attach_mock(mock.patch.object(target, name).start(), name)
+        self.addCleanup(mock.patch.stopall)
+        self.calls.AsyncResult.return_value.state = 'STARTED'
+        mock.patch.object(state_store, 'get', return_value={'handover_token': 'token', 'task_id': 'task-1',
+                                                             'database': 'db', 'status': 'running'}).start()
+
+    def test_running_handover_revoked_before_its_state_is_deleted(self):
+        response = self.client.delete('/jobs/token')
+        self.assertEqual(200, response.status_code)
+        self.calls.AsyncResult.assert_called_once_with('task-1')
+        self.calls.AsyncResult.return_value.revoke.assert_called_once_with(terminate=True)
+        self.calls.registry.discard.assert_called_once_with('token')
+        names = [call[0] for call in self.calls.mock_calls]
+        self.assertLess(names.index('log_and_publish'), names.index('state_writer.flush'))
+        self.assertLess(names.index('state_writer.flush'), names.index('delete'))
+
+
+class ListHandoversTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = main.app.test_client()
+        mock.patch.object(main.response_cache, 'ttl', 0).start()
+        self.addCleanup(mock.patch.stopall)
+        self.states = [{'handover_token': token, 'message': 'Copying', 'status': 'running',
+                        'report_time': '2023-05-02T12:00:00.000', 'submission_time': '2023-05-02T10:00:00.000'}
+                       for token in ('a', 'b')]
+
+    def test_unpaged_list(self):
+        with mock.patch.object(state_store, 'pages', return_value=iter([self.states[:1], self.states[1:]])) as pages:
+            response = self.client.get('/jobs?format=json&release=110')
+        self.assertEqual(['a', 'b'], [row['handover_token'] for row in response.get_json()])
+        self.assertEqual('report_time', pages.call_args[1]['sort'])
+
+    def test_paged_list(self):
+        with mock.patch.object(state_store, 'page', return_value=(5, self.states, ['x', 'b'])) as page:
+            response = self.client.get('/jobs?format=json&release=110&limit=2&offset=2')
+        self.assertEqual({'total': 5, 'search_after': ['x', 'b']},
+                         {key: value for key, value in response.get_json().items() if key != 'rows'})
+        self.assertEqual(['a', 'b'], [row['id'] for row in response.get_json()['rows']])
+        self.assertEqual((2, 2), (page.call_args[1]['limit'], page.call_args[1]['offset']))
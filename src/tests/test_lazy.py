@@ -0,0 +1,50 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+from unittest import mock
+
+from ensembl.production.handover import lazy, startup
+from ensembl.production.handover.lazy import Lazy
+
+
+class TestLazy(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = mock.Mock(side_effect=lambda: mock.Mock(uri='http://datacheck/'))
+        self.client = Lazy('test_client', self.factory)
+
+    def test_created_on_first_use(self):
+        self.assertFalse(self.client.created)
+        self.factory.assert_not_called()
+        self.assertEqual('http://datacheck/', self.client.uri)
+        self.client.submit_job('db')
+        self.factory.assert_called_once()
+        self.assertTrue(self.client.created)
+        self.assertIn('test_client', lazy.timings)
+
+    def test_created_again_in_forked_process(self):
+        first = self.client.get()
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertFalse(self.client.created)
+            self.assertIsNot(first, self.client.get())
+        self.assertEqual(2, self.factory.call_count)
+
+
+class TestStartupReport(unittest.TestCase):
+
+    def test_report(self):
+        steps = startup.profile(modules=('ensembl.production.handover.config',), create=True)
+        self.assertEqual(['import ensembl.production.handover.config'] + [f'create {name}' for name in
+                                                                          startup.LAZY_OBJECTS],
+                         [step for step, _ in steps])
+        self.assertTrue(startup.report(steps).splitlines()[-1].startswith('total'))
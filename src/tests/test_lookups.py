@@ -0,0 +1,139 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+from unittest import mock
+
+from sqlalchemy.exc import OperationalError
+
+from ensembl.production.handover import dropdown
+from ensembl.production.handover.app import main
+from ensembl.production.handover.celery_app.lookups import DatabaseListing, DatabaseListingCache
+
+NAMES = ['homo_sapiens_core_110_38', 'homo_sapiens_variation_110_38', 'mus_musculus_core_110_39',
+         'ensembl_compara_110', 'sapiens_test_db']
+
+
+class TestDatabaseListing(unittest.TestCase):
+
+    def setUp(self):
+        self.listing = DatabaseListing(NAMES)
+
+    def test_prefix_matches_first(self):
+        self.assertEqual(['homo_sapiens_core_110_38', 'homo_sapiens_variation_110_38'], self.listing.search('homo'))
+        self.assertEqual(['sapiens_test_db', 'homo_sapiens_core_110_38', 'homo_sapiens_variation_110_38'],
+                         self.listing.search('sapiens'))
+
+    def test_substring_matches(self):
+        self.assertEqual(['homo_sapiens_core_110_38', 'mus_musculus_core_110_39'], self.listing.search('core'))
+        self.assertEqual(['ensembl_compara_110'], self.listing.search('mpa'))
+        self.assertEqual(['mus_musculus_core_110_39'], self.listing.search('_39'))
+        self.assertEqual([], self.listing.search('rattus'))
+
+    def test_short_terms(self):
+        self.assertEqual(['ensembl_compara_110', 'homo_sapiens_core_110_38', 'mus_musculus_core_110_39'],
+                         self.listing.search('co'))
+        self.assertEqual(['sapiens_test_db', 'homo_sapiens_core_110_38', 'homo_sapiens_variation_110_38'],
+                         self.listing.search('sa'))
+
+    def test_limit(self):
+        self.assertEqual(['homo_sapiens_core_110_38'], self.listing.search('homo', limit=1))
+        self.assertEqual(2, len(self.listing.search('110', limit=2)))
+
+
+class TestDatabaseListingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = DatabaseListingCache(ttl=60)
+        self.list_databases = mock.patch('ensembl.production.handover.celery_app.lookups.list_databases',
+                                         return_value=NAMES).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_listing_cached_per_server(self):
+        self.assertTrue(self.cache.database_exists('mysql://ensro@host:3306/homo_sapiens_core_110_38'))
+        self.assertEqual(['ensembl_compara_110'], self.cache.search('mysql://ensro@host:3306/', 'ensembl'))
+        self.list_databases.assert_called_once_with('mysql://ensro@host:3306', None)
+
+    def test_refreshed_after_ttl(self):
+        self.cache.ttl = 0
+        self.cache.search('mysql://ensro@host:3306/', 'homo')
+        self.cache.search('mysql://ensro@host:3306/', 'homo')
+        self.assertEqual(2, self.list_databases.call_count)
+
+    def test_refreshed_on_miss(self):
+        self.cache.search('mysql://ensro@host:3306/', 'homo')
+        self.list_databases.return_value = NAMES + ['rattus_norvegicus_core_110_72']
+        self.assertTrue(self.cache.database_exists('mysql://ensro@host:3306/rattus_norvegicus_core_110_72'))
+        self.assertFalse(self.cache.database_exists('mysql://ensro@host:3306/danio_rerio_core_110_11'))
+        self.assertEqual(3, self.list_databases.call_count)
+
+    def test_least_recently_used_server_dropped(self):
+        self.cache.max_servers = 2
+        for host in ('a', 'b', 'a', 'c'):
+            self.cache.search(f'mysql://ensro@{host}:3306/', 'homo')
+        self.assertEqual(['mysql://ensro@a:3306', 'mysql://ensro@c:3306'], sorted(self.cache._listings))
+
+
+class TestDatabaseDropdown(unittest.TestCase):
+
+    def setUp(self):
+        self.client = main.app.test_client()
+        self.search = mock.patch.object(main.database_listings, 'search', return_value=['homo_sapiens_core_110_38']).start()
+        proxy = mock.Mock()
+        mock.patch.object(main, 'dropdown_proxy', proxy).start()
+        mock.patch.object(dropdown, 'dropdown_proxy', proxy).start()
+        self.get = proxy.get
+        self.get.side_effect = self.dbcopy
+        self.databases = ['mus_musculus_core_110_39']
+        mock.patch.object(dropdown.cfg, 'dropdown_mysql_user', 'ensro').start()
+        mock.patch.object(dropdown.cfg, 'dropdown_mysql_servers', 'configured:4242').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def dbcopy(self, path, **params):
+        if path == 'api/dbcopy/srchost':
+            hosts = [{'name': 'host', 'port': 3306, 'mysql_user': 'ensro', 'active': True}]
+            return {'count': 1, 'results': [item for item in hosts if item['name'] == params['name']]}
+        return self.databases
+
+    def test_answered_from_listing(self):
+        response = self.client.get('/jobs/dropdown/databases/host/3306?search=homo')
+        self.assertEqual(['homo_sapiens_core_110_38'], response.get_json())
+        self.search.assert_called_once_with('mysql://ensro@host:3306/', 'homo', 50)
+        self.get.assert_called_once_with('api/dbcopy/srchost', name='host')
+
+    def test_configured_server_listed(self):
+        self.client.get('/jobs/dropdown/databases/configured/4242?search=homo&limit=10')
+        self.search.assert_called_once_with('mysql://ensro@configured:4242/', 'homo', 10)
+        self.get.assert_not_called()
+
+    def test_client_user_ignored(self):
+        self.client.get('/jobs/dropdown/databases/host/3306?search=homo&user=root:secret')
+        self.search.assert_called_once_with('mysql://ensro@host:3306/', 'homo', 50)
+
+    def test_unknown_server_proxied(self):
+        for path in ('/jobs/dropdown/databases/internal/3306?search=mus',
+                     '/jobs/dropdown/databases/host/3307?search=mus'):
+            response = self.client.get(path)
+            self.assertEqual(['mus_musculus_core_110_39'], response.get_json())
+        self.search.assert_not_called()
+        self.get.assert_called_with('api/dbcopy/databases/host/3307', search='mus')
+
+    def test_proxied_when_server_unreachable(self):
+        self.search.side_effect = OperationalError('SHOW DATABASES', {}, Exception('Unknown host'))
+        response = self.client.get('/jobs/dropdown/databases/host/3306?search=mus')
+        self.assertEqual(['mus_musculus_core_110_39'], response.get_json())
+
+    def test_invalid_limit(self):
+        for limit in ('-1', '0', 'ten', '100000'):
+            response = self.client.get(f'/jobs/dropdown/databases/host/3306?search=homo&limit={limit}')
+            self.assertEqual(400, response.status_code)
+        self.search.assert_not_called()
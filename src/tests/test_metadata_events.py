@@ -0,0 +1,149 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import threading
+import unittest
+from unittest import mock
+
+from sqlalchemy.exc import OperationalError
+
+from ensembl.production.handover.celery_app import tasks, utils
+
+
+def event(genome, databases=None, event_type='new_genebuild'):
+    return {'genome': genome, 'type': event_type,
+            'details': json.dumps({'current_database_list': databases} if databases is not None else {})}
+
+
+class TestProcessMetadataEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.spec = {'tgt_uri': 'mysql://ensadmin@staging:3306/species_collection_core_57_110_1',
+                     'staging_uri': 'mysql://ensadmin@staging:3306/', 'handover_token': 'token'}
+        self.publish = mock.patch.object(utils, 'log_and_publish').start()
+        self.drop = mock.patch.object(utils, 'drop_databases', side_effect=lambda server, batch: (batch, {})).start()
+        self.email = mock.patch.object(utils, 'send_email').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_drops_batched_in_parallel(self):
+        events = [event(f'species_{i}', [f'species_{i}_core_57_109_1', 'shared_core_57_109_1']) for i in range(5)]
+        with mock.patch.object(utils.cfg, 'drop_concurrency', 2):
+            outcome = utils.process_metadata_events(self.spec, events)
+        self.assertEqual(2, self.drop.call_count)
+        self.assertEqual(6, len(outcome['dropped']))
+        self.assertEqual(sorted(set(outcome['dropped'])), sorted(outcome['dropped']))
+        self.assertEqual({}, outcome['errors'])
+
+    def test_new_database_kept(self):
+        utils.process_metadata_events(self.spec, [event('species', ['species_collection_core_57_110_1'])])
+        self.drop.assert_not_called()
+
+    def test_single_blat_notification(self):
+        events = [event('homo_sapiens', event_type='new_assembly'), event('mus_musculus', event_type='new_assembly'),
+                  event('zea_mays', event_type='new_assembly')]
+        outcome = utils.process_metadata_events(self.spec, events)
+        self.email.assert_called_once()
+        self.assertIn('homo_sapiens, mus_musculus', self.email.call_args.kwargs['body'])
+        self.assertEqual(['homo_sapiens', 'mus_musculus'], outcome['blat_species'])
+
+    def test_errors_reported_per_item(self):
+        self.drop.side_effect = lambda server, batch: ([], {database: 'Access denied' for database in batch})
+        events = [{'genome': 'broken', 'type': 'new_genebuild', 'details': 'not json'},
+                  event('species', ['species_core_57_109_1'])]
+        outcome = utils.process_metadata_events(self.spec, events)
+        self.assertEqual({'broken', 'species_core_57_109_1'}, set(outcome['errors']))
+        self.assertEqual('WARNING', self.publish.call_args_list[0][0][0]['report_type'])
+
+    def test_published_from_the_calling_thread(self):
+        threads = []
+        self.publish.side_effect = lambda report: threads.append(threading.get_ident())
+        self.drop.side_effect = lambda server, batch: (batch[1:], {batch[0]: 'Access denied'})
+        events = [event(f'species_{i}', [f'species_{i}_core_57_109_1']) for i in range(4)]
+        with mock.patch.object(utils.cfg, 'drop_concurrency', 2):
+            outcome = utils.process_metadata_events(self.spec, events)
+        self.assertEqual({threading.get_ident()}, set(threads))
+        self.assertEqual(2, len(outcome['dropped']))
+        self.assertEqual(2, len(outcome['errors']))
+        self.assertEqual(['INFO', 'INFO', 'WARNING', 'WARNING'],
+                         sorted(call[0][0]['report_type'] for call in self.publish.call_args_list))
+
+
+class TestDropDatabases(unittest.TestCase):
+
+    def setUp(self):
+        self.publish = mock.patch.object(utils, 'log_and_publish').start()
+        self.listings = mock.patch.object(utils, 'database_listings').start()
+        self.listings.listing.return_value = {'species_core_109_1', 'species_otherfeatures_109_1'}
+        self.connection = mock.patch.object(utils, 'engines').start().engine.return_value.connect.return_value \
+            .__enter__.return_value.execution_options.return_value
+        self.addCleanup(mock.patch.stopall)
+
+    def test_existing_databases_dropped_on_one_connection(self):
+        self.connection.execute.side_effect = [None, RuntimeError('Access denied')]
+        dropped, errors = utils.drop_databases('mysql://ensadmin@staging:3306/',
+                                               ['species_core_109_1', 'missing_core_109_1',
+                                                'species_otherfeatures_109_1'])
+        self.assertEqual(['species_core_109_1'], dropped)
+        self.assertEqual({'species_otherfeatures_109_1': 'Access denied'}, errors)
+        self.assertEqual('DROP DATABASE `species_core_109_1`', str(self.connection.execute.call_args_list[0][0][0]))
+        self.listings.invalidate.assert_called_once_with('mysql://ensadmin@staging:3306/')
+        self.publish.assert_not_called()
+
+    def test_databases_left_reported_when_connection_lost(self):
+        lost = OperationalError('DROP DATABASE', {}, Exception('Lost connection'), connection_invalidated=True)
+        self.listings.listing.return_value = {'species_core_109_1', 'species_otherfeatures_109_1',
+                                              'species_rnaseq_109_1'}
+        self.connection.execute.side_effect = [None, lost]
+        dropped, errors = utils.drop_databases('mysql://ensadmin@staging:3306/',
+                                               ['species_core_109_1', 'species_otherfeatures_109_1',
+                                                'species_rnaseq_109_1'])
+        self.assertEqual(['species_core_109_1'], dropped)
+        self.assertEqual({'species_otherfeatures_109_1', 'species_rnaseq_109_1'}, set(errors))
+        self.listings.invalidate.assert_called_once_with('mysql://ensadmin@staging:3306/')
+
+
+class TestMetadataEventsTask(unittest.TestCase):
+
+    def setUp(self):
+        self.spec = {'tgt_uri': 'mysql://ensadmin@staging:3306/species_core_110_1', 'db_type': 'core',
+                     'staging_uri': 'mysql://ensadmin@staging:3306/', 'handover_token': 'token',
+                     'metadata_job_id': 'meta-1'}
+        self.events = [event('species', ['species_core_110_0'])]
+        self.publish = mock.patch.object(tasks, 'log_and_publish').start()
+        mock.patch.object(tasks.cfg, 'dispatch_targets', {}).start()
+        mock.patch.object(tasks.cfg, 'dispatch_all', False).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_events_processed_by_their_own_task(self):
+        with mock.patch.object(tasks, 'submit_metadata_update', return_value='meta-1'), \
+                mock.patch.object(tasks.metadata_client, 'retrieve_job', create=True,
+                                  return_value={'status': 'complete', 'output': {'events': self.events}}), \
+                mock.patch.object(tasks, 'process_metadata_events') as process, \
+                mock.patch.object(tasks.metadata_update_task, 'replace') as replace:
+            tasks.metadata_update_task.run(self.spec)
+        process.assert_not_called()
+        replacement = replace.call_args[0][0]
+        self.assertEqual(tasks.metadata_events_task.name, replacement.task)
+        self.assertEqual((self.spec, self.events), tuple(replacement.args))
+
+    def test_errors_reported_before_completion(self):
+        with mock.patch.object(tasks, 'process_metadata_events',
+                               return_value={'dropped': [], 'errors': {'species_core_110_0': 'access denied'},
+                                             'blat_species': []}) as process:
+            tasks.metadata_events_task.run(self.spec, self.events)
+        process.assert_called_once_with(self.spec, self.events)
+        reports = [call[0][0] for call in self.publish.call_args_list]
+        self.assertEqual('WARNING', reports[0]['report_type'])
+        self.assertIn('species_core_110_0: access denied', reports[0]['msg'])
+        self.assertEqual('Metadata load complete, Handover successful', reports[-1]['msg'])
+        self.assertEqual(3, self.spec['progress_complete'])
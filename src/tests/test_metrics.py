@@ -0,0 +1,75 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+from unittest import mock
+
+from ensembl.production.handover import metrics
+from ensembl.production.handover.app import main
+from ensembl.production.handover.es import es_endpoint
+
+
+def sample(name, **labels):
+    return metrics.registry().get_sample_value(name, labels) or 0
+
+
+class TestInstrumentedClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = metrics.InstrumentedClient('test', mock.Mock(uri='http://dc/', **{
+            'retrieve_job.return_value': {'status': 'running'},
+            'submit_job.side_effect': ConnectionError('refused')
+        }))
+
+    def test_calls_forwarded(self):
+        self.assertEqual({'status': 'running'}, self.client.retrieve_job(1))
+        self.assertEqual('http://dc/', self.client.uri)
+        with self.assertRaises(ConnectionError):
+            self.client.submit_job('db')
+
+    @unittest.skipUnless(metrics.enabled, 'prometheus_client is not installed')
+    def test_latency_and_errors_recorded(self):
+        calls = sample('handover_client_request_seconds_count', client='test', method='retrieve_job')
+        errors = sample('handover_client_errors_total', client='test', method='submit_job')
+        self.client.retrieve_job(1)
+        with self.assertRaises(ConnectionError):
+            self.client.submit_job('db')
+        self.assertEqual(calls + 1, sample('handover_client_request_seconds_count', client='test',
+                                           method='retrieve_job'))
+        self.assertEqual(errors + 1, sample('handover_client_errors_total', client='test', method='submit_job'))
+
+
+class TestEsEndpoint(unittest.TestCase):
+
+    def test_ids_and_indices_left_out(self):
+        self.assertEqual('POST _search', es_endpoint('POST', '/handover_state/_search'))
+        self.assertEqual('POST _update', es_endpoint('POST', '/handover_state/_doc/token-1/_update'))
+        self.assertEqual('GET _doc', es_endpoint('GET', '/handover_state/_doc/token-1'))
+        self.assertEqual('HEAD index', es_endpoint('HEAD', '/handover_pending'))
+        self.assertEqual('HEAD /', es_endpoint('HEAD', '/'))
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.client = main.app.test_client()
+
+    @unittest.skipUnless(metrics.enabled, 'prometheus_client is not installed')
+    def test_metrics_exported(self):
+        self.client.get('/ping')
+        response = self.client.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertIn('handover_http_request_seconds_count{endpoint="ping"', response.get_data(as_text=True))
+
+    def test_metrics_disabled(self):
+        with mock.patch.object(metrics, 'enabled', False):
+            self.assertEqual(404, self.client.get('/metrics').status_code)
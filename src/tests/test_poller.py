@@ -0,0 +1,67 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+from unittest import mock
+
+from ensembl.production.core.clients.datachecks import DatacheckClient
+from ensembl.production.core.clients.dbcopy import DbCopyRestClient
+
+from ensembl.production.handover import metrics, tracing
+from ensembl.production.handover.celery_app.poller import JobStatusPoller
+
+dc_client = metrics.InstrumentedClient('datacheck', DatacheckClient('http://datacheck:5001/datacheck/'))
+copy_client = metrics.InstrumentedClient('dbcopy', DbCopyRestClient('http://dbcopy:8000/api/dbcopy/requestjob'))
+
+
+class TestJobStatusPoller(unittest.TestCase):
+
+    def setUp(self):
+        self.poller = JobStatusPoller(concurrency=4, bulk_stages=['datacheck'])
+        self.get = mock.patch.object(self.poller, '_get').start()
+        self.addCleanup(mock.patch.stopall)
+        self.clients = {'datacheck': dc_client, 'dbcopy': copy_client, 'dispatch': copy_client}
+
+    def test_one_request_per_job(self):
+        self.get.side_effect = lambda uri: {'overall_status': 'Running', 'uri': uri}
+        results = self.poller.poll([('dbcopy', 'a'), ('dispatch', 'b'), ('dbcopy', 'a')], self.clients.get)
+        self.assertEqual(2, self.get.call_count)
+        self.assertEqual('http://dbcopy:8000/api/dbcopy/requestjob/a', results[('dbcopy', 'a')]['uri'])
+        self.assertEqual('http://dbcopy:8000/api/dbcopy/requestjob/b', results[('dispatch', 'b')]['uri'])
+
+    def test_bulk_listing(self):
+        self.get.return_value = [{'id': 1, 'status': 'running'}, {'id': 2, 'status': 'complete'},
+                                 {'id': 3, 'status': 'failed'}]
+        results = self.poller.poll([('datacheck', 1), ('datacheck', 2)], self.clients.get)
+        self.get.assert_called_once_with('http://datacheck:5001/datacheck/jobs')
+        self.assertEqual('running', results[('datacheck', '1')]['status'])
+        self.assertEqual('complete', results[('datacheck', '2')]['status'])
+
+    def test_bulk_listing_missing_jobs_are_retrieved(self):
+        self.get.side_effect = [[{'id': 1, 'status': 'running'}], {'id': 4, 'status': 'complete'}]
+        results = self.poller.poll([('datacheck', 1), ('datacheck', 4)], self.clients.get)
+        self.assertEqual(2, self.get.call_count)
+        self.assertEqual('complete', results[('datacheck', '4')]['status'])
+
+    def test_errors_are_returned(self):
+        self.get.side_effect = RuntimeError('404 Not Found')
+        results = self.poller.poll([('dbcopy', 'a')], self.clients.get)
+        self.assertIsInstance(results[('dbcopy', 'a')], RuntimeError)
+
+    def test_requests_recorded_through_the_clients(self):
+        self.get.return_value = {'overall_status': 'Running'}
+        exporter = tracing.MemoryExporter()
+        with mock.patch.object(tracing, 'exporter', exporter), mock.patch.object(metrics, 'client_seconds') as seconds:
+            with tracing.trace('15ce20fd-68cd-11e8-8117-005056ab00f0', 'watcher tick'):
+                self.poller.poll([('dbcopy', 'a')], self.clients.get)
+        seconds.labels.assert_called_once_with('dbcopy', 'retrieve_job')
+        self.assertEqual(['dbcopy.retrieve_job', 'watcher tick'], [span['name'] for span in exporter.spans()])
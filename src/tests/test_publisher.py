@@ -0,0 +1,82 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+from unittest import mock
+
+from kombu import Connection, Exchange, Queue
+
+from ensembl.production.core.reporting import ReportFormatter, make_report
+from ensembl.production.handover.celery_app.publisher import ReportPublisher
+
+
+class TestReportPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = ReportPublisher('memory://', 'test_report_exchange', formatter=ReportFormatter('handover'),
+                                         batch_size=10, flush_interval=0.05)
+        self.addCleanup(self.publisher.close)
+        self.connection = Connection('memory://')
+        self.queue = Queue('test_reports', Exchange('test_report_exchange', type='topic'), routing_key='report.#')
+        self.queue(self.connection.channel()).declare()
+        self.queue(self.connection.channel()).purge()
+
+    def test_publish_and_flush(self):
+        for i in range(25):
+            self.publisher.publish(make_report('INFO', f'report {i}', {'handover_token': 'token'}), 'report.info')
+        self.publisher.close()
+        stats = self.publisher.stats()
+        self.assertEqual(25, stats['published'])
+        self.assertEqual(0, stats['queue_depth'])
+        self.assertEqual(0, stats['dropped'])
+        bound = self.queue(self.connection.channel())
+        messages = [bound.get(no_ack=True) for _ in range(25)]
+        self.assertEqual('report 0', messages[0].payload['message'])
+        self.assertEqual('handover', messages[0].payload['process'])
+
+    def test_queue_full_drops(self):
+        publisher = ReportPublisher('memory://', 'test_report_exchange', max_queue=2)
+        with mock.patch.object(publisher, '_ensure_started'):
+            for i in range(5):
+                publisher.publish({'msg': i}, 'report.info')
+        self.assertEqual(3, publisher.stats()['dropped'])
+        self.assertEqual(2, publisher.stats()['queue_depth'])
+
+    def test_failed_batch_is_retried(self):
+        with mock.patch.object(ReportPublisher, '_connect', side_effect=[OSError('Connection refused'),
+                                                                           mock.DEFAULT],
+                               wraps=self.publisher._connect), mock.patch('time.sleep'):
+            self.publisher.publish(make_report('INFO', 'report', {}), 'report.info')
+            self.publisher.close()
+        stats = self.publisher.stats()
+        self.assertEqual(1, stats['failed_batches'])
+        self.assertEqual(1, stats['published'])
+
+    def test_only_nacked_messages_republished(self):
+        producer = mock.Mock()
+
+        def confirm():
+            # the broker rejects the second message of the first batch and confirms everything else
+            if self.publisher._delivery_tag == 3:
+                self.publisher._on_nack(2, False)
+            self.publisher._on_ack(self.publisher._delivery_tag, True)
+
+        self.publisher._confirms = True
+        with mock.patch.object(self.publisher, '_connect', return_value=producer), \
+                mock.patch.object(self.publisher, '_wait_for_confirms', side_effect=confirm), \
+                mock.patch('time.sleep'):
+            self.publisher._send([({'msg': i}, 'report.info', 0) for i in range(3)])
+        self.assertEqual([0, 1, 2, 1], [c[0][0]['msg'] for c in producer.publish.call_args_list])
+        stats = self.publisher.stats()
+        self.assertEqual(3, stats['published'])
+        self.assertEqual(1, stats['failed_batches'])
+        self.assertEqual(0, stats['reconnections'])
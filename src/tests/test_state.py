@@ -0,0 +1,273 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+import unittest
+from unittest import mock
+
+from ensembl.production.core.reporting import make_report
+
+from ensembl.production.handover.app import main
+from ensembl.production.handover.celery_app.state import HandoverStateStore, StateWriter, database_releases, \
+    handover_status, stage_timeline
+
+
+class TestHandoverState(unittest.TestCase):
+
+    def setUp(self):
+        self.spec = {'handover_token': 'token', 'database': 'homo_sapiens_core_110_38', 'contact': 'me@ebi.ac.uk',
+                     'comment': 'new assembly', 'src_uri': 'mysql://ensro@host:3306/homo_sapiens_core_110_38',
+                     'progress_complete': 2, 'progress_total': 3, 'other': 'not kept'}
+        self.store = HandoverStateStore(index='state')
+
+    def test_database_releases(self):
+        self.assertEqual([110], database_releases('homo_sapiens_core_110_38'))
+        self.assertEqual([110, 57], database_releases('arabidopsis_thaliana_core_57_110_11'))
+        self.assertEqual([110], database_releases('ensembl_compara_110'))
+        self.assertEqual([], database_releases('ensembl_website'))
+        self.assertEqual([], database_releases(None))
+
+    def test_state_from_report(self):
+        state = self.store.from_report(make_report('INFO', 'Copying', self.spec))
+        self.assertEqual('token', state['handover_token'])
+        self.assertEqual('Copying', state['message'])
+        self.assertEqual([110], state['release'])
+        self.assertEqual(2, state['progress_complete'])
+        self.assertNotIn('other', state)
+        self.assertIn('report_time', state)
+
+    def test_ignored_reports(self):
+        self.assertIsNone(self.store.from_report(make_report('DEBUG', 'Copying', self.spec)))
+        self.assertIsNone(self.store.from_report(make_report('INFO', 'Starting', {'database': 'db'})))
+
+    def test_bulk_upsert_merges_updates(self):
+        first = self.store.from_report(make_report('INFO', 'Datachecks in progress', self.spec))
+        first['report_time'] = '2023-05-02T10:00:00.000'
+        second = self.store.from_report(make_report('INFO', 'Copying', self.spec))
+        with mock.patch.object(self.store, 'connect') as connect:
+            bulk = connect.return_value.__enter__.return_value.client.bulk
+            bulk.return_value = {'items': [{'update': {'_id': 'token', 'error': 'version conflict'}}]}
+            self.assertEqual(1, self.store.bulk_upsert([first, second]))
+        action, update = bulk.call_args[1]['body']
+        self.assertEqual('token', action['update']['_id'])
+        self.assertEqual('Copying', update['script']['params']['state']['message'])
+        self.assertNotIn('submission_time', update['script']['params']['state'])
+        self.assertEqual('2023-05-02T10:00:00.000', update['upsert']['submission_time'])
+
+    def test_reports_written_out_of_order(self):
+        running = self.store.from_report(make_report('INFO', 'Copying', self.spec))
+        running['report_time'] = '2023-05-02T10:00:00.000'
+        successful = self.store.from_report(make_report('INFO', 'Handover successful', self.spec))
+        successful['report_time'] = '2023-05-02T11:00:00.000'
+        with mock.patch.object(self.store, 'connect') as connect:
+            bulk = connect.return_value.__enter__.return_value.client.bulk
+            bulk.return_value = {'items': []}
+            self.store.bulk_upsert([successful, running])
+            _, merged = bulk.call_args[1]['body']
+            self.store.bulk_upsert([running])
+            _, late = bulk.call_args[1]['body']
+        # merged in report time order within a batch
+        self.assertEqual('successful', merged['script']['params']['state']['status'])
+        self.assertEqual('2023-05-02T10:00:00.000', merged['upsert']['submission_time'])
+        # and dropped by elasticsearch when older than the stored state
+        self.assertIn("params.state.report_time.compareTo(ctx._source.report_time) < 0) { ctx.op = 'none' }",
+                      late['script']['source'])
+        self.assertEqual('2023-05-02T10:00:00.000', late['script']['params']['state']['report_time'])
+
+    def test_celery_task_id_from_state(self):
+        state = self.store.from_report(make_report('INFO', 'Copying', {**self.spec, 'task_id': 'task-1',
+                                                                        'staging_uri': 'mysql://staging:3306/'}))
+        with mock.patch.object(self.store, 'get', return_value=state):
+            status = self.store.get_celery_task_id('token')
+        self.assertEqual('task-1', status['task_id'])
+        self.assertEqual('mysql://staging:3306/', status['spec']['staging_uri'])
+        self.assertNotIn('message', status['spec'])
+        with mock.patch.object(self.store, 'get', return_value=None):
+            self.assertFalse(self.store.get_celery_task_id('token')['status'])
+
+
+class TestStateWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.spec = {'handover_token': 'token', 'database': 'homo_sapiens_core_110_38'}
+        self.store = HandoverStateStore(index='state')
+        self.bulk_upsert = mock.patch.object(self.store, 'bulk_upsert').start()
+        self.addCleanup(mock.patch.stopall)
+        self.written = []
+
+    def test_updates_written_in_background(self):
+        writer = StateWriter(self.store, flush_interval=0.01, on_write=self.written.append)
+        self.addCleanup(writer.close)
+        for msg in ('Datachecks in progress', 'Copying'):
+            writer.record(make_report('INFO', msg, self.spec))
+        writer.record(make_report('DEBUG', 'Polling', self.spec))
+        writer.close()
+        states = [state for call in self.bulk_upsert.call_args_list for state in call[0][0]]
+        self.assertEqual(['Datachecks in progress', 'Copying'], [state['message'] for state in states])
+        self.assertIn('token', self.written)
+
+    def test_flush_waits_for_the_queued_updates(self):
+        writer = StateWriter(self.store, flush_interval=0.01)
+        self.addCleanup(writer.close)
+        writer.record(make_report('INFO', 'Handover failed, Job Revoked', self.spec))
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual('Handover failed, Job Revoked', self.bulk_upsert.call_args[0][0][0]['message'])
+
+    def test_written_straight_away_when_queue_full(self):
+        writer = StateWriter(self.store, max_queue=1, on_write=self.written.append)
+        writer._ensure_started = mock.Mock()
+        writer.record(make_report('INFO', 'Datachecks in progress', self.spec))
+        writer.record(make_report('INFO', 'Copying', self.spec))
+        self.assertEqual('Copying', self.bulk_upsert.call_args[0][0][0]['message'])
+        self.assertEqual(['token'], self.written)
+
+    def test_write_never_raises(self):
+        self.bulk_upsert.side_effect = RuntimeError('Cannot connect')
+        writer = StateWriter(self.store, background=False, on_write=self.written.append)
+        writer.record(make_report('ERROR', 'Copy failed', self.spec))
+        self.assertEqual(['token'], self.written)
+
+
+class TestHandoverStatePage(unittest.TestCase):
+
+    def setUp(self):
+        self.store = HandoverStateStore(index='state')
+        connect = mock.patch.object(self.store, 'connect').start()
+        self.addCleanup(mock.patch.stopall)
+        self.search = connect.return_value.__enter__.return_value.client.search
+        self.search.return_value = {'hits': {'total': 3, 'hits': [
+            {'_source': {'handover_token': 'a'}, 'sort': [2, 'a']},
+            {'_source': {'handover_token': 'b'}, 'sort': [1, 'b']},
+        ]}}
+
+    def test_status(self):
+        self.assertEqual('successful', handover_status('INFO', 'Metadata load complete, Handover successful'))
+        self.assertEqual('failed', handover_status('INFO', 'Datachecks found problems, you can view the failures'))
+        self.assertEqual('failed', handover_status('ERROR', 'Database dispatch error'))
+        self.assertEqual('running', handover_status('INFO', 'Datachecks successful, starting copy'))
+
+    def test_filter_query(self):
+        query = self.store.filter_query(release='110', status='failed', db_type='core', date_from='2023-01-01',
+                                        search='homo')
+        self.assertIn({"term": {"release": 110}}, query['bool']['filter'])
+        self.assertIn({"term": {"status.keyword": 'failed'}}, query['bool']['filter'])
+        self.assertIn({"term": {"db_type.keyword": 'core'}}, query['bool']['filter'])
+        self.assertIn({"range": {"submission_time": {"gte": '2023-01-01'}}}, query['bool']['filter'])
+        self.assertEqual('homo', query['bool']['must'][0]['multi_match']['query'])
+
+    def test_page_returns_cursor(self):
+        total, docs, cursor = self.store.page({}, limit=2)
+        self.assertEqual(3, total)
+        self.assertEqual(['a', 'b'], [doc['handover_token'] for doc in docs])
+        self.assertEqual([1, 'b'], cursor)
+        total, docs, cursor = self.store.page({}, limit=2, search_after=cursor)
+        body = self.search.call_args[1]['body']
+        self.assertEqual([1, 'b'], body['search_after'])
+        self.assertNotIn('from', body)
+
+    def test_last_page(self):
+        total, docs, cursor = self.store.page({}, sort='contact', order='asc', limit=10, offset=20)
+        self.assertIsNone(cursor)
+        body = self.search.call_args[1]['body']
+        self.assertEqual(20, body['from'])
+        self.assertEqual({'contact.keyword': {'order': 'asc'}}, body['sort'][0])
+
+    def test_invalid_sort(self):
+        with self.assertRaises(ValueError):
+            self.store.page({}, sort='password')
+        with self.assertRaises(ValueError):
+            self.store.page({}, order='sideways')
+
+
+class TestStageTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.state = {'handover_token': 'token', 'status': 'running', 'report_time': '2023-05-02T12:00:00.000',
+                      'submission_time': '2023-05-02T09:59:00.000', 'timeline': {
+                          'dbcopy': {'start': '2023-05-02T11:00:00', 'polls': 4, 'job_id': 'copy-1'},
+                          'datacheck': {'start': '2023-05-02T10:00:00', 'end': '2023-05-02T10:30:00',
+                                        'duration': 1800.0, 'polls': 12, 'job_id': '42'},
+                      }}
+
+    def test_stages_in_running_order(self):
+        now = datetime.datetime(2023, 5, 2, 11, 15)
+        datacheck, dbcopy = stage_timeline(self.state, now)
+        self.assertEqual({'stage': 'datacheck', 'start': '2023-05-02T10:00:00', 'end': '2023-05-02T10:30:00',
+                          'duration': 1800.0, 'polls': 12, 'job_id': '42', 'running': False}, datacheck)
+        self.assertEqual('dbcopy', dbcopy['stage'])
+        self.assertTrue(dbcopy['running'])
+        self.assertEqual(900, dbcopy['duration'])
+
+    def test_unfinished_stage_of_failed_handover(self):
+        self.state['status'] = 'failed'
+        dbcopy = stage_timeline(self.state)[1]
+        self.assertFalse(dbcopy['running'])
+        self.assertEqual(3600, dbcopy['duration'])
+
+    def test_no_timeline(self):
+        self.assertEqual([], stage_timeline({'status': 'running', 'report_time': '2023-05-02T12:00:00.000'}))
+
+    def test_timeline_endpoint(self):
+        client = main.app.test_client()
+        with mock.patch.object(main.state_store, 'get', return_value=self.state), \
+                mock.patch.object(main.response_cache, 'ttl', 0):
+            timeline = client.get('/jobs/token/timeline').get_json()
+        self.assertEqual('running', timeline['status'])
+        self.assertEqual(['datacheck', 'dbcopy'], [stage['stage'] for stage in timeline['stages']])
+        with mock.patch.object(main.state_store, 'get', return_value=None), \
+                mock.patch.object(main.response_cache, 'ttl', 0):
+            self.assertEqual(404, client.get('/jobs/unknown/timeline').status_code)
+
+
+class TestStageLatencies(unittest.TestCase):
+
+    def test_latencies_from_aggregations(self):
+        store = HandoverStateStore(index='state')
+        with mock.patch.object(store, 'connect') as connect:
+            search = connect.return_value.__enter__.return_value.client.search
+            search.return_value = {'aggregations': {
+                'datacheck': {'doc_count': 2, 'duration': {'avg': 1500.0, 'max': 1800.0},
+                              'percentiles': {'values': {'50.0': 1500.0, '90.0': 1740.0, '99.0': 1794.0}},
+                              'polls': {'value': 10.5}},
+                'dbcopy': {'doc_count': 0, 'duration': {'avg': None, 'max': None},
+                           'percentiles': {'values': {'50.0': None, '90.0': None, '99.0': None}},
+                           'polls': {'value': None}},
+            }}
+            latencies = store.stage_latencies(store.filter_query(release='110'))
+        self.assertEqual({'datacheck': {'count': 2, 'mean': 1500.0, 'max': 1800.0, 'p50': 1500.0, 'p90': 1740.0,
+                                        'p99': 1794.0, 'mean_polls': 10.5}}, latencies)
+        body = search.call_args[1]['body']
+        self.assertEqual(0, body['size'])
+        self.assertEqual({'exists': {'field': 'timeline.dispatch.duration'}}, body['aggs']['dispatch']['filter'])
+
+
+class TestStatusUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.client = main.app.test_client()
+        es = mock.patch.object(main, 'ElasticsearchConnection').start().return_value.__enter__.return_value
+        es.client.search.return_value = {'hits': {'hits': [{'_id': 'report-1', '_source': {
+            'params': {'handover_token': 'token', 'database': 'homo_sapiens_core_110_38'},
+            'report_type': 'INFO', 'msg': 'Metadata load failed, please see', 'message': 'Metadata load failed',
+            'report_time': '2023-05-02T12:00:00.000'}}]}}
+        es.client.update.return_value = {'result': 'updated'}
+        self.upsert = mock.patch.object(main.state_store, 'upsert').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_state_successful(self):
+        response = self.client.put('/jobs/status', json={'handover_token': 'token'})
+        self.assertEqual(200, response.status_code)
+        state = self.upsert.call_args[0][0]
+        self.assertEqual('token', state['handover_token'])
+        self.assertEqual('successful', state['status'])
+        self.assertEqual('Metadata load complete, Handover successful', state['message'])
+        self.assertEqual([110], state['release'])
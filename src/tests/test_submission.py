@@ -0,0 +1,161 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+import unittest
+import uuid
+from unittest import mock
+
+from elasticsearch import ConflictError, NotFoundError
+from ensembl.production.core.reporting import make_report
+
+from ensembl.production.handover.celery_app import tasks, utils
+from ensembl.production.handover.celery_app.state import DatabaseReservations
+from ensembl.production.handover.celery_app.utils import check_handover_spec
+
+
+class TestAsyncSubmission(unittest.TestCase):
+
+    def setUp(self):
+        self.spec = {'src_uri': 'mysql://user@host:3306/homo_sapiens_core_110_38', 'contact': 'me@ebi.ac.uk',
+                     'comment': 'new assembly'}
+        mock.patch.object(tasks.cfg, 'submission_mode', 'async').start()
+        self.publish = mock.patch.object(tasks, 'log_and_publish').start()
+        self.delay = mock.patch.object(tasks.validate_handover_task, 'delay').start()
+        self.reserve = mock.patch.object(tasks.reservations, 'reserve', return_value=None).start()
+        self.release = mock.patch.object(tasks.reservations, 'release').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_check_handover_spec(self):
+        self.assertEqual('homo_sapiens_core_110_38', check_handover_spec(dict(self.spec))['database'])
+        with self.assertRaises(ValueError):
+            check_handover_spec({'src_uri': 'mysql://user@host:3306/homo_sapiens_website_110'})
+        with self.assertRaises(ValueError):
+            check_handover_spec({'src_uri': 'mysql://user@host:3306/'})
+
+    def test_token_returned_before_validation(self):
+        with mock.patch.object(tasks, 'validate_handover') as validate:
+            token = tasks.submit_handover(self.spec)
+        validate.assert_not_called()
+        spec = self.delay.call_args[0][0]
+        self.assertEqual(token, spec['handover_token'])
+        self.assertEqual('INFO', self.publish.call_args[0][0]['report_type'])
+        self.reserve.assert_called_once_with('homo_sapiens_core_110_38', token)
+
+    def test_database_reserved_by_another_submission(self):
+        self.reserve.return_value = 'other-token'
+        with self.assertRaisesRegex(ValueError, 'already submitted with handover: other-token'):
+            tasks.submit_handover(self.spec)
+        self.delay.assert_not_called()
+        self.publish.assert_not_called()
+
+    def test_later_submissions_ignored_by_resubmit_check(self):
+        first, second = str(uuid.uuid1()), str(uuid.uuid1())
+        states = [{'handover_token': token, 'database': 'homo_sapiens_core_110_38',
+                   'message': 'Handover submitted, checking database'} for token in (first, second)]
+        with mock.patch.object(utils.state_store, 'by_database', return_value=states):
+            self.assertTrue(utils.check_handover_db_resubmit({'database': 'homo_sapiens_core_110_38',
+                                                              'handover_token': first})['status'])
+            self.assertFalse(utils.check_handover_db_resubmit({'database': 'homo_sapiens_core_110_38',
+                                                               'handover_token': second})['status'])
+
+    def test_invalid_submission_rejected(self):
+        with self.assertRaises(ValueError):
+            tasks.submit_handover({**self.spec, 'src_uri': 'mysql://user@host:3306/my_database'})
+        self.delay.assert_not_called()
+
+    def test_validation_failure_reported_against_token(self):
+        spec = {**self.spec, 'database': 'homo_sapiens_core_110_38', 'handover_token': 'token'}
+        with mock.patch.object(tasks, 'validate_handover', side_effect=ValueError('Database division plants')), \
+                mock.patch.object(tasks, 'start_handover') as start:
+            tasks.validate_handover_task.run(spec)
+        start.assert_not_called()
+        report = self.publish.call_args[0][0]
+        self.assertEqual('ERROR', report['report_type'])
+        self.assertEqual('token', report['params']['handover_token'])
+        self.release.assert_called_once_with('homo_sapiens_core_110_38', 'token')
+
+    def test_validation_error_reported_once(self):
+        spec = {**self.spec, 'database': 'homo_sapiens_core_110_38', 'handover_token': 'token'}
+
+        def validate(spec, **kwargs):
+            utils.log_and_publish(make_report('ERROR', 'Handover failed, release 109 does not match', spec))
+            raise ValueError('release 109 does not match')
+
+        with mock.patch.object(utils, 'publisher') as publisher, mock.patch.object(utils, 'state_writer'), \
+                mock.patch.object(tasks, 'validate_handover', side_effect=validate):
+            self.assertFalse(utils.error_reported(spec))
+            tasks.validate_handover_task.run(spec)
+        self.assertTrue(utils.error_reported(spec))
+        publisher.publish.assert_called_once()
+        self.publish.assert_not_called()
+        self.release.assert_called_once_with('homo_sapiens_core_110_38', 'token')
+
+    def test_validation_success_starts_workflow(self):
+        spec = {**self.spec, 'handover_token': 'token'}
+        with mock.patch.object(tasks, 'validate_handover', return_value=(spec, 'dc-1', spec['src_uri'])) as validate, \
+                mock.patch.object(tasks, 'start_handover') as start:
+            tasks.validate_handover_task.run(spec)
+        self.assertEqual('token', validate.call_args[1]['handover_token'])
+        start.assert_called_once_with(spec, 'dc-1', spec['src_uri'])
+
+
+class TestDatabaseReservations(unittest.TestCase):
+
+    def setUp(self):
+        self.store = mock.Mock()
+        self.reservations = DatabaseReservations(self.store, index='reservations', timeout=600)
+        connect = mock.patch.object(self.reservations, 'connect').start()
+        self.addCleanup(mock.patch.stopall)
+        self.client = connect.return_value.__enter__.return_value.client
+        self.conflict = ConflictError(409, 'version_conflict_engine_exception', {})
+
+    def held_by(self, token, reserved_at=None):
+        self.client.index.side_effect = [self.conflict, None]
+        self.client.get.return_value = {'_seq_no': 4, '_primary_term': 1, '_source': {
+            'database': 'db', 'handover_token': token,
+            'reserved_at': (reserved_at or datetime.datetime.now()).isoformat()}}
+
+    def test_reserved_once_created(self):
+        self.assertIsNone(self.reservations.reserve('db', 'token'))
+        self.assertEqual('create', self.client.index.call_args[1]['op_type'])
+        self.assertEqual('db', self.client.index.call_args[1]['id'])
+
+    def test_held_by_running_handover(self):
+        self.held_by('first')
+        self.store.get.return_value = {'status': 'running'}
+        self.assertEqual('first', self.reservations.reserve('db', 'token'))
+        self.assertEqual(1, self.client.index.call_count)
+
+    def test_held_by_submission_not_yet_in_state(self):
+        self.held_by('first')
+        self.store.get.return_value = None
+        self.assertEqual('first', self.reservations.reserve('db', 'token'))
+
+    def test_taken_over_once_handover_over(self):
+        for state, reserved_at in (({'status': 'failed'}, None),
+                                   (None, datetime.datetime.now() - datetime.timedelta(hours=1))):
+            self.held_by('first', reserved_at)
+            self.store.get.return_value = state
+            self.assertIsNone(self.reservations.reserve('db', 'token'))
+            self.assertEqual(4, self.client.index.call_args[1]['if_seq_no'])
+            self.assertEqual('token', self.client.index.call_args[1]['body']['handover_token'])
+
+    def test_released_by_its_handover_only(self):
+        self.held_by('first')
+        self.reservations.release('db', 'token')
+        self.client.delete.assert_not_called()
+        self.reservations.release('db', 'first')
+        self.assertEqual(4, self.client.delete.call_args[1]['if_seq_no'])
+        self.client.get.side_effect = NotFoundError(404, 'not_found', {})
+        self.reservations.release('db', 'first')
+        self.assertEqual(1, self.client.delete.call_count)
@@ -0,0 +1,128 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import tempfile
+import unittest
+import uuid
+from unittest import mock
+
+from ensembl.production.handover import tracing
+from ensembl.production.handover.celery_app import utils
+
+TOKEN = str(uuid.uuid1())
+
+
+class TestSpans(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = tracing.MemoryExporter()
+        mock.patch.object(tracing, 'exporter', self.exporter).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_spans_nested_in_the_handover_trace(self):
+        with tracing.trace(TOKEN, 'handover submission'):
+            with tracing.span('submit_dc', database='db'):
+                with tracing.span('datacheck.submit_job'):
+                    pass
+        inner, middle, root = self.exporter.spans(TOKEN)
+        self.assertEqual(uuid.UUID(TOKEN).hex, root['trace_id'])
+        self.assertIsNone(root['parent_id'])
+        self.assertEqual(root['span_id'], middle['parent_id'])
+        self.assertEqual(middle['span_id'], inner['parent_id'])
+        self.assertEqual({'database': 'db'}, middle['attributes'])
+        self.assertGreaterEqual(root['duration'], inner['duration'])
+
+    def test_error_recorded(self):
+        with self.assertRaises(ValueError):
+            with tracing.trace(TOKEN, 'handover submission'):
+                raise ValueError('no such database')
+        self.assertEqual('ValueError: no such database', self.exporter.spans(TOKEN)[0]['error'])
+
+    def test_nothing_recorded_outside_of_a_trace(self):
+        with tracing.span('mysql query') as span:
+            self.assertIsNone(span)
+        self.assertIsNone(tracing.current_context())
+        self.assertEqual([], self.exporter.spans())
+
+    def test_nothing_recorded_when_tracing_off(self):
+        with mock.patch.object(tracing, 'exporter', None):
+            with tracing.trace(TOKEN, 'handover submission') as root:
+                self.assertIsNone(root)
+        self.assertEqual([], self.exporter.spans())
+
+    def test_context_sent_with_messages(self):
+        with tracing.trace(TOKEN, 'handover submission'):
+            headers = {}
+            utils.propagate_trace(headers=headers)
+        context = headers[tracing.HEADER]
+        self.assertEqual(TOKEN, context['handover_token'])
+        with tracing.use(context):
+            with tracing.span('resumed'):
+                pass
+        root, resumed = self.exporter.spans(TOKEN)
+        self.assertEqual(root['span_id'], resumed['parent_id'])
+
+    def test_task_spans(self):
+        with tracing.trace(TOKEN, 'handover submission'):
+            context = tracing.current_context()
+        tracing.task_spans.start('task-1', 'task datacheck_task', context, retries=0)
+        with tracing.span('datacheck.retrieve_job'):
+            pass
+        tracing.task_spans.end('task-1', 'RETRY')
+        self.assertIsNone(tracing.current_context())
+        root, task, call = sorted(self.exporter.spans(TOKEN), key=lambda span: span['start'])
+        self.assertEqual(root['span_id'], task['parent_id'])
+        self.assertEqual(task['span_id'], call['parent_id'])
+        self.assertEqual('RETRY', task['attributes']['state'])
+
+    def test_task_spans_from_signals(self):
+        with tracing.trace(TOKEN, 'handover submission'):
+            context = tracing.current_context()
+        task = mock.Mock(request=mock.Mock(retries=1, **{tracing.HEADER: context}))
+        task.name = 'ensembl.production.handover.celery_app.tasks.dbcopy_task'
+        utils.start_task_span(task_id='task-3', task=task)
+        self.assertEqual(TOKEN, tracing.current_context()['handover_token'])
+        utils.end_task_span(task_id='task-3', state='FAILURE', retval=ValueError('copy failed'))
+        task_span = self.exporter.spans(TOKEN)[-1]
+        self.assertEqual('task dbcopy_task', task_span['name'])
+        self.assertEqual({'celery_task_id': 'task-3', 'retries': 1, 'state': 'FAILURE'}, task_span['attributes'])
+        self.assertEqual('ValueError: copy failed', task_span['error'])
+
+    def test_task_without_context(self):
+        tracing.task_spans.start('task-2', 'task update_report', None)
+        self.assertIsNone(tracing.current_context())
+        tracing.task_spans.end('task-2', 'SUCCESS')
+        self.assertEqual([], self.exporter.spans())
+
+
+class TestFileExporter(unittest.TestCase):
+
+    def test_spans_reported_from_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'spans.jsonl')
+        with mock.patch.object(tracing, 'exporter', tracing.FileExporter(path)):
+            with tracing.trace(TOKEN, 'handover submission'):
+                with tracing.span('es POST _search'):
+                    pass
+            with tracing.trace(str(uuid.uuid1()), 'handover submission'):
+                pass
+        spans = tracing.load(path, TOKEN)
+        self.assertEqual(['handover submission', 'es POST _search'], [span['name'] for span in spans])
+        lines = tracing.report(spans).splitlines()
+        self.assertTrue(lines[1].endswith('  es POST _search'))
+
+    def test_create_exporter(self):
+        self.assertIsNone(tracing.create_exporter('none'))
+        self.assertIsInstance(tracing.create_exporter('memory'), tracing.MemoryExporter)
+        self.assertIsInstance(tracing.create_exporter(f'{tracing.__name__}:MemoryExporter'), tracing.MemoryExporter)
+        with self.assertRaises(ValueError):
+            tracing.create_exporter('jaeger')
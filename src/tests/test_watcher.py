@@ -0,0 +1,115 @@
+# See the NOTICE file distributed with this work for additional information
+#   regarding copyright ownership.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+from unittest import mock
+
+from celery import Celery
+from celery.exceptions import Ignore, Retry
+
+from ensembl.production.handover.celery_app import backoff, watcher
+
+test_app = Celery('handover_watcher_test', set_as_current=False)
+
+
+@test_app.task(bind=True, base=watcher.HandoverTask)
+def waiting_task(self, spec):
+    self.wait_for_job('dbcopy', spec['copy_job_id'], spec)
+
+
+class TestWaitForJob(unittest.TestCase):
+
+    def setUp(self):
+        self.spec = {'handover_token': 'token', 'copy_job_id': 'job-1'}
+        self.chain = [{'task': 'next_task'}]
+        waiting_task.push_request(args=[self.spec], chain=list(self.chain), retries=2)
+        self.addCleanup(waiting_task.pop_request)
+        self.retry = mock.patch.object(waiting_task, 'retry', side_effect=Retry()).start()
+        self.register = mock.patch.object(watcher.registry, 'register').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_poll_mode_retries(self):
+        test_app.conf.completion_mode = 'poll'
+        with self.assertRaises(Retry):
+            waiting_task.wait_for_job('dbcopy', 'job-1', self.spec)
+        self.register.assert_not_called()
+        self.assertIn('countdown', self.retry.call_args[1])
+
+    def test_notify_mode_hands_over_chain(self):
+        test_app.conf.completion_mode = 'notify'
+        with self.assertRaises(Ignore):
+            waiting_task.wait_for_job('dbcopy', 'job-1', self.spec)
+        self.retry.assert_not_called()
+        self.assertIsNone(waiting_task.request.chain)
+        stage, job_id, spec, payload, next_check = self.register.call_args[0]
+        self.assertEqual(('dbcopy', 'job-1'), (stage, job_id))
+        self.assertEqual(waiting_task.name, payload['task'])
+        self.assertEqual([self.spec], payload['args'])
+        self.assertEqual(self.chain, payload['chain'])
+        self.assertEqual(3, payload['retries'])
+
+    def test_notify_mode_falls_back_to_polling(self):
+        test_app.conf.completion_mode = 'notify'
+        self.register.side_effect = RuntimeError('Cannot connect to Elasticsearch server')
+        with self.assertRaises(Retry):
+            waiting_task.wait_for_job('dbcopy', 'job-1', self.spec)
+        self.assertEqual(self.chain, waiting_task.request.chain)
+
+    def test_duration_recorded_for_the_learned_backoff(self):
+        spec = {'db_type': 'core', 'timeline': {'dbcopy': {'start': '2023-05-02T10:00:00'}}}
+        test_app.conf.learned_backoff = False
+        with mock.patch.object(watcher.history, 'record') as record, \
+                mock.patch.object(backoff.HandoverCeleryConfig, 'learned_backoff', True):
+            waiting_task.stage_completed('dbcopy', spec)
+        self.assertEqual(('core', 'dbcopy'), record.call_args[0][:2])
+
+
+class TestCheckPendingJob(unittest.TestCase):
+
+    def setUp(self):
+        self.payload = {'task': 'dbcopy_task', 'args': [{'src_uri': 'mysql://user@host:3306/db'}],
+                        'chain': [], 'retries': 1}
+        self.app = mock.Mock()
+        self.claim = mock.patch.object(watcher.registry, 'claim', return_value=True).start()
+        self.update = mock.patch.object(watcher.registry, 'update').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_running_job_stays_pending(self):
+        result = {'overall_status': 'Running'}
+        self.assertFalse(watcher.check_pending_job(self.app, 'dbcopy', 'job-1', self.payload, result))
+        self.claim.assert_not_called()
+        self.app.send_task.assert_not_called()
+        stage, job_id, payload, next_check = self.update.call_args[0]
+        self.assertEqual(2, payload['retries'])
+
+    def test_running_job_checks_counted(self):
+        self.payload['args'][0]['timeline'] = {'dbcopy': {'start': '2023-05-02T11:00:00', 'polls': 1}}
+        watcher.check_pending_job(self.app, 'dbcopy', 'job-1', self.payload, {'overall_status': 'Running'})
+        self.assertEqual({'start': '2023-05-02T11:00:00', 'polls': 2, 'job_id': 'job-1'},
+                         self.payload['args'][0]['timeline']['dbcopy'])
+
+    def test_completed_job_resumes_chain(self):
+        result = {'overall_status': 'Complete'}
+        self.assertTrue(watcher.check_pending_job(self.app, 'dbcopy', 'job-1', self.payload, result))
+        self.claim.assert_called_once_with('dbcopy', 'job-1')
+        self.app.send_task.assert_called_once_with('dbcopy_task', args=self.payload['args'], chain=[], retries=1)
+
+    def test_already_claimed_job_is_not_resumed_twice(self):
+        result = {'overall_status': 'Failed'}
+        self.claim.return_value = False
+        self.assertFalse(watcher.check_pending_job(self.app, 'dbcopy', 'job-1', self.payload, result))
+        self.app.send_task.assert_not_called()
+
+    def test_retrieval_error_resumes_chain(self):
+        result = RuntimeError('500 Server Error')
+        self.assertTrue(watcher.check_pending_job(self.app, 'dbcopy', 'job-1', self.payload, result))
+        self.app.send_task.assert_called_once()